@@ -0,0 +1,18 @@
+from datetime import datetime, timezone
+from sampleapp.models import database
+from sampleapp.models.user import User
+
+# ユーザーのidを保存する前に登録されたemailアドレスにidを追加する
+# 使い方: python -m db.migrate_email_index
+backend = database.get_backend()
+for user in User.all():
+    with backend.transaction():
+        entity = backend.get(User.KIND_EMAILS, user.email)
+        if entity is not None and entity.get('user_id') == user.id:
+            continue
+        print(f'migrate email: {user.email}')
+        if entity is None:
+            entity = database.Entity(User.KIND_EMAILS, user.email)
+            entity['created_at'] = datetime.now(timezone.utc)
+        entity['user_id'] = user.id
+        backend.put(entity)
@@ -0,0 +1,27 @@
+import hashlib
+import sys
+from google.cloud import storage
+from sampleapp.models.micropost import Micropost
+from sampleapp.models.image import Image
+
+# 画像の情報をmicropostに保存する前に投稿されたmicropostに画像の情報を追加する
+# 使い方: python -m db.migrate_image_metadata <バケット名>
+bucket = storage.Client().bucket(sys.argv[1])
+for image in Image.all():
+    micropost = Micropost.find(image.micropost_id)
+    if micropost is None or micropost.image is not None:
+        continue
+    print(f'migrate image: {image.micropost_id}/{image.file_name}')
+    blob_name = f'{image.micropost_id}/{image.file_name}'
+    blob = bucket.get_blob(blob_name)
+    if blob is None:
+        continue
+    micropost.image = {
+        'file_name': image.file_name,
+        'blob_name': blob_name,
+        'content_type': blob.content_type,
+        'size': blob.size,
+        'sha256': hashlib.sha256(blob.download_as_bytes()).hexdigest(),
+        'variants': {},
+    }
+    micropost._insert_or_update()
@@ -0,0 +1,20 @@
+from sampleapp.models import database
+from sampleapp.models.relationship import Relationship
+
+# 自動で割り当てたidで作成したrelationshipを"{follower_id}:{followed_id}"を
+# idとするものに作り直す。重複していたものは1つにしてカウンタを減らす
+# 使い方: python -m db.migrate_relationship_keys
+backend = database.get_backend()
+for entity in backend.query(Relationship.KIND_RELATIONSHIPS):
+    key = Relationship.key(entity['follower_id'], entity['followed_id'])
+    if entity.id == key:
+        continue
+    print(f'migrate relationship: {entity.id} -> {key}')
+    with backend.transaction():
+        if backend.get(Relationship.KIND_RELATIONSHIPS, key) is None:
+            new_entity = database.Entity(Relationship.KIND_RELATIONSHIPS, key)
+            new_entity.update(entity)
+            backend.put(new_entity)
+        else:
+            Relationship(id=entity.id, **entity)._increment_counters(-1)
+        backend.delete(Relationship.KIND_RELATIONSHIPS, entity.id)
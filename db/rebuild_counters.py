@@ -0,0 +1,25 @@
+from sampleapp.models import database
+from sampleapp.models.user import User
+from sampleapp.models.micropost import Micropost
+from sampleapp.models.relationship import Relationship
+from sampleapp.models.image import Image
+from sampleapp.models.counter import Counter
+
+# カウンタ導入前に作成されたユーザーの件数を数え直す
+for user in User.all():
+    print(f'rebuild counters: {user.name}')
+    counts = {
+        'following': len(Relationship.find_by(follower_id=user.id)),
+        'followers': len(Relationship.find_by(followed_id=user.id)),
+        'microposts': len(user.microposts()),
+    }
+    for field, value in counts.items():
+        Counter.reset(Counter.name(User.KIND_USERS, user.id, field), value)
+
+# kind全体の件数を数え直す
+backend = database.get_backend()
+for kind in (User.KIND_USERS, Micropost.KIND_MICROPOSTS,
+             Relationship.KIND_RELATIONSHIPS, Image.KIND_IMAGES):
+    count = backend.count(kind)
+    print(f'rebuild counters: {kind} {count}')
+    Counter.reset(Counter.kind_name(kind), count)
@@ -0,0 +1,7 @@
+from sampleapp.models.user import User
+from sampleapp.models.timeline import Timeline
+
+# タイムライン導入前に作成されたユーザーのタイムラインを作り直す
+for user in User.all():
+    print(f'rebuild timeline: {user.name}')
+    Timeline.rebuild(user.id)
@@ -0,0 +1,7 @@
+from sampleapp.models.micropost import Micropost
+
+# ブラウザから直接アップロードされたままフォームが送信されなかった画像
+# (uploads/以下でMicropost.UPLOADS_MAX_AGEより古いもの)を削除する
+# cronなどで1日に1回程度実行する
+# 使い方: python -m db.sweep_uploads
+print(f'deleted {Micropost.sweep_uploads()} uploads')
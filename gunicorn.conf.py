@@ -0,0 +1,17 @@
+# gunicornの設定
+
+# passwordのhashを計算するプロセスのプールはworkerごとに作られ、
+# CPUのコア数をworkerの数(環境変数WEB_CONCURRENCY)で割った数のプロセスを使う
+# -wやworkersで指定した時も合うよう、post_forkで実際のworkerの数を設定する
+# プロセスの数を直接決める時はSAMPLEAPP_PASSWORD_HASHING_WORKERSを指定する
+# preloadでmasterプロセスがクライアントを作成していてもworkerでは作り直す
+def post_fork(server, worker):
+    import os
+    os.environ['WEB_CONCURRENCY'] = str(server.cfg.workers)
+    from sampleapp.models import clients
+    clients.reset()
+
+# バックグラウンドで実行中の画像のアップロードが終わってからworkerを終了する
+def worker_exit(server, worker):
+    from sampleapp.models import uploads
+    uploads.wait(timeout=60)
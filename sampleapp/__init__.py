@@ -6,6 +6,14 @@ from .controllers import account_activations_controller
 from .controllers import password_resets_controller
 from .controllers import microposts_controller
 from .controllers import relationships_controller
+from .controllers import images_controller
+from .mailers import mail_queue
+from .models import database
+from .models import feed
+from .models import identity_map
+from .models import image_storage
+from .models import password_hashing
+from .models import user_deletion
 
 def create_app(test_config=None):
     app = Flask(__name__, instance_relative_config=True)
@@ -19,6 +27,21 @@ def create_app(test_config=None):
     else:
         app.config.from_mapping(test_config)
 
+    # モデルが使用するデータストアのバックエンドを設定する
+    database.init_app(app)
+    # feedの読み出し方を設定する
+    feed.init_app(app)
+    # リクエスト内で読み出したエンティティの再利用状況をdebugログに出す
+    identity_map.init_app(app)
+    # 画像を保存するストレージを設定する
+    image_storage.init_app(app)
+    # passwordのhashの計算が混んでいる時に503を返す
+    password_hashing.init_app(app)
+    # 中断したユーザーの削除を再開する
+    user_deletion.init_app(app)
+    # キューに入っているメールを送るworkerを起動する
+    mail_queue.init_app(app)
+
     # register static_pages blueprint
     app.register_blueprint(static_pages_controller.bp)
 
@@ -42,6 +65,9 @@ def create_app(test_config=None):
     # register relationships blueprint
     app.register_blueprint(relationships_controller.bp)
 
+    # register images blueprint
+    app.register_blueprint(images_controller.bp)
+
     @app.after_request
     def add_default_headers(resp):
         resp.headers['X-XSS-Protection'] = '1; mode=block'
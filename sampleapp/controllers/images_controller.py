@@ -0,0 +1,52 @@
+import mimetypes
+import os
+from flask import Blueprint, abort, request, send_file
+from ..models import image_storage
+
+# ローカルのファイルシステムに保存した画像(image_storage.LocalStorage)を配信する
+# send_fileのconditionalでETag(If-None-Match)とRangeに対応する
+# USE_X_SENDFILEを設定するとファイルの送信をWebサーバーに任せる。設定しない時も
+# gunicornはwsgi.file_wrapperでsendfileを使うのでファイルの内容をコピーしない
+# PUTはCloud Storageの署名付きURLの代わりにブラウザからのアップロードを受け取る
+
+bp = Blueprint('images', __name__, url_prefix='/images')
+
+# blob名は内容のSHA-256から作るので内容が変わることはなく、長期間キャッシュできる
+CACHE_TIMEOUT = 365 * 24 * 60 * 60
+
+@bp.route('/<path:blob_name>')
+def show(blob_name):
+    storage = image_storage.get_storage()
+    if not isinstance(storage, image_storage.LocalStorage):
+        abort(404)
+    path = storage.path(blob_name)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    response = send_file(path, mimetype=mimetype, conditional=True,
+                         cache_timeout=CACHE_TIMEOUT)
+    response.cache_control.public = True
+    response.headers['Cache-Control'] += ', immutable'
+    return response
+
+@bp.route('/<path:blob_name>', methods=['PUT'])
+def upload(blob_name):
+    storage = image_storage.get_storage()
+    if not isinstance(storage, image_storage.LocalStorage):
+        abort(404)
+    args = request.args
+    content_type = args.get('content_type')
+    max_size = args.get('max_size', type=int)
+    if storage.path(blob_name) is None or \
+       not storage.verify_upload(blob_name, content_type, max_size,
+                                 args.get('expires'), args.get('signature')):
+        abort(403)
+    if request.mimetype != content_type:
+        abort(415)
+    if request.content_length is None:
+        abort(411)
+    if max_size < request.content_length:
+        abort(413)
+    # request.streamはContent-Lengthを超えて読まない
+    storage.put(blob_name, request.stream, content_type)
+    return '', 201
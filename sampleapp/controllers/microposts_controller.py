@@ -3,7 +3,8 @@ from flask import (Blueprint, abort, request, flash, redirect, url_for,
 from ..controllers.users_controller import logged_in_user
 from ..helpers.application_helper import check_csrf_token
 from ..helpers.sessions_helper import current_user
-from flask_paginate import Pagination, get_page_parameter
+from ..helpers.application_helper import CursorPagination
+from ..models.micropost import Micropost
 
 bp = Blueprint('microposts', __name__, url_prefix='/microposts')
 
@@ -16,28 +17,44 @@ def create():
 
     content = request.form['content']
     micropost = current_user().microposts.build(content=content)
-    image_file = request.files.get('image')
-    #print(f'\n**** image ****\n{image_file}, {not(not(image_file))}\n')
-    micropost.image_attach(image_file)
+    image_blob = request.form.get('image_blob')
+    if image_blob:
+        # ブラウザがストレージに直接アップロードした画像
+        micropost.image_attach_upload(image_blob)
+    else:
+        image_file = request.files.get('image')
+        #print(f'\n**** image ****\n{image_file}, {not(not(image_file))}\n')
+        micropost.image_attach(image_file)
     if micropost.save():
         flash('Micropost created!', 'success')
         root_url = url_for('static_pages.home', _external=True)
         return redirect(root_url)
     else:
-        feed_items = current_user().feed()
-        page = request.args.get(get_page_parameter(), type=int, default=1)
+        cursor = request.args.get('cursor')
         per_page = 30
-        total = len(feed_items)
-        feed_items = feed_items[(page-1)*per_page:page*per_page]
-        pagination = Pagination(
-            page=page, total=total, per_page=per_page,
-            href=url_for('static_pages.home')+'?page={0}',
-            prev_label='&larr; Previous', next_label='Next &rarr;',
-            css_framework='bootstrap3')
+        feed_items = current_user().feed(limit=per_page, cursor=cursor)
+        Micropost.preload(feed_items, 'user')
+        pagination = CursorPagination(feed_items, url_for('static_pages.home'))
         return render_template('static_pages/home.html',
                                micropost=micropost, feed_items=feed_items,
                                pagination=pagination, csrf_token=csrf_token)
 
+# 画像をブラウザからストレージに直接アップロードするための署名付きURLを返す
+# 画像の内容はアプリのworkerを経由しない
+@bp.route('/uploads', methods=['POST'])
+@logged_in_user
+def upload():
+    csrf_token = check_csrf_token()
+    if not csrf_token:
+        abort(422)
+
+    content_type = request.form.get('content_type', '')
+    size = request.form.get('size', type=int)
+    upload = Micropost.signed_image_upload(current_user().id, content_type, size)
+    if upload is None:
+        abort(422)
+    return upload
+
 @bp.route('/<int:id>', methods=['POST'])
 @logged_in_user
 def destroy(id):
@@ -18,8 +18,8 @@ def create():
         abort(422)
 
     email = request.form['email']
-    users = User.find_by(email=email)
-    if users and (user:=users[0]):
+    user = User.find_by_email(email)
+    if user:
         user.create_reset_digest()
         user.send_password_reset_email(current_app)
         flash('Email sent with password reset instructions', 'info')
@@ -32,8 +32,8 @@ def create():
 @bp.route('/<id>/edit')
 def edit(id):
     email = request.args.get('email')
-    users = User.find_by(email=email)
-    if not (users and (user:=users[0]) and user.activated and \
+    user = User.find_by_email(email)
+    if not (user and user.activated and \
             user.authenticated('reset', id)):
         url = url_for('static_pages.home', _external=True)
         return redirect(url)
@@ -60,8 +60,8 @@ def update(id):
         return redirect(url)
 
     email = request.form.get('email')
-    users = User.find_by(email=email)
-    if not (users and (user:=users[0]) and user.activated and \
+    user = User.find_by_email(email)
+    if not (user and user.activated and \
             user.authenticated('reset', id)):
         url = url_for('static_pages.home', _external=True)
         return redirect(url)
@@ -27,15 +27,16 @@ def create():
     accept = request.headers.get('Accept', '')
     if accept and accept.lower() == 'application/json':
         return {'result':'ok',
-                'followers': len(user.followers()),
-                'relation_id': cur.active_relationships_find_by(user.id).id,
+                'followers': user.followers_count(),
+                'relation_id': Relationship.key(cur.id, user.id),
                 'csrf_token': csrf_token()
                 }
     else:
         url = url_for('users.show', id=user.id, _external=True)
         return redirect(url)
 
-@bp.route('/<int:id>', methods=['POST'])
+# idは"{follower_id}:{followed_id}"
+@bp.route('/<id>', methods=['POST'])
 @logged_in_user
 def destroy(id):
     # CSRF対策
@@ -43,7 +44,10 @@ def destroy(id):
     if not token:
         abort(422)
 
-    user = Relationship.find(id).followed()
+    relationship = Relationship.find(id)
+    if relationship is None:
+        abort(404)
+    user = relationship.followed()
     if user is None:
         abort(404)
 
@@ -52,7 +56,7 @@ def destroy(id):
     accept = request.headers.get('Accept', '')
     if accept and accept.lower() == 'application/json':
         return {'result':'ok',
-                'followers': len(user.followers()),
+                'followers': user.followers_count(),
                 'user_id': user.id,
                 'csrf_token': csrf_token()
         }
@@ -24,8 +24,8 @@ def create():
 
     email = request.form['email'].lower()
     password = request.form['password']
-    users = User.find_by(email=email)
-    if users and (user := users[0]) and user.authenticate(password):
+    user = User.find_by_email(email)
+    if user and user.authenticate(password):
         if user.activated:
             # login成功
             log_in(user)
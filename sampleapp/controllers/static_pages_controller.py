@@ -1,7 +1,7 @@
-from flask import Blueprint, render_template, request
+from flask import Blueprint, render_template, request, url_for
 from ..helpers.sessions_helper import logged_in, current_user
-from ..helpers.application_helper import csrf_token
-from flask_paginate import Pagination, get_page_parameter
+from ..helpers.application_helper import csrf_token, CursorPagination
+from ..models.micropost import Micropost
 
 # 1st arg: The name of the blueprint. Will be prepended to each endpoint name.
 bp = Blueprint('static_pages', __name__, url_prefix='/')
@@ -13,14 +13,12 @@ def home():
         token = csrf_token()
         user = current_user()
         micropost = user.microposts.build()
-        feed_items = user.feed()
-        page = request.args.get(get_page_parameter(), type=int, default=1)
+        cursor = request.args.get('cursor')
         per_page = 30
-        total = len(feed_items)
-        feed_items = feed_items[(page-1)*per_page:page*per_page]
-        pagination = Pagination(page=page, total=total, per_page=per_page,
-                            prev_label='&larr; Previous', next_label='Next &rarr;',
-                            css_framework='bootstrap3')
+        feed_items = user.feed(limit=per_page, cursor=cursor)
+        # 表示する投稿者をまとめて読み込む
+        Micropost.preload(feed_items, 'user')
+        pagination = CursorPagination(feed_items, url_for('static_pages.home'))
     return render_template('static_pages/home.html',
                            micropost=micropost, feed_items=feed_items,
                            pagination=pagination, csrf_token=token)
@@ -1,7 +1,9 @@
 from flask import (Blueprint, render_template, session, request, abort,
                    redirect, url_for, flash, current_app)
 from ..models.user import User
-from ..helpers.application_helper import csrf_token, check_csrf_token
+from ..models.micropost import Micropost
+from ..helpers.application_helper import (csrf_token, check_csrf_token,
+                                          CursorPagination)
 from ..helpers.sessions_helper import (logged_in, is_current_user,
                                        store_location, current_user)
 import secrets
@@ -47,21 +49,9 @@ def admin_user(f):
 @bp.route('/')
 @logged_in_user
 def index():
-    page = request.args.get(get_page_parameter(), type=int, default=1)
-    per_page = 30
-    # 全ユーザー数を取得するUser.countメソッドでどのみちUser.allを呼び出すので
-    # paginateは使用しないでUser.allを使用する
-    #users = User.paginate(page)
-    users = User.all()
-    total = len(users)
-    users = users[(page-1)*per_page:page*per_page]
-    # User.paginateを使う場合
-    # pagination = Pagination(page=page, total=User.count(), per_page=per_page,
-    #                         prev_label='&larr; Previous', next_label='Next &rarr;',
-    #                         css_framework='bootstrap3')
-    pagination = Pagination(page=page, total=total, per_page=per_page,
-                            prev_label='&larr; Previous', next_label='Next &rarr;',
-                            css_framework='bootstrap3')
+    cursor = request.args.get('cursor')
+    users = User.paginate(cursor=cursor)
+    pagination = CursorPagination(users, url_for('users.index'))
     return render_template('users/index.html', users=users, pagination=pagination)
 
 @bp.route('/<int:id>')
@@ -74,6 +64,8 @@ def show(id):
     microposts = user.microposts()
     total = user.microposts.count()
     microposts = microposts[(page-1)*per_page:page*per_page]
+    # 表示する投稿者をまとめて読み込む
+    Micropost.preload(microposts, 'user')
     pagination = Pagination(page=page, total=total, per_page=per_page,
                             prev_label='&larr; Previous', next_label='Next &rarr;',
                             css_framework='bootstrap3')
@@ -101,10 +93,8 @@ def create():
 
     if user.save():
         try:
+            # メールはキューに入れるだけで、送信はバックグラウンドで行う
             user.send_activation_email(current_app)
-        except ConnectionRefusedError as e:
-            user.destroy()
-            abort(500, description='Unable to send the confirmation email')
         except BaseException as e:
             user.destroy()
             raise e
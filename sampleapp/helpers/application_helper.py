@@ -1,4 +1,6 @@
 from flask import session, request
+from markupsafe import Markup, escape
+from urllib.parse import urlencode
 import secrets
 
 _CSRF_TOKEN = 'csrf_token'
@@ -38,6 +40,30 @@ def csrf_token_meta_tag():
     session[_CSRF_TOKEN_META_TAG] = token
     return token
 
+# カーソルで読み出したページ(keyset.Page)のページ送りリンク
+# flask_paginateのPaginationと同じくlinksで表示する
+class CursorPagination:
+    def __init__(self, page, href, prev_label='&larr; Previous',
+                 next_label='Next &rarr;'):
+        self.page = page
+        self.href = href
+        self.prev_label = prev_label
+        self.next_label = next_label
+
+    def _link(self, css_class, label, cursor):
+        if cursor:
+            url = escape(self.href + '?' + urlencode({'cursor': cursor}))
+            return f'<li class="{css_class}"><a href="{url}">{label}</a></li>'
+        return f'<li class="{css_class} disabled"><a>{label}</a></li>'
+
+    # flask_paginateと同じく1ページしか無い時も無効なリンクとして表示する
+    @property
+    def links(self):
+        s = '<ul class="pagination">' +\
+            self._link('previous', self.prev_label, self.page.prev_cursor) +\
+            self._link('next', self.next_label, self.page.next_cursor) +\
+            '</ul>'
+        return Markup(s)
 
 def template_functions():
     return dict(full_title=full_title, csrf_token_meta_tag=csrf_token_meta_tag)
@@ -0,0 +1,256 @@
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from flask import has_request_context, request
+from flask_mail import Mail
+from ..models import database
+from . import user_mailer
+
+# メールをリクエストの中で送らず、データストアのキューに入れてworkerのthreadで送る
+# リクエストはキューに入れた時点で返るのでSMTPの接続待ちが応答時間に含まれない
+# キューはデータストアにあるのでプロセスが落ちても送られていないメールは残る
+#   取り出したメールはLEASE秒の間他のworkerから見えなくなり、送れたら削除する
+#   送れなかった時は間隔を倍にしながらMAX_ATTEMPTS回まで送り直す
+# テンプレートの描画もworkerで行う。キューにはmailerの名前とtokenのselectorだけを入れる
+#   tokenそのものをデータストアに置くとdigestだけを保存している意味が無くなるので、
+#   workerが同じselectorで新しいtokenを発行し直してメールに載せる
+#   selectorが変わっていたら(新しいメールを頼まれた、使われたなど)送らない
+# workerはSMTPの接続を使い回し、IDLE_TIMEOUT秒の間メールが無ければ閉じる
+# 接続は開いた時のアプリに結び付いているので、startで別のアプリに替わった時や
+# resetが呼ばれた時は閉じて開き直す
+
+KIND_MAIL_QUEUE = 'mail_queue'
+
+# 名前 -> user_mailerの関数
+MAILERS = {
+    'account_activation': user_mailer.account_activation,
+    'password_reset': user_mailer.password_reset,
+}
+# 名前 -> メールに載せるtokenの種類
+TOKENS = {
+    'account_activation': 'activation',
+    'password_reset': 'reset',
+}
+
+NUM_WORKERS = 2
+# 1回に取り出すメールの数
+BATCH = 20
+MAX_ATTEMPTS = 5
+RETRY_INTERVAL = 30
+LEASE = 5 * 60
+IDLE_TIMEOUT = 30
+# 他のプロセスが入れたメールや再送のメールを探す間隔
+POLL_INTERVAL = 5
+
+_logger = logging.getLogger(__name__)
+
+_app = None
+_pid = None
+_lock = threading.Lock()
+_wakeup = threading.Event()
+# resetのたびに増やす。workerは開いた時と違っていたら接続を閉じる
+_generation = 0
+# 取り出してから送り終わるまでのメールの数
+_in_flight = 0
+
+# user宛てのメールをキューに入れる。userにはメールに載せるtoken
+# (activation_tokenなど)が発行されていること。メールのURLはリクエストのURLを元に作る
+def deliver_later(app, mailer, user):
+    if mailer not in MAILERS:
+        raise ValueError(f'unknown mailer: {mailer}')
+    selector = user.token_selector(TOKENS[mailer])
+    if not selector:
+        raise ValueError(f'no token to deliver: {mailer}')
+    base_url = request.url_root if has_request_context() else None
+    now = datetime.now(timezone.utc)
+    entity = database.Entity(KIND_MAIL_QUEUE)
+    entity['mailer'] = mailer
+    entity['user_id'] = user.id
+    entity['selector'] = selector
+    entity['base_url'] = base_url
+    entity['attempts'] = 0
+    entity['run_at'] = now
+    entity['created_at'] = now
+    database.get_backend().put(entity)
+    # current_appが渡されることがあるのでproxyの中身を渡す
+    start(getattr(app, '_get_current_object', lambda: app)())
+    _wakeup.set()
+    return entity.id
+
+# workerのthreadを起動する。起動済みなら何もしない
+# fork後の子プロセスには親のthreadが無いので起動し直す
+def start(app):
+    global _app, _pid
+    with _lock:
+        _app = app
+        if _pid == os.getpid():
+            return
+        _pid = os.getpid()
+        for n in range(NUM_WORKERS):
+            thread = threading.Thread(target=_work, name=f'mail-{n}', daemon=True)
+            thread.start()
+
+# アプリの作成時にworkerを起動し、再起動前にキューに入っていたメールも送る
+# preloadでmasterプロセスが起動した時は、fork後のworkerの最初のリクエストで起動する
+def init_app(app):
+    start(app)
+
+    @app.before_request
+    def start_mail_queue():
+        if _pid != os.getpid():
+            start(app)
+
+# workerが開いている接続を閉じさせる。テストで使う
+def reset():
+    global _generation
+    with _lock:
+        _generation += 1
+    _wakeup.set()
+
+def _work():
+    global _in_flight
+    connection = None
+    connection_app = None
+    connection_generation = None
+    last_sent = time.monotonic()
+    while True:
+        try:
+            jobs = _claim(BATCH)
+        except Exception:
+            _logger.exception('failed to read the mail queue')
+            jobs = []
+        if not jobs:
+            if connection is not None and \
+               IDLE_TIMEOUT < time.monotonic() - last_sent:
+                connection = _close(connection)
+            _wakeup.wait(POLL_INTERVAL)
+            _wakeup.clear()
+            continue
+        with _lock:
+            app = _app
+            generation = _generation
+        if connection is not None and \
+           (connection_app is not app or connection_generation != generation):
+            connection = _close(connection)
+        # app contextやMailの準備で失敗してもthreadを終わらせず、
+        # 取り出したメールは数え終えて後で送り直す
+        pending = list(jobs)
+        try:
+            with app.app_context():
+                mail = app.extensions.get('mail') or Mail(app)
+                while pending:
+                    job = pending.pop(0)
+                    try:
+                        msg = _render(app, job)
+                        if msg is not None:
+                            if connection is None:
+                                connection = mail.connect()
+                                connection.__enter__()
+                                connection_app = app
+                                connection_generation = generation
+                            # メールを送る時にもapp contextが必要
+                            connection.send(msg)
+                            last_sent = time.monotonic()
+                        _done(job)
+                    except Exception as e:
+                        _logger.exception('failed to send mail %s', job.id)
+                        # 接続が切れているかもしれないので次は繋ぎ直す
+                        connection = _close(connection)
+                        _retry(job, e)
+                    finally:
+                        with _lock:
+                            _in_flight -= 1
+        except Exception as e:
+            _logger.exception('mail worker failed')
+            connection = _close(connection)
+            for job in pending:
+                try:
+                    _retry(job, e)
+                except Exception:
+                    # 送り直せなかったメールもLEASE秒後に取り出される
+                    _logger.exception('failed to retry mail %s', job.id)
+            with _lock:
+                _in_flight -= len(pending)
+
+def _close(connection):
+    if connection is not None:
+        try:
+            connection.__exit__(None, None, None)
+        except Exception:
+            pass
+    return None
+
+def _render(app, job):
+    from ..models.user import User
+    user = User.find(job['user_id'])
+    if user is None:
+        # キューに入れた後でユーザーが削除された
+        return None
+    if user.reissue_token(TOKENS[job['mailer']], job['selector']) is None:
+        # 新しいメールを頼まれたか、既にtokenが使われた
+        return None
+    base_url = job.get('base_url') or 'http://localhost/'
+    with app.test_request_context('/', base_url=base_url):
+        return MAILERS[job['mailer']](user)
+
+# 送る時刻になったメールを取り出す。他のworkerと同じメールを取り出さないよう
+# transactionの中でrun_atをLEASE秒後にずらす
+def _claim(limit):
+    global _in_flight
+    backend = database.get_backend()
+    # 取り出している間もwaitが待つように数えておく
+    with _lock:
+        _in_flight += 1
+    jobs = []
+    try:
+        now = datetime.now(timezone.utc)
+        entities = backend.query(KIND_MAIL_QUEUE, filters=[('run_at', '<=', now)],
+                                 order=['run_at'], limit=limit)
+        for e in entities:
+            try:
+                with backend.transaction():
+                    job = backend.get(KIND_MAIL_QUEUE, e.id)
+                    if job is None or now < job['run_at']:
+                        continue
+                    job['run_at'] = now + timedelta(seconds=LEASE)
+                    job['attempts'] += 1
+                    backend.put(job)
+            except database.Aborted:
+                continue
+            jobs.append(job)
+    finally:
+        with _lock:
+            _in_flight += len(jobs) - 1
+    return jobs
+
+def _done(job):
+    database.get_backend().delete(KIND_MAIL_QUEUE, job.id)
+
+def _retry(job, error):
+    backend = database.get_backend()
+    if MAX_ATTEMPTS <= job['attempts']:
+        _logger.error('giving up sending mail %s: %s', job.id, error)
+        backend.delete(KIND_MAIL_QUEUE, job.id)
+        return
+    interval = RETRY_INTERVAL * 2**(job['attempts'] - 1)
+    job['run_at'] = datetime.now(timezone.utc) + timedelta(seconds=interval)
+    job['last_error'] = str(error)
+    backend.put(job)
+
+# 送る時刻になったメールが無くなるまで待つ。テストで使う
+def wait(timeout=None):
+    deadline = None if timeout is None else time.monotonic() + timeout
+    backend = database.get_backend()
+    while deadline is None or time.monotonic() < deadline:
+        with _lock:
+            busy = 0 < _in_flight
+        now = datetime.now(timezone.utc)
+        if not busy and not backend.query(KIND_MAIL_QUEUE,
+                                          filters=[('run_at', '<=', now)],
+                                          limit=1, keys_only=True):
+            return True
+        _wakeup.set()
+        time.sleep(0.01)
+    return False
@@ -0,0 +1,77 @@
+import os
+import threading
+
+# Google Cloudのクライアントをプロセス(gunicornのworker)ごとに1つだけ作成して共有する
+# クライアントを作るたびに認証情報の探索やgRPCチャネルの作成が行われるので使い回す
+# fork後の子プロセスに親のgRPCチャネルを持ち込まないようpidが変わったら作り直す
+
+_factories = {}
+_clients = {}
+_lock = threading.Lock()
+_pid = os.getpid()
+_stats = {}
+
+def _new_stats():
+    return {'created': 0, 'reused': 0, 'resets': 0}
+
+def register(name, factory):
+    with _lock:
+        _factories[name] = factory
+        _stats.setdefault(name, _new_stats())
+
+def get(name):
+    if _pid != os.getpid():
+        reset()
+    client = _clients.get(name)
+    if client is not None:
+        _stats[name]['reused'] += 1
+        return client
+    with _lock:
+        client = _clients.get(name)
+        if client is None:
+            factory = _factories.get(name)
+            if factory is None:
+                raise KeyError(f'unknown client: {name}')
+            client = factory()
+            _clients[name] = client
+            _stats[name]['created'] += 1
+        else:
+            _stats[name]['reused'] += 1
+    return client
+
+def reset():
+    # 作成済みのクライアントを捨てる。次のget()で作り直される
+    global _pid
+    with _lock:
+        for name in _clients:
+            _stats[name]['resets'] += 1
+        _clients.clear()
+        _pid = os.getpid()
+
+def _after_fork():
+    # fork時に他のthreadがlockを持っていた可能性があるのでlockも作り直す
+    global _lock, _pid
+    _lock = threading.Lock()
+    for name in _clients:
+        _stats[name]['resets'] += 1
+    _clients.clear()
+    _pid = os.getpid()
+
+def stats():
+    with _lock:
+        return {name: dict(s) for name, s in _stats.items()}
+
+def _datastore_client():
+    from google.cloud import datastore
+    return datastore.Client()
+
+def _storage_client():
+    from google.cloud import storage
+    return storage.Client()
+
+register('datastore', _datastore_client)
+register('storage', _storage_client)
+
+# gunicorn以外の方法でforkされた場合にも備える
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
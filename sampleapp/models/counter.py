@@ -0,0 +1,123 @@
+import random
+import threading
+import time
+from . import database
+
+# 件数を数えるためだけに全エンティティを読まなくて済むように件数を別に保存しておく
+# 同じカウンタへの同時更新でtransactionが競合しないようにカウンタを
+# NUM_SHARDS個のエンティティに分けて保存し、更新時はその1つをランダムに選ぶ
+# 読み出しは全shardを1回のget_multiで読んで合計する
+# shardのidは"{カウンタ名}:{shard番号}"
+# kind全体の件数は全ての書き込みで更新されるので多めのshardに分ける
+class Counter:
+    KIND_COUNTERS = 'counters'
+    NUM_SHARDS = 4
+    NUM_KIND_SHARDS = 16
+    # increment_multiで1つのtransactionで更新するカウンタの数
+    MAX_BATCH = 500
+
+    # get_cachedで読んだ値を保持する {カウンタ名: (値, 期限)}
+    _cache = {}
+    _cache_lock = threading.Lock()
+
+    @staticmethod
+    def name(kind, id, field):
+        return f'{kind}:{id}:{field}'
+
+    # kind全体の件数のカウンタ名
+    @staticmethod
+    def kind_name(kind):
+        return f'{kind}:count'
+
+    @staticmethod
+    def _num_shards(name):
+        if name.endswith(':count'):
+            return Counter.NUM_KIND_SHARDS
+        return Counter.NUM_SHARDS
+
+    @staticmethod
+    def _shard_ids(name):
+        return [f'{name}:{n}' for n in range(Counter._num_shards(name))]
+
+    # transaction内で呼ばれた時はそのtransactionに含まれる
+    @staticmethod
+    def increment(name, delta=1):
+        backend = database.get_backend()
+        shard_id = f'{name}:{random.randrange(Counter._num_shards(name))}'
+        with backend.transaction():
+            shard = backend.get(Counter.KIND_COUNTERS, shard_id)
+            if shard is None:
+                shard = database.Entity(Counter.KIND_COUNTERS, shard_id)
+                shard['name'] = name
+                shard['count'] = 0
+            shard['count'] += delta
+            backend.put(shard)
+
+    # {カウンタ名: 増やす数}をまとめて更新する。MAX_BATCH個ずつ1つのtransactionで
+    # 読み書きするので、カウンタごとにincrementを呼ぶよりtransactionの数が少ない
+    @staticmethod
+    def increment_multi(deltas):
+        backend = database.get_backend()
+        items = [(name, delta) for name, delta in deltas.items() if delta]
+        for i in range(0, len(items), Counter.MAX_BATCH):
+            chunk = items[i:i+Counter.MAX_BATCH]
+            shard_ids = [f'{name}:{random.randrange(Counter._num_shards(name))}'
+                         for name, _ in chunk]
+            with backend.transaction():
+                shards = backend.get_multi(Counter.KIND_COUNTERS, shard_ids)
+                for n, shard in enumerate(shards):
+                    name, delta = chunk[n]
+                    if shard is None:
+                        shard = shards[n] = database.Entity(Counter.KIND_COUNTERS,
+                                                            shard_ids[n])
+                        shard['name'] = name
+                        shard['count'] = 0
+                    shard['count'] += delta
+                backend.put_multi(shards)
+
+    @staticmethod
+    def get(name):
+        return Counter.get_multi([name])[name]
+
+    # プロセス内にmax_age秒キャッシュした値を返す。正確さより速さが必要な時に使う
+    @staticmethod
+    def get_cached(name, max_age=60):
+        now = time.monotonic()
+        cached = Counter._cache.get(name)
+        if cached is not None and now < cached[1]:
+            return cached[0]
+        value = Counter.get(name)
+        with Counter._cache_lock:
+            Counter._cache[name] = (value, now + max_age)
+        return value
+
+    # 複数のカウンタを1回のget_multiで読み出す
+    @staticmethod
+    def get_multi(names):
+        backend = database.get_backend()
+        shard_ids = [id for name in names for id in Counter._shard_ids(name)]
+        shards = backend.get_multi(Counter.KIND_COUNTERS, shard_ids)
+        counts = {name: 0 for name in names}
+        for shard in shards:
+            if shard is not None:
+                counts[shard['name']] += shard['count']
+        return counts
+
+    # 件数を数え直した値で置き換える。既存データの移行に使う
+    @staticmethod
+    def reset(name, value=0):
+        backend = database.get_backend()
+        shard_ids = Counter._shard_ids(name)
+        with backend.transaction():
+            # 同じエンティティを1つのtransactionで2回更新しないよう0番は上書きする
+            backend.delete_multi(Counter.KIND_COUNTERS, shard_ids[1:])
+            shard = database.Entity(Counter.KIND_COUNTERS, shard_ids[0])
+            shard['name'] = name
+            shard['count'] = value
+            backend.put(shard)
+
+    @staticmethod
+    def delete(names):
+        backend = database.get_backend()
+        shard_ids = [id for name in names for id in Counter._shard_ids(name)]
+        backend.delete_multi(Counter.KIND_COUNTERS, shard_ids)
@@ -0,0 +1,129 @@
+import os
+import threading
+
+# モデルが使用するデータストアの抽象化層
+# モデルはdatastore.Clientを直接使わずにget_backend()で取得したバックエンドを使う
+# バックエンドは以下の3種類
+#   datastore: Cloud Datastore (本番用)
+#   memory:    プロセス内のdict (テストやローカルでの動作確認用)
+#   sqlite:    SQLite (ローカルで本番相当のデータ量を扱う時用。プロパティにindexを張る)
+
+# key filterに使うプロパティ名
+KEY = '__key__'
+
+# filterで使用できる演算子。INの値はリストで渡す
+OPERATORS = ('=', '<', '<=', '>', '>=', 'IN')
+# 1つのINに渡せる値の数の上限(Datastoreの制限)
+MAX_IN_VALUES = 30
+
+class Aborted(Exception):
+    # transaction競合のため失敗
+    pass
+
+class Entity(dict):
+    # kindとidを持つdict。idがNoneの時はput時に採番される
+    def __init__(self, kind, id=None, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.kind = kind
+        self.id = id
+
+    def __repr__(self):
+        return f'Entity(kind={self.kind!r}, id={self.id!r}, {dict.__repr__(self)})'
+
+class Backend:
+    name = None
+
+    def get(self, kind, id):
+        raise NotImplementedError
+
+    # idsと同じ順序でEntityのリストを返す。存在しないidの位置はNone
+    def get_multi(self, kind, ids):
+        return [self.get(kind, id) for id in ids]
+
+    def put(self, entity):
+        raise NotImplementedError
+
+    def put_multi(self, entities):
+        for entity in entities:
+            self.put(entity)
+        return entities
+
+    def delete(self, kind, id):
+        raise NotImplementedError
+
+    def delete_multi(self, kind, ids):
+        for id in ids:
+            self.delete(kind, id)
+
+    # filters: (プロパティ名, 演算子, 値)のリスト。プロパティ名にKEYを指定するとkey filter
+    # order: プロパティ名のリスト。先頭に'-'を付けると降順。KEYでkey順
+    # keys_only: Trueの時はプロパティを読まずidだけを持つEntityを返す
+    def query(self, kind, filters=(), order=(), limit=None, offset=0,
+              keys_only=False):
+        raise NotImplementedError
+
+    # エンティティを読まずに件数を数える
+    def count(self, kind, filters=()):
+        return len(self.query(kind, filters=filters, keys_only=True))
+
+    # with backend.transaction(): の形で使う。競合時はAbortedを送出する
+    def transaction(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+def create_backend(name, **options):
+    if name == 'datastore':
+        from .database_datastore import DatastoreBackend
+        return DatastoreBackend(**options)
+    if name == 'memory':
+        from .database_memory import MemoryBackend
+        return MemoryBackend(**options)
+    if name == 'sqlite':
+        from .database_sqlite import SQLiteBackend
+        return SQLiteBackend(**options)
+    raise ValueError(f'unknown database backend: {name}')
+
+_backend = None
+_backend_lock = threading.Lock()
+
+def _backend_from_env():
+    name = os.environ.get('SAMPLEAPP_DATABASE_BACKEND', 'datastore')
+    options = {}
+    path = os.environ.get('SAMPLEAPP_DATABASE_PATH')
+    if name == 'sqlite' and path:
+        options['path'] = path
+    return create_backend(name, **options)
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                # アプリのコンテキスト外(seedやテストのfixture)からも使われるので
+                # 設定が無い時は環境変数から作成する
+                _backend = _backend_from_env()
+    return _backend
+
+def set_backend(backend):
+    global _backend
+    with _backend_lock:
+        old = _backend
+        _backend = backend
+    if old is not None and old is not backend:
+        old.close()
+    return backend
+
+def init_app(app):
+    # DATABASE_BACKENDが設定されている時のみ切り替える
+    name = app.config.get('DATABASE_BACKEND')
+    if not name:
+        return
+    current = _backend
+    if current is not None and current.name == name:
+        return
+    options = {}
+    if name == 'sqlite' and app.config.get('DATABASE_PATH'):
+        options['path'] = app.config['DATABASE_PATH']
+    set_backend(create_backend(name, **options))
@@ -0,0 +1,142 @@
+from google.cloud import datastore
+from google.api_core.exceptions import Aborted as DatastoreAborted
+import contextlib
+from .database import Backend, Entity, Aborted, KEY
+from . import clients
+
+# 1回のRPCで読み出せるエンティティ数の上限
+MAX_READ_BATCH = 1000
+# 1回のRPCで書き込み・削除できるエンティティ数の上限
+MAX_WRITE_BATCH = 500
+
+class DatastoreBackend(Backend):
+    name = 'datastore'
+
+    def __init__(self, client=None):
+        self._client = client
+
+    @property
+    def client(self):
+        if self._client is not None:
+            return self._client
+        # workerごとに共有しているクライアントを使う
+        return clients.get('datastore')
+
+    def _to_entity(self, kind, entity):
+        return Entity(kind, entity.key.id_or_name, entity)
+
+    def get(self, kind, id):
+        client = self.client
+        entity = client.get(client.key(kind, id))
+        if entity is None:
+            return None
+        return self._to_entity(kind, entity)
+
+    def get_multi(self, kind, ids):
+        client = self.client
+        ids = list(ids)
+        found = {}
+        for i in range(0, len(ids), MAX_READ_BATCH):
+            keys = [client.key(kind, id) for id in ids[i:i+MAX_READ_BATCH]]
+            # 一度に返せなかったkeyはdeferredに入るので読み終わるまで繰り返す
+            while keys:
+                deferred = []
+                for e in client.get_multi(keys, deferred=deferred):
+                    found[e.key.id_or_name] = self._to_entity(kind, e)
+                keys = deferred
+        # get_multiは順序を保証しないので並べ直す
+        return [found.get(id) for id in ids]
+
+    def _to_datastore_entities(self, entities):
+        client = self.client
+        ds_entities = []
+        allocated = {}
+        if client.current_transaction is not None:
+            # transaction内ではcommitされるまでkeyが確定しないので先に採番する
+            counts = {}
+            for e in entities:
+                if e.id is None:
+                    counts[e.kind] = counts.get(e.kind, 0) + 1
+            for kind, n in counts.items():
+                allocated[kind] = client.allocate_ids(client.key(kind), n)
+        for entity in entities:
+            if entity.id is not None:
+                key = client.key(entity.kind, entity.id)
+            elif allocated.get(entity.kind):
+                key = allocated[entity.kind].pop(0)
+            else:
+                key = client.key(entity.kind)
+            e = datastore.Entity(key)
+            e.update(entity)
+            ds_entities.append(e)
+        return ds_entities
+
+    def put(self, entity):
+        return self.put_multi([entity])[0]
+
+    def put_multi(self, entities):
+        client = self.client
+        for i in range(0, len(entities), MAX_WRITE_BATCH):
+            chunk = entities[i:i+MAX_WRITE_BATCH]
+            ds_entities = self._to_datastore_entities(chunk)
+            client.put_multi(ds_entities)
+            for entity, e in zip(chunk, ds_entities):
+                entity.id = e.key.id_or_name
+        return entities
+
+    def delete(self, kind, id):
+        client = self.client
+        client.delete(client.key(kind, id))
+
+    def delete_multi(self, kind, ids):
+        client = self.client
+        ids = list(ids)
+        for i in range(0, len(ids), MAX_WRITE_BATCH):
+            client.delete_multi([client.key(kind, id)
+                                 for id in ids[i:i+MAX_WRITE_BATCH]])
+
+    def _add_filters(self, query, kind, filters):
+        client = self.client
+        for prop, op, value in filters:
+            if prop == KEY:
+                if op == 'IN':
+                    value = [client.key(kind, v) for v in value]
+                else:
+                    value = client.key(kind, value)
+            query.add_filter(prop, op, value)
+
+    def query(self, kind, filters=(), order=(), limit=None, offset=0,
+              keys_only=False):
+        client = self.client
+        query = client.query(kind=kind)
+        if keys_only:
+            query.keys_only()
+        self._add_filters(query, kind, filters)
+        if order:
+            query.order = list(order)
+        entities = query.fetch(limit=limit, offset=offset)
+        return [self._to_entity(kind, e) for e in entities]
+
+    def count(self, kind, filters=()):
+        # aggregation queryでサーバー側で数える
+        client = self.client
+        query = client.query(kind=kind)
+        self._add_filters(query, kind, filters)
+        total = 0
+        for results in client.aggregation_query(query).count().fetch():
+            for result in results:
+                total += result.value
+        return total
+
+    @contextlib.contextmanager
+    def transaction(self):
+        client = self.client
+        if client.current_transaction is not None:
+            # 入れ子のtransactionは外側のtransactionに含める
+            yield
+            return
+        try:
+            with client.transaction():
+                yield
+        except DatastoreAborted as e:
+            raise Aborted(str(e)) from e
@@ -0,0 +1,180 @@
+import contextlib
+import copy
+import itertools
+import operator
+import threading
+from .database import Backend, Entity, KEY
+
+_OPERATORS = {
+    '=': operator.eq,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    'IN': lambda v, values: v in values,
+}
+
+# 型の異なる値同士でも並べ替えられるようにする
+def _sort_value(v):
+    if v is None:
+        return (0, 0)
+    if isinstance(v, bool):
+        return (1, v)
+    if isinstance(v, (int, float)):
+        return (2, v)
+    if isinstance(v, str):
+        return (3, v)
+    return (4, v)
+
+def _hashable(v):
+    try:
+        hash(v)
+    except TypeError:
+        return False
+    return True
+
+class MemoryBackend(Backend):
+    name = 'memory'
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._kinds = {}
+        # (kind, プロパティ名) -> {値: idのset}。等価filterで初めて使われた時に作成する
+        self._indexes = {}
+        self._ids = itertools.count(1)
+        self._undo = None
+
+    def _store(self, kind, id, props):
+        entities = self._kinds.setdefault(kind, {})
+        old = entities.get(id)
+        for (k, prop), index in self._indexes.items():
+            if k != kind:
+                continue
+            if old is not None and _hashable(v := old.get(prop)):
+                ids = index.get(v)
+                if ids is not None:
+                    ids.discard(id)
+                    if not ids:
+                        del index[v]
+            if props is not None and prop in props and _hashable(v := props[prop]):
+                index.setdefault(v, set()).add(id)
+        if props is None:
+            entities.pop(id, None)
+        else:
+            entities[id] = props
+        if self._undo is not None:
+            self._undo.append((kind, id, old))
+
+    def _index(self, kind, prop):
+        index = self._indexes.get((kind, prop))
+        if index is None:
+            index = {}
+            for id, props in self._kinds.get(kind, {}).items():
+                if prop in props and _hashable(v := props[prop]):
+                    index.setdefault(v, set()).add(id)
+            self._indexes[(kind, prop)] = index
+        return index
+
+    def get(self, kind, id):
+        with self._lock:
+            props = self._kinds.get(kind, {}).get(id)
+            if props is None:
+                return None
+            return Entity(kind, id, copy.deepcopy(props))
+
+    def get_multi(self, kind, ids):
+        with self._lock:
+            return [self.get(kind, id) for id in ids]
+
+    def put(self, entity):
+        with self._lock:
+            if entity.id is None:
+                entity.id = next(self._ids)
+            self._store(entity.kind, entity.id, copy.deepcopy(dict(entity)))
+        return entity
+
+    def put_multi(self, entities):
+        with self._lock:
+            for entity in entities:
+                self.put(entity)
+        return entities
+
+    def delete(self, kind, id):
+        with self._lock:
+            if id in self._kinds.get(kind, {}):
+                self._store(kind, id, None)
+
+    def delete_multi(self, kind, ids):
+        with self._lock:
+            for id in ids:
+                self.delete(kind, id)
+
+    def _match(self, id, props, filters):
+        for prop, op, value in filters:
+            if prop == KEY:
+                v = id
+            elif prop in props:
+                v = props[prop]
+            else:
+                return False
+            try:
+                if not _OPERATORS[op](v, value):
+                    return False
+            except TypeError:
+                return False
+        return True
+
+    def query(self, kind, filters=(), order=(), limit=None, offset=0,
+              keys_only=False):
+        with self._lock:
+            entities = self._kinds.get(kind, {})
+            candidates = None
+            for prop, op, value in filters:
+                if op == '=' and prop != KEY and _hashable(value):
+                    candidates = self._index(kind, prop).get(value, ())
+                    break
+                if op == 'IN' and prop != KEY and all(map(_hashable, value)):
+                    index = self._index(kind, prop)
+                    candidates = set().union(*(index.get(v, ()) for v in value))
+                    break
+            if candidates is None:
+                candidates = entities.keys()
+            results = [(id, entities[id]) for id in candidates
+                       if self._match(id, entities[id], filters)]
+
+            # key順に並べたあと指定された順序で安定ソートする
+            results.sort(key=lambda x: _sort_value(x[0]))
+            for o in reversed(order):
+                reverse = o.startswith('-')
+                prop = o.lstrip('-')
+                if prop == KEY:
+                    results.sort(key=lambda x: _sort_value(x[0]), reverse=reverse)
+                else:
+                    results.sort(key=lambda x: _sort_value(x[1].get(prop)),
+                                 reverse=reverse)
+
+            results = results[offset:]
+            if limit is not None:
+                results = results[:limit]
+            if keys_only:
+                return [Entity(kind, id) for id, _ in results]
+            return [Entity(kind, id, copy.deepcopy(props)) for id, props in results]
+
+    @contextlib.contextmanager
+    def transaction(self):
+        with self._lock:
+            if self._undo is not None:
+                # 入れ子のtransactionは外側のtransactionに含める
+                yield
+                return
+            self._undo = []
+            try:
+                yield
+            except BaseException:
+                # 変更を元に戻す
+                undo, self._undo = self._undo, None
+                for kind, id, old in reversed(undo):
+                    self._store(kind, id, old)
+                raise
+            finally:
+                self._undo = None
@@ -0,0 +1,237 @@
+import base64
+import contextlib
+import json
+import sqlite3
+import threading
+from datetime import datetime, timezone
+from .database import Backend, Entity, KEY, OPERATORS
+
+# エンティティはkindごとのテーブルにJSONで保存する
+#   CREATE TABLE "<kind>" (id PRIMARY KEY, data TEXT)
+# filter, orderに使われたプロパティにはjson_extractの式indexを張る
+# JSONで表現できない型は__types__に型名を記録して復元する
+
+_TYPES = '__types__'
+_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f+00:00'
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+def _encode_value(v):
+    if isinstance(v, datetime):
+        if v.tzinfo is None:
+            v = v.replace(tzinfo=timezone.utc)
+        # 文字列の大小と時刻の前後が一致するようにUTCの固定長で保存する
+        return 'datetime', v.astimezone(timezone.utc).strftime(_DATETIME_FORMAT)
+    if isinstance(v, bytes):
+        return 'bytes', base64.b64encode(v).decode('ascii')
+    return None, v
+
+def _decode_value(t, v):
+    if v is None:
+        return None
+    if t == 'datetime':
+        return datetime.strptime(v, _DATETIME_FORMAT).replace(tzinfo=timezone.utc)
+    if t == 'bytes':
+        return base64.b64decode(v)
+    return v
+
+def _encode(props):
+    data = {}
+    types = {}
+    for k, v in props.items():
+        t, data[k] = _encode_value(v)
+        if t:
+            types[k] = t
+    if types:
+        data[_TYPES] = types
+    return json.dumps(data, ensure_ascii=False)
+
+def _decode(text):
+    data = json.loads(text)
+    types = data.pop(_TYPES, {})
+    return {k: _decode_value(types.get(k), v) for k, v in data.items()}
+
+def _sql_value(v):
+    # json_extractの戻り値と比較できる値に変換する
+    _, v = _encode_value(v)
+    if isinstance(v, bool):
+        return int(v)
+    return v
+
+class SQLiteBackend(Backend):
+    name = 'sqlite'
+
+    def __init__(self, path=':memory:'):
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, isolation_level=None,
+                                     check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS _sequences '
+            '(kind TEXT PRIMARY KEY, next_id INTEGER NOT NULL)')
+        self._tables = set()
+        self._indexes = set()
+        self._in_transaction = False
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _table(self, kind):
+        if kind not in self._tables:
+            self._conn.execute(
+                f'CREATE TABLE IF NOT EXISTS {_quote(kind)} '
+                '(id PRIMARY KEY, data TEXT NOT NULL)')
+            self._tables.add(kind)
+        return _quote(kind)
+
+    def _column(self, kind, prop):
+        if prop == KEY:
+            return 'id'
+        expr = f"json_extract(data, '$.{_quote(prop)}')"
+        if (kind, prop) not in self._indexes:
+            name = _quote(f'{kind}__{prop}')
+            self._conn.execute(
+                f'CREATE INDEX IF NOT EXISTS {name} ON {_quote(kind)}({expr})')
+            self._indexes.add((kind, prop))
+        return expr
+
+    def _allocate_id(self, kind):
+        row = self._conn.execute(
+            'SELECT next_id FROM _sequences WHERE kind=?', (kind,)).fetchone()
+        if row is None:
+            table = self._table(kind)
+            row = self._conn.execute(
+                f"SELECT MAX(id) FROM {table} WHERE typeof(id)='integer'").fetchone()
+            id = (row[0] or 0) + 1
+            self._conn.execute('INSERT INTO _sequences VALUES (?, ?)',
+                               (kind, id + 1))
+        else:
+            id = row[0]
+            self._conn.execute('UPDATE _sequences SET next_id=? WHERE kind=?',
+                               (id + 1, kind))
+        return id
+
+    def get(self, kind, id):
+        with self._lock:
+            table = self._table(kind)
+            row = self._conn.execute(
+                f'SELECT data FROM {table} WHERE id=?', (id,)).fetchone()
+        if row is None:
+            return None
+        return Entity(kind, id, _decode(row[0]))
+
+    def get_multi(self, kind, ids):
+        ids = list(ids)
+        found = {}
+        with self._lock:
+            table = self._table(kind)
+            # SQLiteの変数の上限を超えないよう分割する
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i+500]
+                marks = ', '.join('?' * len(chunk))
+                rows = self._conn.execute(
+                    f'SELECT id, data FROM {table} WHERE id IN ({marks})',
+                    chunk).fetchall()
+                for id, data in rows:
+                    found[id] = data
+        return [Entity(kind, id, _decode(found[id])) if id in found else None
+                for id in ids]
+
+    def put(self, entity):
+        return self.put_multi([entity])[0]
+
+    def put_multi(self, entities):
+        with self.transaction():
+            for entity in entities:
+                table = self._table(entity.kind)
+                if entity.id is None:
+                    entity.id = self._allocate_id(entity.kind)
+                self._conn.execute(
+                    f'INSERT OR REPLACE INTO {table} (id, data) VALUES (?, ?)',
+                    (entity.id, _encode(entity)))
+        return entities
+
+    def delete(self, kind, id):
+        self.delete_multi(kind, [id])
+
+    def delete_multi(self, kind, ids):
+        with self.transaction():
+            table = self._table(kind)
+            self._conn.executemany(f'DELETE FROM {table} WHERE id=?',
+                                   [(id,) for id in ids])
+
+    def _where(self, kind, filters):
+        where = []
+        params = []
+        for prop, op, value in filters:
+            if op not in OPERATORS:
+                raise ValueError(f'unsupported operator: {op}')
+            column = self._column(kind, prop)
+            if op == 'IN':
+                marks = ', '.join('?' * len(value))
+                where.append(f'{column} IN ({marks})')
+                params += [v if prop == KEY else _sql_value(v) for v in value]
+            elif value is None and op == '=':
+                where.append(f'{column} IS NULL')
+            else:
+                where.append(f'{column} {op} ?')
+                params.append(value if prop == KEY else _sql_value(value))
+        return where, params
+
+    def query(self, kind, filters=(), order=(), limit=None, offset=0,
+              keys_only=False):
+        with self._lock:
+            table = self._table(kind)
+            where, params = self._where(kind, filters)
+            columns = 'id' if keys_only else 'id, data'
+            sql = f'SELECT {columns} FROM {table}'
+            if where:
+                sql += ' WHERE ' + ' AND '.join(where)
+            orders = []
+            for o in order:
+                direction = 'DESC' if o.startswith('-') else 'ASC'
+                orders.append(f'{self._column(kind, o.lstrip("-"))} {direction}')
+            orders.append('id ASC')
+            sql += ' ORDER BY ' + ', '.join(orders)
+            if limit is not None or offset:
+                sql += ' LIMIT ? OFFSET ?'
+                params += [-1 if limit is None else limit, offset]
+            rows = self._conn.execute(sql, params).fetchall()
+        if keys_only:
+            return [Entity(kind, row[0]) for row in rows]
+        return [Entity(kind, id, _decode(data)) for id, data in rows]
+
+    def count(self, kind, filters=()):
+        with self._lock:
+            table = self._table(kind)
+            where, params = self._where(kind, filters)
+            sql = f'SELECT COUNT(*) FROM {table}'
+            if where:
+                sql += ' WHERE ' + ' AND '.join(where)
+            return self._conn.execute(sql, params).fetchone()[0]
+
+    @contextlib.contextmanager
+    def transaction(self):
+        with self._lock:
+            if self._in_transaction:
+                # 入れ子のtransactionは外側のtransactionに含める
+                yield
+                return
+            self._conn.execute('BEGIN IMMEDIATE')
+            self._in_transaction = True
+            try:
+                yield
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                # transaction内で作成したテーブルやindexも取り消されるので作り直させる
+                self._tables.clear()
+                self._indexes.clear()
+                raise
+            else:
+                self._conn.execute('COMMIT')
+            finally:
+                self._in_transaction = False
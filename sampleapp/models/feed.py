@@ -0,0 +1,119 @@
+import heapq
+import itertools
+import os
+from . import database
+from . import keyset
+from . import micropost as mpost
+from . import relationship
+from .timeline import Timeline
+
+# feedをカーソルで1ページずつ読み出す
+# 読み出し方は2通り
+#   timeline: micropost投稿時に作成したタイムラインを読む(fan-out on write)
+#   merge:    自分とフォローしている人のmicropostをそれぞれ新しい順に必要な分だけ読み、
+#             heapでマージする(fan-in)。1ページの読み出しは
+#             O(ページサイズ × フォロー数)で、全micropostを読むことはない
+# どちらもmicropostは(created_at, key)の降順に並ぶ。カーソルはこの位置を表す(keyset参照)
+
+TIMELINE = 'timeline'
+MERGE = 'merge'
+
+# feedは新しい順に並ぶので次のページは古い方になる
+OLDER = keyset.NEXT
+NEWER = keyset.PREV
+
+Cursor = keyset.Cursor
+# next_cursorは古い方、prev_cursorは新しい方のページ
+FeedPage = keyset.Page
+
+_strategy = os.environ.get('SAMPLEAPP_FEED_STRATEGY', TIMELINE)
+
+def init_app(app):
+    strategy = app.config.get('FEED_STRATEGY')
+    if strategy:
+        set_strategy(strategy)
+
+def set_strategy(strategy):
+    global _strategy
+    if strategy not in (TIMELINE, MERGE):
+        raise ValueError(f'unknown feed strategy: {strategy}')
+    _strategy = strategy
+
+def get_strategy():
+    return _strategy
+
+# 1つの並び(あるユーザーのmicropost、あるユーザーのタイムライン)を
+# カーソルの位置から順に少しずつ読み出す
+class _Stream:
+    kind = None
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+
+    def _filters(self):
+        return [('user_id', '=', self.user_id)]
+
+    def _tie(self, micropost_id):
+        return micropost_id
+
+    def _micropost_id(self, entity):
+        return entity.id
+
+    def items(self, cursor, batch):
+        newer = cursor is not None and cursor.direction == NEWER
+        position = None
+        if cursor is not None:
+            position = (cursor.created_at, self._tie(cursor.id))
+        for e in keyset.scan(self.kind, self._filters(), position,
+                             ascending=newer, batch=batch):
+            yield (e['created_at'], e.id), self._micropost_id(e), e
+
+class _MicropostStream(_Stream):
+    kind = mpost.Micropost.KIND_MICROPOSTS
+
+class _TimelineStream(_Stream):
+    kind = Timeline.KIND_TIMELINES
+
+    def _tie(self, micropost_id):
+        return Timeline._entry_id(self.user_id, micropost_id)
+
+    def _micropost_id(self, entity):
+        return entity['micropost_id']
+
+def _streams(user_id):
+    if _strategy == TIMELINE:
+        return [_TimelineStream(user_id)]
+    rs = relationship.Relationship.find_by(follower_id=user_id)
+    user_ids = [user_id] + sorted({r.followed_id for r in rs})
+    return [_MicropostStream(id) for id in user_ids]
+
+def page(user_id, limit=None, cursor=None):
+    if isinstance(cursor, str):
+        cursor = Cursor.decode(cursor)
+    newer = cursor is not None and cursor.direction == NEWER
+    # 次のページがあるかを知るために1つ多く読む
+    batch = limit + 1 if limit is not None else 100
+    streams = _streams(user_id)
+    iterators = [s.items(cursor, batch) for s in streams]
+    # 複数のstreamの時はkeyがmicropost idなので全体で順序が揃う
+    merged = heapq.merge(*iterators, key=lambda x: x[0], reverse=not newer)
+    if limit is not None:
+        merged = itertools.islice(merged, limit + 1)
+    items = list(merged)
+    has_more = limit is not None and len(items) > limit
+    if has_more:
+        items = items[:limit]
+    # カーソルは(created_at, micropost id)で表す
+    result = keyset.make_page(items, cursor, has_more,
+                              key=lambda x: (x[0][0], x[1]))
+
+    if _strategy == TIMELINE:
+        ids = [micropost_id for _, micropost_id, _ in result]
+        backend = database.get_backend()
+        entities = backend.get_multi(mpost.Micropost.KIND_MICROPOSTS, ids)
+    else:
+        entities = [e for _, _, e in result]
+    # 削除と読み出しが競合した場合は存在しないmicropostを飛ばす
+    microposts = [mpost.Micropost(id=e.id, **e) for e in entities if e is not None]
+    return FeedPage(microposts, next_cursor=result.next_cursor,
+                    prev_cursor=result.prev_cursor)
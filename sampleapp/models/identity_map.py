@@ -0,0 +1,91 @@
+from flask import g, has_app_context
+from . import database
+
+# リクエストの間に読み出したエンティティをgに保存しておき、同じエンティティを
+# 何度もデータストアから読まないようにする(identity map)
+# キーは(kind, id)。存在しなかったこと(None)も保存する
+# モデルを通した書き込みではinvalidateで該当するエンティティを取り除く
+# リクエストの外(スクリプトなど)では何もせずにそのままバックエンドから読む
+
+class _IdentityMap:
+    def __init__(self):
+        self.entities = {}
+        # (kind, filterのtuple) -> エンティティのリスト
+        self.queries = {}
+        self.reads = 0
+        self.hits = 0
+
+def _map():
+    if not has_app_context():
+        return None
+    m = getattr(g, '_identity_map', None)
+    if m is None:
+        m = g._identity_map = _IdentityMap()
+    return m
+
+def get(kind, id):
+    backend = database.get_backend()
+    m = _map()
+    if m is None:
+        return backend.get(kind, id)
+    key = (kind, id)
+    if key in m.entities:
+        m.hits += 1
+        return m.entities[key]
+    entity = backend.get(kind, id)
+    m.reads += 1
+    m.entities[key] = entity
+    return entity
+
+def get_multi(kind, ids):
+    backend = database.get_backend()
+    m = _map()
+    if m is None:
+        return backend.get_multi(kind, ids)
+    missing = [id for id in dict.fromkeys(ids) if (kind, id) not in m.entities]
+    m.hits += len(ids) - len(missing)
+    if missing:
+        entities = backend.get_multi(kind, missing)
+        m.reads += 1
+        for id, entity in zip(missing, entities):
+            m.entities[(kind, id)] = entity
+    return [m.entities[(kind, id)] for id in ids]
+
+# 等価filterのクエリの結果を保存する
+def query(kind, filters):
+    backend = database.get_backend()
+    m = _map()
+    if m is None:
+        return backend.query(kind, filters=filters)
+    key = (kind, tuple(filters))
+    if key in m.queries:
+        m.hits += 1
+        return m.queries[key]
+    entities = backend.query(kind, filters=filters)
+    m.reads += 1
+    m.queries[key] = entities
+    return entities
+
+# 書き込んだエンティティと、同じkindのクエリの結果を取り除く
+def invalidate(kind, id=None):
+    m = _map()
+    if m is None:
+        return
+    if id is not None:
+        m.entities.pop((kind, id), None)
+    for key in [k for k in m.queries if k[0] == kind]:
+        del m.queries[key]
+
+def stats():
+    m = _map()
+    if m is None:
+        return {'reads': 0, 'hits': 0}
+    return {'reads': m.reads, 'hits': m.hits}
+
+def init_app(app):
+    @app.teardown_appcontext
+    def log_identity_map_stats(exception=None):
+        m = getattr(g, '_identity_map', None)
+        if m is not None and app.debug:
+            app.logger.debug(f'identity map: {m.reads} reads, '
+                             f'{m.hits} reads saved')
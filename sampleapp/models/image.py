@@ -1,8 +1,15 @@
 from .errors import Errors
-from google.cloud import datastore
+from . import database
+from . import identity_map
+from .counter import Counter
 from datetime import datetime, timezone
 import copy
 
+# 画像は内容のSHA-256をidとして1つだけ保存し、参照しているmicropostの数を
+# ref_countで数える(content-addressed)。同じ画像が何度投稿されてもblobは1つで、
+# 最後のmicropostが削除された時にblobを削除する
+# micropost_id, file_nameを持つものは重複排除を導入する前にmicropostごとに
+# 作成していたもの
 class Image:
     KIND_IMAGES = 'images'
 
@@ -10,6 +17,12 @@ class Image:
         self.id = kwargs.get('id')
         self.micropost_id = kwargs.get('micropost_id')
         self.file_name = kwargs.get('file_name')
+        self.blob_name = kwargs.get('blob_name')
+        self.content_type = kwargs.get('content_type')
+        self.size = kwargs.get('size')
+        self.ref_count = kwargs.get('ref_count', 0)
+        self.ready = kwargs.get('ready', False)
+        self.variants = kwargs.get('variants') or {}
         self.created_at = kwargs.get('created_at')
         self.updated_at = kwargs.get('updated_at')
         self.errors = Errors()
@@ -44,15 +57,13 @@ class Image:
 
 
     def _insert_or_update(self):
-        client = datastore.Client()
+        backend = database.get_backend()
         if self.id:
             # update
-            key = client.key(Image.KIND_IMAGES, self.id)
-            image = client.get(key)
+            image = backend.get(Image.KIND_IMAGES, self.id)
         else:
             # insert
-            key = client.key(Image.KIND_IMAGES)
-            image = datastore.Entity(key)
+            image = database.Entity(Image.KIND_IMAGES)
 
         image['micropost_id'] = self.micropost_id
         image['file_name'] = self.file_name
@@ -62,8 +73,16 @@ class Image:
             image['created_at'] = t
         image['updated_at'] = t
 
-        client.put(image)
-        self.id = image.key.id
+        try:
+            with backend.transaction():
+                backend.put(image)
+                identity_map.invalidate(Image.KIND_IMAGES, image.id)
+                if not self.id:
+                    Counter.increment(Counter.kind_name(Image.KIND_IMAGES))
+        except database.Aborted:
+            # transaction競合のため失敗
+            return False
+        self.id = image.id
         self.created_at = image['created_at']
         self.updated_at = image['updated_at']
         return True
@@ -80,36 +99,116 @@ class Image:
         return image
 
     def destroy(self):
-        client = datastore.Client()
-        key = client.key(Image.KIND_IMAGES, self.id)
-        client.delete(key)
+        backend = database.get_backend()
+        with backend.transaction():
+            # 既に削除されていたらカウンタを減らさない
+            if backend.get(Image.KIND_IMAGES, self.id) is None:
+                return
+            backend.delete(Image.KIND_IMAGES, self.id)
+            identity_map.invalidate(Image.KIND_IMAGES, self.id)
+            Counter.increment(Counter.kind_name(Image.KIND_IMAGES), -1)
+
+    # 内容がsha256の画像への参照を1つ増やす。無ければ作成する
+    # (Image, アップロードが必要か)を返す
+    @staticmethod
+    def acquire(sha256, blob_name, content_type, size):
+        backend = database.get_backend()
+        with backend.transaction():
+            image = backend.get(Image.KIND_IMAGES, sha256)
+            upload = image is None or image.get('failed', False)
+            t = datetime.now(timezone.utc)
+            if image is None:
+                image = database.Entity(Image.KIND_IMAGES, sha256)
+                image['blob_name'] = blob_name
+                image['content_type'] = content_type
+                image['size'] = size
+                image['ref_count'] = 0
+                image['variants'] = {}
+                image['created_at'] = t
+                Counter.increment(Counter.kind_name(Image.KIND_IMAGES))
+            if upload:
+                # 前回のアップロードが失敗していた時は送り直す
+                image['ready'] = False
+                image['failed'] = False
+            image['ref_count'] += 1
+            image['updated_at'] = t
+            backend.put(image)
+            identity_map.invalidate(Image.KIND_IMAGES, sha256)
+        return Image(id=image.id, **image), upload
+
+    # 参照を1つ減らす。最後の参照だった時は削除すべきblob名のリストを返す
+    # blob_nameが異なる時は別の画像なので何もしない
+    @staticmethod
+    def release(sha256, blob_name):
+        backend = database.get_backend()
+        with backend.transaction():
+            image = backend.get(Image.KIND_IMAGES, sha256)
+            if image is None or image['blob_name'] != blob_name:
+                return []
+            image['ref_count'] -= 1
+            identity_map.invalidate(Image.KIND_IMAGES, sha256)
+            if 0 < image['ref_count']:
+                image['updated_at'] = datetime.now(timezone.utc)
+                backend.put(image)
+                return []
+            backend.delete(Image.KIND_IMAGES, sha256)
+            Counter.increment(Counter.kind_name(Image.KIND_IMAGES), -1)
+        return [image['blob_name']] + list((image.get('variants') or {}).values())
+
+    # アップロードの結果や縮小版を記録する。画像が無ければNoneを返す
+    @staticmethod
+    def update_record(sha256, ready=None, variants=None):
+        backend = database.get_backend()
+        with backend.transaction():
+            image = backend.get(Image.KIND_IMAGES, sha256)
+            if image is None:
+                return None
+            if ready is not None:
+                image['ready'] = ready
+                image['failed'] = not ready
+            if variants:
+                image['variants'] = dict(image.get('variants') or {}, **variants)
+            image['updated_at'] = datetime.now(timezone.utc)
+            backend.put(image)
+            identity_map.invalidate(Image.KIND_IMAGES, sha256)
+        return Image(id=image.id, **image)
+
+    @staticmethod
+    def find(id):
+        if id is None:
+            return None
+        entity = identity_map.get(Image.KIND_IMAGES, id)
+        if entity is None:
+            return None
+        return Image(id=entity.id, **entity)
 
     @staticmethod
     def find_by(**kwargs):
         if not kwargs:
             return []
-        client = datastore.Client()
-        query = client.query(kind=Image.KIND_IMAGES)
+        filters = []
         for k,v in kwargs.items():
             if k=='id':
-                key = client.key(Image.KIND_IMAGES, v)
-                query.key_filter(key, '=')
+                filters.append((database.KEY, '=', v))
             else:
-                query.add_filter(k, '=', v)
-        entities = list(query.fetch())
-        images = [Image(id=entity.key.id, **entity) for entity in entities]
+                filters.append((k, '=', v))
+        # 同じリクエスト内で同じ条件で読み出し済みならデータストアを読まない
+        entities = identity_map.query(Image.KIND_IMAGES, filters)
+        images = [Image(id=entity.id, **entity) for entity in entities]
         images.sort(key=lambda x: x.created_at, reverse=True)
         return images
 
     @staticmethod
     def all():
-        client = datastore.Client()
-        query = client.query(kind=Image.KIND_IMAGES)
-        query.order = ['-created_at']
-        entities = list(query.fetch())
-        images = [Image(id=entity.key.id, **entity) for entity in entities]
+        backend = database.get_backend()
+        entities = backend.query(Image.KIND_IMAGES, order=['-created_at'])
+        images = [Image(id=entity.id, **entity) for entity in entities]
         return images
 
+    # exact=Falseの時はプロセス内に一定時間キャッシュした値を返す
     @staticmethod
-    def count():
-        return len(Image.all())
+    def count(exact=True):
+        name = Counter.kind_name(Image.KIND_IMAGES)
+        if exact:
+            return Counter.get(name)
+        return Counter.get_cached(name)
@@ -0,0 +1,381 @@
+import hashlib
+import hmac
+import io
+import mimetypes
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from urllib.parse import quote, urlencode
+from flask import current_app, has_app_context
+from . import clients
+
+# micropostの画像を保存するストレージ
+# workerごとに1つ作成し、クライアントとバケットのハンドルを使い回す
+# 操作ごとの回数と所要時間をstats()で確認できる
+# ストレージは設定IMAGE_STORAGE(環境変数SAMPLEAPP_IMAGE_STORAGE)で選ぶ
+#   gcs:   Cloud Storage (本番用)。バケットはBUCKET_IMAGES
+#   local: ローカルのファイルシステム。IMAGE_STORAGE_PATHに保存し、
+#          images_controllerが配信する(オンプレミスや負荷試験用)
+# ブラウザから画像を直接アップロードできるよう、期限付きの署名付きURLを発行する
+# (signed_upload)。localではimages_controllerがHMACで署名を確かめて受け取る
+
+# Cloud Storageの公開URL
+STORAGE_URL = 'https://storage.googleapis.com'
+
+class _Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ops = {}
+
+    def record(self, op, seconds):
+        with self._lock:
+            m = self._ops.setdefault(op, {'count': 0, 'total': 0.0, 'max': 0.0})
+            m['count'] += 1
+            m['total'] += seconds
+            m['max'] = max(m['max'], seconds)
+
+    def snapshot(self):
+        with self._lock:
+            return {op: dict(m, avg=m['total'] / m['count'])
+                    for op, m in self._ops.items()}
+
+class ImageStorage:
+    name = None
+
+    def __init__(self):
+        self.metrics = _Metrics()
+
+    def _timed(self, op, f, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            self.metrics.record(op, time.perf_counter() - start)
+
+    def put(self, blob_name, file, content_type):
+        return self._timed('put', self._put, blob_name, file, content_type)
+
+    def get(self, blob_name):
+        return self._timed('get', self._get, blob_name)
+
+    # blobを読み出すファイルオブジェクト。全体をメモリに読まずに少しずつ読める
+    def open(self, blob_name):
+        return self._timed('open', self._open, blob_name)
+
+    # prefixで始まるblobの(blob名, 更新日時)を返す
+    def list(self, prefix):
+        return self._timed('list', lambda: list(self._list(prefix)))
+
+    def delete(self, blob_name):
+        self.delete_multi([blob_name])
+
+    # blobのサイズとContent-Type。blobが無ければNone
+    def stat(self, blob_name):
+        return self._timed('stat', self._stat, blob_name)
+
+    # ストレージ内でblobをコピーする。内容はアプリを経由しない
+    def copy(self, src_blob_name, dst_blob_name):
+        return self._timed('copy', self._copy, src_blob_name, dst_blob_name)
+
+    # ブラウザがblob_nameに直接アップロードするための署名付きURL
+    # {'url': URL, 'method': 'PUT', 'headers': {送るべきヘッダー}}を返す
+    # max_sizeより大きいものはストレージが受け付けない
+    def signed_upload(self, blob_name, content_type, max_size, expires_in=600):
+        return self._timed('sign', self._signed_upload, blob_name,
+                           content_type, max_size, expires_in)
+
+    def delete_multi(self, blob_names):
+        blob_names = list(blob_names)
+        if blob_names:
+            self._timed('delete', self._delete_multi, blob_names)
+
+    # 公開URL。ストレージへの問い合わせはしない
+    def url(self, blob_name):
+        raise NotImplementedError
+
+    def stats(self):
+        return self.metrics.snapshot()
+
+    def _put(self, blob_name, file, content_type):
+        raise NotImplementedError
+
+    # blobの内容をバイト列で返す
+    def _get(self, blob_name):
+        raise NotImplementedError
+
+    def _open(self, blob_name):
+        return io.BytesIO(self._get(blob_name))
+
+    # 存在しないblobは無視する
+    def _delete_multi(self, blob_names):
+        raise NotImplementedError
+
+    def _list(self, prefix):
+        raise NotImplementedError
+
+    def _stat(self, blob_name):
+        raise NotImplementedError
+
+    def _copy(self, src_blob_name, dst_blob_name):
+        raise NotImplementedError
+
+    def _signed_upload(self, blob_name, content_type, max_size, expires_in):
+        raise NotImplementedError
+
+class CloudStorage(ImageStorage):
+    name = 'gcs'
+    # 1回のbatchに含められるリクエスト数の上限
+    MAX_BATCH = 100
+    # blob名は内容のSHA-256から作るので内容が変わることはなく、長期間キャッシュできる
+    CACHE_CONTROL = 'public, max-age=31536000, immutable'
+    # chunk_sizeを指定するとresumable uploadになり、途中で失敗しても
+    # 最初から送り直さずに済む。256KBの倍数にすること
+    CHUNK_SIZE = 8 * 1024 * 1024
+    # openで1回に読むサイズ
+    READ_CHUNK_SIZE = 256 * 1024
+
+    def __init__(self, bucket_name, client=None):
+        super().__init__()
+        self.bucket_name = bucket_name
+        self._client = client
+        self._bucket = None
+
+    @property
+    def client(self):
+        if self._client is not None:
+            return self._client
+        # workerごとに共有しているクライアントを使う
+        return clients.get('storage')
+
+    @property
+    def bucket(self):
+        client = self.client
+        # client.bucketはRPCを行わない(get_bucketはメタデータを読む)
+        # fork後にクライアントが作り直されたらハンドルも作り直す
+        if self._bucket is None or self._bucket.client is not client:
+            self._bucket = client.bucket(self.bucket_name)
+        return self._bucket
+
+    def _put(self, blob_name, file, content_type):
+        blob = self.bucket.blob(blob_name, chunk_size=CloudStorage.CHUNK_SIZE)
+        blob.cache_control = CloudStorage.CACHE_CONTROL
+        blob.upload_from_file(file, content_type=content_type)
+
+    def _get(self, blob_name):
+        return self.bucket.blob(blob_name).download_as_bytes()
+
+    def _open(self, blob_name):
+        return self.bucket.blob(blob_name).open(
+            'rb', chunk_size=CloudStorage.READ_CHUNK_SIZE)
+
+    def _list(self, prefix):
+        for blob in self.client.list_blobs(self.bucket, prefix=prefix):
+            yield blob.name, blob.updated
+
+    def _delete_multi(self, blob_names):
+        from google.api_core.exceptions import NotFound
+        client = self.client
+        bucket = self.bucket
+        for i in range(0, len(blob_names), CloudStorage.MAX_BATCH):
+            try:
+                with client.batch():
+                    for blob_name in blob_names[i:i+CloudStorage.MAX_BATCH]:
+                        bucket.delete_blob(blob_name)
+            except NotFound:
+                pass
+
+    def _stat(self, blob_name):
+        # get_blobはメタデータだけを読む
+        blob = self.bucket.get_blob(blob_name)
+        if blob is None:
+            return None
+        return {'size': blob.size, 'content_type': blob.content_type}
+
+    def _copy(self, src_blob_name, dst_blob_name):
+        bucket = self.bucket
+        # rewriteはストレージ内で行われるのでアプリは内容を転送しない
+        blob = bucket.copy_blob(bucket.blob(src_blob_name), bucket, dst_blob_name)
+        blob.cache_control = CloudStorage.CACHE_CONTROL
+        blob.patch()
+
+    def _signed_upload(self, blob_name, content_type, max_size, expires_in):
+        # V4署名。署名には秘密鍵を持つサービスアカウントの認証情報が必要
+        # ブラウザから送れるようバケットにCORSを設定しておくこと
+        # x-goog-content-length-rangeを署名に含めてサイズの上限を守らせる
+        length_range = {'x-goog-content-length-range': f'0,{max_size}'}
+        url = self.bucket.blob(blob_name).generate_signed_url(
+            version='v4', expiration=timedelta(seconds=expires_in),
+            method='PUT', content_type=content_type, headers=length_range)
+        headers = dict(length_range, **{'Content-Type': content_type})
+        return {'url': url, 'method': 'PUT', 'headers': headers}
+
+    def url(self, blob_name):
+        return f'{STORAGE_URL}/{self.bucket_name}/{quote(blob_name)}'
+
+class LocalStorage(ImageStorage):
+    name = 'local'
+
+    def __init__(self, root, url_prefix='/images', secret_key=None):
+        super().__init__()
+        self.root = os.path.abspath(root)
+        self.url_prefix = url_prefix
+        # 署名付きURLの署名に使う鍵。アプリのSECRET_KEY
+        self.secret_key = secret_key
+
+    # blob名からファイルのパスを求める。root外を指すものはNone
+    def path(self, blob_name):
+        path = os.path.normpath(os.path.join(self.root, blob_name))
+        if os.path.commonpath([self.root, path]) != self.root or path == self.root:
+            return None
+        return path
+
+    def _put(self, blob_name, file, content_type):
+        path = self.path(blob_name)
+        if path is None:
+            raise ValueError(f'invalid blob name: {blob_name}')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 書き込み途中のファイルを配信しないよう一時ファイルに書いてから置き換える
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                shutil.copyfileobj(file, f)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def _get(self, blob_name):
+        with self._open(blob_name) as f:
+            return f.read()
+
+    def _open(self, blob_name):
+        path = self.path(blob_name)
+        if path is None:
+            raise FileNotFoundError(blob_name)
+        return open(path, 'rb')
+
+    def _list(self, prefix):
+        top = self.path(prefix)
+        if top is None or not os.path.isdir(top):
+            return
+        for dirpath, _, filenames in os.walk(top):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                mtime = os.path.getmtime(path)
+                yield (os.path.relpath(path, self.root).replace(os.sep, '/'),
+                       datetime.fromtimestamp(mtime, timezone.utc))
+
+    def _delete_multi(self, blob_names):
+        for blob_name in blob_names:
+            path = self.path(blob_name)
+            if path is None:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _stat(self, blob_name):
+        path = self.path(blob_name)
+        if path is None or not os.path.isfile(path):
+            return None
+        content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        return {'size': os.path.getsize(path), 'content_type': content_type}
+
+    def _copy(self, src_blob_name, dst_blob_name):
+        path = self.path(src_blob_name)
+        if path is None:
+            raise FileNotFoundError(src_blob_name)
+        with open(path, 'rb') as f:
+            self._put(dst_blob_name, f, None)
+
+    # Cloud Storageの署名付きURLの代わり。URLの引数にHMACの署名を付ける
+    def _sign(self, blob_name, content_type, max_size, expires):
+        if not self.secret_key:
+            raise ValueError('secret_key is required to sign uploads')
+        key = self.secret_key
+        if isinstance(key, str):
+            key = key.encode('utf-8')
+        message = f'{blob_name}\n{content_type}\n{max_size}\n{expires}'
+        return hmac.new(key, message.encode('utf-8'), hashlib.sha256).hexdigest()
+
+    def _signed_upload(self, blob_name, content_type, max_size, expires_in):
+        expires = int(time.time()) + expires_in
+        signature = self._sign(blob_name, content_type, max_size, expires)
+        query = urlencode({'content_type': content_type, 'max_size': max_size,
+                           'expires': expires, 'signature': signature})
+        return {'url': f'{self.url(blob_name)}?{query}',
+                'method': 'PUT', 'headers': {'Content-Type': content_type}}
+
+    # signed_uploadで発行したURLの引数を確かめる
+    def verify_upload(self, blob_name, content_type, max_size, expires, signature):
+        try:
+            if int(expires) < time.time():
+                return False
+            expected = self._sign(blob_name, content_type, int(max_size),
+                                  int(expires))
+        except (TypeError, ValueError):
+            return False
+        return hmac.compare_digest(expected, signature or '')
+
+    def url(self, blob_name):
+        return f'{self.url_prefix}/{quote(blob_name)}'
+
+def create_storage(name, **options):
+    if name == 'gcs':
+        return CloudStorage(**options)
+    if name == 'local':
+        return LocalStorage(**options)
+    raise ValueError(f'unknown image storage: {name}')
+
+_storage = None
+_storage_lock = threading.Lock()
+
+def _default_path():
+    if has_app_context():
+        return os.path.join(current_app.instance_path, 'images')
+    return os.path.join(tempfile.gettempdir(), 'sampleapp-images')
+
+def _storage_from_config():
+    # アプリのコンテキスト外(スクリプトなど)では環境変数から作成する
+    if has_app_context():
+        config = current_app.config
+        name = config.get('IMAGE_STORAGE', 'gcs')
+        bucket_name = config.get('BUCKET_IMAGES')
+        path = config.get('IMAGE_STORAGE_PATH')
+    else:
+        name = os.environ.get('SAMPLEAPP_IMAGE_STORAGE', 'gcs')
+        bucket_name = os.environ.get('SAMPLEAPP_BUCKET_IMAGES')
+        path = os.environ.get('SAMPLEAPP_IMAGE_STORAGE_PATH')
+    if name == 'local':
+        secret_key = current_app.secret_key if has_app_context() else None
+        return create_storage(name, root=path or _default_path(),
+                              secret_key=secret_key)
+    return create_storage(name, bucket_name=bucket_name)
+
+def get_storage():
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                _storage = _storage_from_config()
+    return _storage
+
+def set_storage(storage):
+    global _storage
+    with _storage_lock:
+        _storage = storage
+    return storage
+
+def init_app(app):
+    # 設定が無い時は最初に使う時に作成する
+    name = app.config.get('IMAGE_STORAGE', 'gcs')
+    if name == 'local':
+        path = app.config.get('IMAGE_STORAGE_PATH') or \
+            os.path.join(app.instance_path, 'images')
+        set_storage(create_storage(name, root=path, secret_key=app.secret_key))
+    elif app.config.get('BUCKET_IMAGES'):
+        set_storage(create_storage(name, bucket_name=app.config['BUCKET_IMAGES']))
@@ -0,0 +1,83 @@
+import atexit
+import concurrent.futures
+import io
+import multiprocessing
+import os
+import threading
+from flask import current_app, has_app_context
+
+# 表示用に縮小・再エンコードした画像(variant)を作成する
+# 元の画像は最大5MBあるのでfeedには縮小版を表示する
+# 縮小はCPUを使うのでリクエストのworkerではなく別プロセスのプールで行う
+# 作成するタイミングは設定IMAGE_VARIANTS(環境変数SAMPLEAPP_IMAGE_VARIANTS)で選ぶ
+#   eager: アップロード時に作成する
+#   lazy:  最初に表示された時に作成を始める。作成されるまでは元の画像を表示する
+
+EAGER = 'eager'
+LAZY = 'lazy'
+
+# 名前 -> (最大の幅, 最大の高さ)
+VARIANTS = {
+    'display': (500, 500),
+}
+FORMAT = 'WEBP'
+CONTENT_TYPE = 'image/webp'
+QUALITY = 80
+MAX_WORKERS = 2
+
+_executor = None
+_pid = None
+_lock = threading.Lock()
+
+def get_mode():
+    if has_app_context():
+        mode = current_app.config.get('IMAGE_VARIANTS')
+        if mode:
+            return mode
+    return os.environ.get('SAMPLEAPP_IMAGE_VARIANTS', EAGER)
+
+def _get_executor():
+    global _executor, _pid
+    # fork後の子プロセスでは親のプールは使えないので作り直す
+    if _executor is None or _pid != os.getpid():
+        with _lock:
+            if _executor is None or _pid != os.getpid():
+                # threadを使っているプロセスからforkしないようforkserverを使う
+                context = None
+                if 'forkserver' in multiprocessing.get_all_start_methods():
+                    context = multiprocessing.get_context('forkserver')
+                _executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=MAX_WORKERS, mp_context=context)
+                _pid = os.getpid()
+    return _executor
+
+@atexit.register
+def _shutdown():
+    if _executor is not None and _pid == os.getpid():
+        _executor.shutdown(wait=True)
+
+# プールのプロセスで実行される。pickleできるようにモジュールの関数にする
+def _resize(data, size):
+    from PIL import Image, ImageOps
+    with Image.open(io.BytesIO(data)) as image:
+        # EXIFの向きを反映してからメタデータを捨てる
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'transparency' in image.info
+                                  else 'RGB')
+        image.thumbnail(size)
+        out = io.BytesIO()
+        image.save(out, FORMAT, quality=QUALITY)
+        return out.getvalue()
+
+def blob_name(original_blob_name, variant):
+    base, _ = os.path.splitext(original_blob_name)
+    return f'{base}.{variant}.webp'
+
+# 画像のバイト列から全てのvariantを作成する。{名前: バイト列}を返す
+# 呼び出したthreadは作成が終わるまで待つのでバックグラウンドのthreadから呼ぶこと
+def generate(data):
+    executor = _get_executor()
+    futures = {name: executor.submit(_resize, data, size)
+               for name, size in VARIANTS.items()}
+    return {name: future.result() for name, future in futures.items()}
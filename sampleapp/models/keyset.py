@@ -0,0 +1,124 @@
+import base64
+import json
+from datetime import datetime, timezone
+from . import database
+
+# (created_at, key)の位置を起点に読み出すページ送り(keyset pagination)
+# offsetを使わないので何ページ目でも読み出すのは1ページ分とその次の1件だけで、
+# エンティティの総数に関係なく一定のコストで済む
+# カーソルは前後のページの境目の(created_at, key)と読む向きを表す
+
+NEXT = 'next'
+PREV = 'prev'
+
+_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f%z'
+
+class Cursor:
+    def __init__(self, created_at, id, direction=NEXT):
+        self.created_at = created_at
+        self.id = id
+        self.direction = direction
+
+    def __repr__(self):
+        return f'Cursor(created_at={self.created_at!r}, ' +\
+            f'id={self.id!r}, ' +\
+            f'direction={self.direction!r})'
+
+    def encode(self):
+        data = {'t': self.created_at.astimezone(timezone.utc).strftime(_DATETIME_FORMAT),
+                'id': self.id, 'd': self.direction}
+        s = json.dumps(data, separators=(',', ':')).encode('utf-8')
+        return base64.urlsafe_b64encode(s).decode('ascii').rstrip('=')
+
+    @staticmethod
+    def decode(s):
+        # 不正なカーソルは先頭ページ扱いにする
+        if not s:
+            return None
+        try:
+            s += '=' * (-len(s) % 4)
+            data = json.loads(base64.urlsafe_b64decode(s.encode('ascii')))
+            created_at = datetime.strptime(data['t'], _DATETIME_FORMAT)
+            direction = data['d']
+            if direction not in (NEXT, PREV):
+                return None
+            # keyと比べるのでidは整数か文字列に限る
+            id = data['id']
+            if isinstance(id, bool) or not isinstance(id, (int, str)):
+                return None
+            return Cursor(created_at, id, direction)
+        except (ValueError, KeyError, TypeError):
+            return None
+
+class Page(list):
+    # 1ページ分のリスト。前後のページのカーソル(無ければNone)を持つ
+    def __init__(self, items=(), next_cursor=None, prev_cursor=None):
+        super().__init__(items)
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+# positionの(created_at, key)より後ろのエンティティを順にbatch件ずつ読み出す
+# ascendingがFalseの時は新しい順に読む
+def scan(kind, filters, position=None, ascending=True, batch=100):
+    if ascending:
+        op, order = '>=', ['created_at', database.KEY]
+    else:
+        op, order = '<=', ['-created_at', '-' + database.KEY]
+    backend = database.get_backend()
+    while True:
+        fs = list(filters)
+        if position is not None:
+            fs.append(('created_at', op, position[0]))
+        entities = backend.query(kind, filters=fs, order=order, limit=batch)
+        n = 0
+        for e in entities:
+            key = (e['created_at'], e.id)
+            # 同時刻のものはkeyで前後を判断して既に返したものを飛ばす
+            if position is not None and \
+               ((key <= position) if ascending else (key >= position)):
+                continue
+            position = key
+            n += 1
+            yield e
+        if len(entities) < batch:
+            return
+        if n == 0:
+            # 同時刻のものしか無かったので多めに読む
+            batch *= 2
+
+# itemsは(created_at, id)の順に並んだ1ページ分と、その先にまだあるかどうか
+# backwardはカーソルから前のページに向かって読んだ場合
+def make_page(items, cursor, has_more, key=lambda x: x):
+    backward = cursor is not None and cursor.direction == PREV
+    if backward:
+        items = items[::-1]
+    next_cursor = prev_cursor = None
+    if items:
+        next_exists = has_more if not backward else True
+        prev_exists = cursor is not None if not backward else has_more
+        if next_exists:
+            created_at, id = key(items[-1])
+            next_cursor = Cursor(created_at, id, NEXT).encode()
+        if prev_exists:
+            created_at, id = key(items[0])
+            prev_cursor = Cursor(created_at, id, PREV).encode()
+    return Page(items, next_cursor=next_cursor, prev_cursor=prev_cursor)
+
+# kindのエンティティを(created_at, key)の順に1ページ読み出す
+def page(kind, filters=(), limit=30, cursor=None, descending=False):
+    if isinstance(cursor, str):
+        cursor = Cursor.decode(cursor)
+    backward = cursor is not None and cursor.direction == PREV
+    position = None
+    if cursor is not None:
+        position = (cursor.created_at, cursor.id)
+    # 次のページがあるかを知るために1つ多く読む
+    entities = []
+    for e in scan(kind, filters, position, ascending=descending == backward,
+                  batch=limit + 1):
+        entities.append(e)
+        if len(entities) > limit:
+            break
+    has_more = len(entities) > limit
+    return make_page(entities[:limit], cursor, has_more,
+                     key=lambda e: (e['created_at'], e.id))
@@ -1,16 +1,36 @@
-from flask import current_app
 from .errors import Errors
-from google.cloud import datastore
-from google.cloud import storage
+from . import database
+from . import identity_map
+from . import image_storage
+from . import uploads
+from . import image_variants
 from . import user
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 import copy
 from . import image as im
+from . import timeline
+from .counter import Counter
+import hashlib
+import io
 import os
+import secrets
+import threading
 from werkzeug.utils import secure_filename
 
+# 縮小版の作成(lazy)を始めたmicropostのid
+_scheduled = set()
+_scheduled_lock = threading.Lock()
+
 class Micropost:
     KIND_MICROPOSTS = 'microposts'
+    # 添付できる画像のContent-Typeと保存する時の拡張子
+    IMAGE_TYPES = {'image/jpeg': '.jpg', 'image/gif': '.gif', 'image/png': '.png'}
+    MAX_IMAGE_SIZE = 5*1024*1024
+    # ブラウザから直接アップロードされた画像の一時的な置き場所
+    # uploads/{user_id}/{乱数}{拡張子}
+    # フォームが送信されずに残ったものはsweep_uploadsで削除する
+    UPLOADS_PREFIX = 'uploads'
+    UPLOADS_MAX_AGE = timedelta(days=1)
 
     def __init__(self, **kwargs):
         self.id = kwargs.get('id')
@@ -19,6 +39,10 @@ class Micropost:
         self.created_at = kwargs.get('created_at')
         self.updated_at = kwargs.get('updated_at')
         self.errors = Errors()
+        # 添付画像の情報(_image_metadata参照)。画像が無ければNone
+        self.image = kwargs.get('image')
+        # preloadで読み込んだ投稿者
+        self._user = None
 
     def __repr__(self):
         return f'Micropost(id={self.id.__repr__()}, ' +\
@@ -61,37 +85,63 @@ class Micropost:
             v = False
             self.errors.add('user', 'user must exist')
         if hasattr(self, 'image_file') and self.image_file:
-            if self.image_file.mimetype not in \
-               ['image/jpeg', 'image/gif', 'image/png']:
+            if self.image_file.mimetype not in Micropost.IMAGE_TYPES:
                 v = False
                 self.errors.add('image', 'file must be a valid image format')
             self.image_file.seek(0, os.SEEK_END)
             file_size = self.image_file.tell()
             self.image_file.seek(0, os.SEEK_SET)
-            if 5*1024*1024 < file_size:
+            if Micropost.MAX_IMAGE_SIZE < file_size:
                 v = False
                 self.errors.add('image', 'file should be less than 5MB')
+        if getattr(self, 'image_upload', None):
+            if not self._valid_image_upload():
+                v = False
+        return v
+
+    # ブラウザから直接アップロードされた画像を確かめる
+    # 投稿者に発行した置き場所にあり、形式とサイズが正しいこと
+    def _valid_image_upload(self):
+        blob_name = self.image_upload
+        prefix = f'{Micropost.UPLOADS_PREFIX}/{self.user_id}/'
+        stat = None
+        if blob_name.startswith(prefix) and '/' not in blob_name[len(prefix):]:
+            stat = image_storage.get_storage().stat(blob_name)
+        if stat is None:
+            self.errors.add('image', 'uploaded file was not found')
+            return False
+        v = True
+        if stat['content_type'] not in Micropost.IMAGE_TYPES:
+            v = False
+            self.errors.add('image', 'file must be a valid image format')
+        if Micropost.MAX_IMAGE_SIZE < stat['size']:
+            v = False
+            self.errors.add('image', 'file should be less than 5MB')
+        if v:
+            self._image_upload_stat = stat
         return v
 
     def _insert_or_update(self):
-        client = datastore.Client()
+        backend = database.get_backend()
         if self.id:
-            key = client.key(Micropost.KIND_MICROPOSTS, self.id)
-            micropost = client.get(key)
+            micropost = backend.get(Micropost.KIND_MICROPOSTS, self.id)
         else:
-            key = client.key(Micropost.KIND_MICROPOSTS)
-            micropost = datastore.Entity(key)
+            micropost = database.Entity(Micropost.KIND_MICROPOSTS)
 
         micropost['content'] = self.content
         micropost['user_id'] = self.user_id
+        micropost['image'] = self.image
+        # 同じ画像を参照しているmicropostを探すのに使う
+        micropost['image_sha256'] = self.image['sha256'] if self.image else None
         t = datetime.now(timezone.utc)
         if not self.id:
             # 新規登録
             micropost['created_at'] = t
         micropost['updated_at'] = t
 
-        client.put(micropost)
-        self.id = micropost.key.id
+        backend.put(micropost)
+        identity_map.invalidate(Micropost.KIND_MICROPOSTS, micropost.id)
+        self.id = micropost.id
         self.created_at = micropost['created_at']
         self.updated_at = micropost['updated_at']
         return True
@@ -99,9 +149,25 @@ class Micropost:
     def save(self):
         if not self.valid():
             return False
-        ret = self._insert_or_update()
+        is_new = not self.id
+        if is_new:
+            backend = database.get_backend()
+            try:
+                with backend.transaction():
+                    ret = self._insert_or_update()
+                    Counter.increment(self._microposts_counter())
+                    Counter.increment(Counter.kind_name(Micropost.KIND_MICROPOSTS))
+            except database.Aborted:
+                # transaction競合のため失敗
+                self.id = None
+                return False
+        else:
+            ret = self._insert_or_update()
         if ret:
             self._save_attached_image()
+            if is_new:
+                # 投稿者とフォロワーのタイムラインに追加する
+                timeline.Timeline.fan_out(self)
         return ret
 
     @classmethod
@@ -167,17 +233,28 @@ class Micropost:
         return self.update_columns(**{k:v})
 
     def destroy(self):
-        client = datastore.Client()
-        key = client.key(Micropost.KIND_MICROPOSTS, self.id)
-        client.delete(key)
+        backend = database.get_backend()
+        with backend.transaction():
+            # 既に削除されていたらカウンタを減らさない
+            if backend.get(Micropost.KIND_MICROPOSTS, self.id) is None:
+                return
+            backend.delete(Micropost.KIND_MICROPOSTS, self.id)
+            identity_map.invalidate(Micropost.KIND_MICROPOSTS, self.id)
+            Counter.increment(self._microposts_counter(), -1)
+            Counter.increment(Counter.kind_name(Micropost.KIND_MICROPOSTS), -1)
+        timeline.Timeline.remove_micropost(self)
         self._delete_attached_image()
 
+    def _microposts_counter(self):
+        return Counter.name(user.User.KIND_USERS, self.user_id, 'microposts')
+
     def reload(self):
         micropost = Micropost.find(self.id)
         self.content = micropost.content
         self.user_id = micropost.user_id
         self.created_at = micropost.created_at
         self.updated_at = micropost.updated_at
+        self.image = micropost.image
         self.errors = micropost.errors
         return self
 
@@ -185,87 +262,411 @@ class Micropost:
     def find(id):
         if id is None:
             return None
-        client = datastore.Client()
-        key = client.key(Micropost.KIND_MICROPOSTS, id)
-        entity = client.get(key)
+        entity = identity_map.get(Micropost.KIND_MICROPOSTS, id)
         if entity is None:
             return None
-        micropost = Micropost(id=entity.key.id, **entity)
+        micropost = Micropost(id=entity.id, **entity)
         return micropost
 
     @staticmethod
     def find_by(**kwargs):
         if not kwargs:
             return []
-        client = datastore.Client()
-        query = client.query(kind=Micropost.KIND_MICROPOSTS)
+        backend = database.get_backend()
+        filters = []
         for k,v in kwargs.items():
             if k=='id':
-                key = client.key(Micropost.KIND_MICROPOSTS, v)
-                query.key_filter(key, '=')
+                filters.append((database.KEY, '=', v))
             else:
-                query.add_filter(k, '=', v)
-        entities = list(query.fetch())
-        microposts = [Micropost(id=entity.key.id, **entity) for entity in entities]
+                filters.append((k, '=', v))
+        entities = backend.query(Micropost.KIND_MICROPOSTS, filters=filters)
+        microposts = [Micropost(id=entity.id, **entity) for entity in entities]
         microposts.sort(key=lambda x: x.created_at, reverse=True)
         return microposts
 
     @staticmethod
     def all():
-        client = datastore.Client()
-        query = client.query(kind=Micropost.KIND_MICROPOSTS)
-        query.order = ['-created_at']
-        entities = list(query.fetch())
-        microposts = [Micropost(id=entity.key.id, **entity) for entity in entities]
+        backend = database.get_backend()
+        entities = backend.query(Micropost.KIND_MICROPOSTS, order=['-created_at'])
+        microposts = [Micropost(id=entity.id, **entity) for entity in entities]
         return microposts
 
+    # exact=Falseの時はプロセス内に一定時間キャッシュした値を返す
     @staticmethod
-    def count():
-        return len(Micropost.all())
+    def count(exact=True):
+        name = Counter.kind_name(Micropost.KIND_MICROPOSTS)
+        if exact:
+            return Counter.get(name)
+        return Counter.get_cached(name)
 
     def user(self):
+        if self._user is not None:
+            return self._user
         return user.User.find(self.user_id)
 
+    # micropostの一覧を表示する前に投稿者をまとめて読み込んでおく
+    #   Micropost.preload(microposts, 'user')
+    # 投稿者は1回のget_multiで読むので一覧の件数に関係なく読み出しの回数は一定になる
+    # 画像の情報はmicropostのエンティティに含まれているので読み込む必要は無い
+    @staticmethod
+    def preload(microposts, *associations):
+        for association in associations:
+            if association not in ('user',):
+                raise ValueError(f'unknown association: {association}')
+        if not microposts:
+            return microposts
+        if 'user' in associations:
+            ids = list(dict.fromkeys(m.user_id for m in microposts))
+            users = {u.id: u for u in user.User.find_multi(ids)}
+            for m in microposts:
+                m._user = users.get(m.user_id)
+        return microposts
+
     def image_attach(self, image_file):
         self.image_file = image_file
 
+    # ブラウザがsigned_image_uploadのURLに直接アップロードした画像を添付する
+    def image_attach_upload(self, blob_name):
+        self.image_upload = blob_name
+
+    # 画像を直接アップロードするための署名付きURLを発行する
+    # 置き場所のblob名を'blob_name'に加えたsigned_uploadの結果を返す
+    # 形式が正しくない時や大きすぎる時はNone
+    @staticmethod
+    def signed_image_upload(user_id, content_type, size):
+        if content_type not in Micropost.IMAGE_TYPES:
+            return None
+        if size is not None and Micropost.MAX_IMAGE_SIZE < size:
+            return None
+        ext = Micropost.IMAGE_TYPES[content_type]
+        blob_name = f'{Micropost.UPLOADS_PREFIX}/{user_id}/' + \
+            f'{secrets.token_urlsafe(16)}{ext}'
+        upload = image_storage.get_storage().signed_upload(
+            blob_name, content_type, Micropost.MAX_IMAGE_SIZE)
+        return dict(upload, blob_name=blob_name)
+
     def image_attached(self):
-        images = im.Image.find_by(micropost_id=self.id)
-        if images:
-            return True
-        else:
-            return False
+        return self.image is not None
+
+    # バックグラウンドでのアップロードが終わっているか
+    # readyが無いものはアップロード中の状態が導入される前のもの
+    def image_ready(self):
+        return self.image is not None and self.image.get('ready', True)
 
-    def image_url(self):
-        images = im.Image.find_by(micropost_id=self.id)
-        if images:
-            image = images[0]
-            client = storage.Client()
-            bucket = client.get_bucket(current_app.config['BUCKET_IMAGES'])
-            blob_name = f'{self.id}/{image.file_name}'
-            blob = bucket.get_blob(blob_name)
-            if blob:
-                return blob.public_url
-        return None
+    # バックグラウンドでのアップロードが失敗したか
+    def image_failed(self):
+        return self.image is not None and self.image.get('failed', False)
+
+    # 公開URLはバケット名とblob名から作るのでCloud Storageにはアクセスしない
+    # variantを指定すると縮小版のURLを返す。まだ無ければ元の画像のURLを返す
+    def image_url(self, variant=None):
+        if not self.image_ready():
+            return None
+        blob_name = self.image['blob_name']
+        if variant is not None:
+            variants = self.image.get('variants') or {}
+            if variant in variants:
+                blob_name = variants[variant]
+            elif image_variants.get_mode() == image_variants.LAZY and \
+                 not self.image.get('variants_failed'):
+                # 作成に失敗したものは作り直さない
+                Micropost._schedule_variants(self.id, self.image)
+        return image_storage.get_storage().url(blob_name)
 
     def _save_attached_image(self):
+        if getattr(self, 'image_upload', None):
+            self._save_uploaded_image()
+            return
         if hasattr(self, 'image_file') and self.image_file:
             # Cloud Storageに保存するので必要無いはずだが念の為
             file_name = secure_filename(self.image_file.filename)
             if file_name:
-                image = im.Image(micropost_id=self.id, file_name=file_name)
-                if image.save():
-                    client = storage.Client()
-                    bucket = client.get_bucket(current_app.config['BUCKET_IMAGES'])
-                    blob_name = f'{self.id}/{file_name}'
-                    blob = bucket.blob(blob_name)
-                    blob.upload_from_file(self.image_file,
-                                          content_type=self.image_file.mimetype)
+                # 一時ファイルに書き出しながらSHA-256を求める
+                path, size, sha256 = uploads.spool(self.image_file)
+                content_type = self.image_file.mimetype
+                # blobは内容のSHA-256で保存するので同じ画像は1回だけアップロードする
+                ext = os.path.splitext(file_name)[1].lower()
+                image, upload = im.Image.acquire(sha256, f'images/{sha256}{ext}',
+                                                 content_type, size)
+                # 表示の度に問い合わせなくて済むようmicropostに保存する
+                self.image = {
+                    'file_name': file_name,
+                    'blob_name': image.blob_name,
+                    'content_type': image.content_type,
+                    'size': size,
+                    'sha256': sha256,
+                    # 縮小版を作った時に{名前: blob名}で追加する
+                    'variants': dict(image.variants),
+                    'ready': image.ready and not upload,
+                }
+                self._insert_or_update()
+                if not upload:
+                    os.remove(path)
+                    if not self.image['ready']:
+                        # 他のmicropostからのアップロードがこの間に終わっていれば反映する
+                        image = im.Image.find(sha256)
+                        if image is not None and image.ready:
+                            Micropost._update_image(self.id, ready=True,
+                                                    variants=image.variants)
+                    return
+                # アップロードはバックグラウンドで行う
+                blob_name = image.blob_name
+                eager = image_variants.get_mode() == image_variants.EAGER
+                uploads.submit(blob_name, path, content_type,
+                               lambda ok, path: Micropost._image_uploaded(
+                                   sha256, blob_name, ok,
+                                   path if eager else None))
+
+    # ブラウザから直接アップロードされた画像を添付する
+    # 内容のSHA-256が分からないので、取り込みが終わるまでは置き場所のblobを指しておく
+    def _save_uploaded_image(self):
+        blob_name = self.image_upload
+        stat = getattr(self, '_image_upload_stat', None) or \
+            image_storage.get_storage().stat(blob_name)
+        self.image = {
+            'file_name': os.path.basename(blob_name),
+            'blob_name': blob_name,
+            'content_type': stat['content_type'],
+            'size': stat['size'],
+            'sha256': None,
+            'variants': {},
+            'ready': False,
+        }
+        self._insert_or_update()
+        eager = image_variants.get_mode() == image_variants.EAGER
+        uploads.run(Micropost._import_upload, self.id, blob_name,
+                    stat['content_type'], eager)
+
+    # 直接アップロードされた画像をバックグラウンドで取り込む
+    # SHA-256を求めて画像を登録し、初めての画像ならストレージ内でコピーする
+    @staticmethod
+    def _import_upload(micropost_id, upload_blob_name, content_type, eager):
+        storage = image_storage.get_storage()
+        # SHA-256は少しずつ読みながら求め、画像全体をメモリに読まない
+        sha256 = hashlib.sha256()
+        size = 0
+        try:
+            with storage.open(upload_blob_name) as f:
+                while chunk := f.read(64*1024):
+                    sha256.update(chunk)
+                    size += len(chunk)
+        except Exception:
+            Micropost._update_image(micropost_id, ready=False)
+            return
+        sha256 = sha256.hexdigest()
+        ext = os.path.splitext(upload_blob_name)[1]
+        image, upload = im.Image.acquire(sha256, f'images/{sha256}{ext}',
+                                         content_type, size)
+        ready = image.ready and not upload
+        if not Micropost._update_image(micropost_id, sha256=sha256,
+                                       blob_name=image.blob_name,
+                                       variants=image.variants,
+                                       ready=True if ready else None):
+            # 取り込み中にmicropostが削除された
+            storage.delete_multi([upload_blob_name] +
+                                 im.Image.release(sha256, image.blob_name))
+            return
+        ok = True
+        if upload:
+            data = None
+            try:
+                storage.copy(upload_blob_name, image.blob_name)
+            except Exception:
+                ok = False
+            # 縮小版の作成には画像全体が必要なので、初めての画像の時だけ読む
+            # 読めなかった時は元の画像を表示する
+            if ok and eager:
+                try:
+                    data = storage.get(upload_blob_name)
+                except Exception:
+                    pass
+            Micropost._image_stored(sha256, image.blob_name, ok, data)
+        elif not ready:
+            # 他のmicropostからのアップロードがこの間に終わっていれば反映する
+            image = im.Image.find(sha256)
+            if image is not None and image.ready:
+                Micropost._update_image(micropost_id, ready=True,
+                                        variants=image.variants)
+        storage.delete(upload_blob_name)
+
+    # 直接アップロードされたままフォームが送信されなかった画像を削除する
+    # 削除したblobの数を返す
+    @staticmethod
+    def sweep_uploads(max_age=None):
+        if max_age is None:
+            max_age = Micropost.UPLOADS_MAX_AGE
+        storage = image_storage.get_storage()
+        expired = datetime.now(timezone.utc) - max_age
+        blob_names = [blob_name for blob_name, updated
+                      in storage.list(Micropost.UPLOADS_PREFIX + '/')
+                      if updated < expired]
+        storage.delete_multi(blob_names)
+        return len(blob_names)
+
+    # バックグラウンドでのアップロードが終わった時に呼ばれる
+    # pathが渡された時はその一時ファイルから縮小版を作成する
+    @staticmethod
+    def _image_uploaded(sha256, blob_name, ok, path=None):
+        data = None
+        if ok and path is not None:
+            with open(path, 'rb') as f:
+                data = f.read()
+        Micropost._image_stored(sha256, blob_name, ok, data)
+
+    # 画像をblob_nameに保存し終わった時に呼ばれる
+    # dataが渡された時はそれから縮小版を作成する
+    @staticmethod
+    def _image_stored(sha256, blob_name, ok, data=None):
+        variants = {}
+        if ok and data is not None:
+            variants = Micropost._make_variants(blob_name, data)
+        if im.Image.update_record(sha256, ready=ok, variants=variants) is None:
+            # アップロード中に画像を参照するmicropostが全て削除された
+            if ok:
+                image_storage.get_storage().delete_multi(
+                    [blob_name] + list(variants.values()))
+            return
+        Micropost._update_images(sha256, ready=ok, variants=variants)
+
+    # 縮小版を作成してストレージに保存する。{名前: blob名}を返す
+    @staticmethod
+    def _make_variants(blob_name, data):
+        try:
+            images = image_variants.generate(data)
+        except Exception:
+            # 画像として読めなかった場合は元の画像を表示する
+            return {}
+        storage = image_storage.get_storage()
+        variants = {}
+        for name, variant in images.items():
+            variant_blob_name = image_variants.blob_name(blob_name, name)
+            storage.put(variant_blob_name, io.BytesIO(variant),
+                        image_variants.CONTENT_TYPE)
+            variants[name] = variant_blob_name
+        return variants
+
+    # 最初に表示された時に縮小版の作成を始める(lazy)
+    @staticmethod
+    def _schedule_variants(micropost_id, image):
+        key = image.get('sha256') or micropost_id
+        with _scheduled_lock:
+            if key in _scheduled:
+                return
+            _scheduled.add(key)
+        uploads.run(Micropost._generate_variants, micropost_id, image, key)
+
+    @staticmethod
+    def _generate_variants(micropost_id, image, key):
+        try:
+            blob_name = image['blob_name']
+            sha256 = image.get('sha256')
+            record = im.Image.find(sha256) if sha256 else None
+            if record is not None and record.blob_name != blob_name:
+                # 重複排除を導入する前の画像
+                record = None
+            if record is not None and record.variants:
+                # 同じ画像を参照する他のmicropostで作成済み
+                variants = record.variants
+            else:
+                try:
+                    data = image_storage.get_storage().get(blob_name)
+                except Exception:
+                    data = None
+                variants = {}
+                if data is not None:
+                    variants = Micropost._make_variants(blob_name, data)
+            # 作成できなかった時は記録し、表示するたびに作り直さないようにする
+            fields = {} if variants else {'variants_failed': True}
+            if record is not None:
+                if im.Image.update_record(sha256, variants=variants) is None:
+                    image_storage.get_storage().delete_multi(variants.values())
+                    return
+                Micropost._update_images(sha256, variants=variants, **fields)
+            elif not Micropost._update_image(micropost_id, variants=variants,
+                                             **fields):
+                image_storage.get_storage().delete_multi(variants.values())
+        finally:
+            with _scheduled_lock:
+                _scheduled.discard(key)
+
+    # 同じ画像を参照している全てのmicropostの画像の情報を更新する
+    @staticmethod
+    def _update_images(sha256, ready=None, variants=None, **fields):
+        backend = database.get_backend()
+        entities = backend.query(Micropost.KIND_MICROPOSTS,
+                                 filters=[('image_sha256', '=', sha256)],
+                                 keys_only=True)
+        for e in entities:
+            Micropost._update_image(e.id, ready=ready, variants=variants,
+                                    **fields)
+
+    # micropostに保存している画像の情報を更新する。micropostが無ければFalseを返す
+    # fieldsは置き換える項目
+    @staticmethod
+    def _update_image(micropost_id, ready=None, variants=None, **fields):
+        backend = database.get_backend()
+        with backend.transaction():
+            micropost = backend.get(Micropost.KIND_MICROPOSTS, micropost_id)
+            if micropost is None or not micropost.get('image'):
+                return False
+            image = micropost['image']
+            image.update(fields)
+            if 'sha256' in fields:
+                micropost['image_sha256'] = fields['sha256']
+            if ready is not None:
+                image['ready'] = ready
+                if not ready:
+                    image['failed'] = True
+            if variants:
+                image['variants'] = dict(image.get('variants') or {}, **variants)
+            backend.put(micropost)
+        return True
 
     def _delete_attached_image(self):
-        for image in im.Image.find_by(micropost_id=self.id):
-            image.destroy()
-            client = storage.Client()
-            bucket = client.get_bucket(current_app.config['BUCKET_IMAGES'])
-            blob_name = f'{self.id}/{image.file_name}'
-            bucket.delete_blob(blob_name)
+        Micropost._delete_attached_images([self])
+
+    # 削除したmicropostの画像を削除する。blobはまとめて1回で削除する
+    @staticmethod
+    def _delete_attached_images(microposts):
+        backend = database.get_backend()
+        blob_names = []
+        # 重複排除を導入する前にmicropostごとに保存していた画像
+        by_id = {m.id: m for m in microposts}
+        ids = list(by_id)
+        for i in range(0, len(ids), database.MAX_IN_VALUES):
+            entities = backend.query(im.Image.KIND_IMAGES,
+                                     filters=[('micropost_id', 'IN',
+                                               ids[i:i+database.MAX_IN_VALUES])])
+            for entity in entities:
+                image = im.Image(id=entity.id, **entity)
+                image.destroy()
+                blob_names.append(f'{image.micropost_id}/{image.file_name}')
+                m = by_id[image.micropost_id]
+                if m.image is not None:
+                    blob_names += list((m.image.get('variants') or {}).values())
+        for m in microposts:
+            # 最後の参照だった時だけblobを削除する
+            if m.image is not None and m.image.get('sha256'):
+                blob_names += im.Image.release(m.image['sha256'],
+                                               m.image['blob_name'])
+            elif m.image is not None and m.image['blob_name'].startswith(
+                    Micropost.UPLOADS_PREFIX + '/'):
+                # 取り込み前の直接アップロードされた画像
+                blob_names.append(m.image['blob_name'])
+        image_storage.get_storage().delete_multi(blob_names)
+
+    # ユーザーのmicropostをまとめて削除する(ユーザーの削除で使う)
+    # 投稿者の件数のカウンタはユーザーと一緒に削除するので減らさない
+    # 途中で止まってやり直した時に画像の参照を2回減らさないよう、先にmicropostを削除する
+    @staticmethod
+    def delete_all(microposts):
+        if not microposts:
+            return
+        backend = database.get_backend()
+        ids = [m.id for m in microposts]
+        backend.delete_multi(Micropost.KIND_MICROPOSTS, ids)
+        for id in ids:
+            identity_map.invalidate(Micropost.KIND_MICROPOSTS, id)
+        Counter.increment(Counter.kind_name(Micropost.KIND_MICROPOSTS), -len(ids))
+        timeline.Timeline.remove_microposts(ids)
+        Micropost._delete_attached_images(microposts)
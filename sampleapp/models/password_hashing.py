@@ -0,0 +1,137 @@
+import atexit
+import concurrent.futures
+import multiprocessing
+import os
+import threading
+from flask import current_app, has_app_context
+from werkzeug.security import check_password_hash, generate_password_hash
+
+# passwordのhash(PBKDF2)の計算と照合を別プロセスのプールで行う
+# 計算は意図的に遅くCPUを使うので、リクエストのthreadで行うとGILのために
+# 同じworkerの他のリクエストまで止まってしまう。プールならCPUのコア数まで並列に計算できる
+# 待っている計算がプロセスあたりQUEUE_PER_WORKERを超えた時やTIMEOUT秒で終わらない時は
+# Saturatedを送出し、init_appで登録したハンドラーが503を返す(負荷を捨てる)
+# 方法は設定PASSWORD_HASHING(環境変数SAMPLEAPP_PASSWORD_HASHING)で選ぶ
+#   pool:   プロセスのプールで計算する
+#   inline: 呼び出したthreadで計算する
+# プールはgunicornのworkerごとに作られるので、プロセスの数はCPUのコア数を
+# workerの数(WEB_CONCURRENCY)で割った数にする。全workerのプロセスの合計が
+# コア数を超えると計算が遅くなるだけで、503で負荷を捨てる判断が実際の負荷と合わなくなる
+# 設定PASSWORD_HASHING_WORKERS(環境変数SAMPLEAPP_PASSWORD_HASHING_WORKERS)で指定もできる
+
+POOL = 'pool'
+INLINE = 'inline'
+
+# 実行中のものを除いて待たせておける計算の数(プールのプロセス1つあたり)
+QUEUE_PER_WORKER = 4
+TIMEOUT = 10
+# 503で返すRetry-After(秒)
+RETRY_AFTER = 1
+
+class Saturated(Exception):
+    pass
+
+_executor = None
+_pid = None
+_max_workers = 1
+_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(_max_workers * (1 + QUEUE_PER_WORKER))
+_stats = {'submitted': 0, 'rejected': 0, 'timeouts': 0, 'in_flight': 0,
+          'max_in_flight': 0}
+
+def get_mode():
+    if has_app_context():
+        mode = current_app.config.get('PASSWORD_HASHING')
+        if mode:
+            return mode
+    return os.environ.get('SAMPLEAPP_PASSWORD_HASHING', POOL)
+
+# プールのプロセスの数
+def get_max_workers():
+    workers = None
+    if has_app_context():
+        workers = current_app.config.get('PASSWORD_HASHING_WORKERS')
+    if not workers:
+        workers = os.environ.get('SAMPLEAPP_PASSWORD_HASHING_WORKERS')
+    if workers:
+        return max(1, int(workers))
+    web_concurrency = int(os.environ.get('WEB_CONCURRENCY') or 1)
+    return max(1, (os.cpu_count() or 1) // max(1, web_concurrency))
+
+def _get_executor():
+    global _executor, _pid, _slots, _max_workers
+    # fork後の子プロセスでは親のプールは使えないので作り直す
+    if _executor is None or _pid != os.getpid():
+        with _lock:
+            if _executor is None or _pid != os.getpid():
+                # threadを使っているプロセスからforkしないようforkserverを使う
+                context = None
+                if 'forkserver' in multiprocessing.get_all_start_methods():
+                    context = multiprocessing.get_context('forkserver')
+                _max_workers = get_max_workers()
+                _executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=_max_workers, mp_context=context)
+                _slots = threading.BoundedSemaphore(
+                    _max_workers * (1 + QUEUE_PER_WORKER))
+                _stats['in_flight'] = 0
+                _pid = os.getpid()
+    return _executor
+
+@atexit.register
+def _shutdown():
+    if _executor is not None and _pid == os.getpid():
+        _executor.shutdown(wait=True)
+
+def _release(slots):
+    with _lock:
+        _stats['in_flight'] -= 1
+    slots.release()
+
+def _run(f, *args):
+    if get_mode() == INLINE:
+        return f(*args)
+    executor = _get_executor()
+    slots = _slots
+    if not slots.acquire(blocking=False):
+        with _lock:
+            _stats['rejected'] += 1
+        raise Saturated('password hashing queue is full')
+    with _lock:
+        _stats['submitted'] += 1
+        _stats['in_flight'] += 1
+        _stats['max_in_flight'] = max(_stats['max_in_flight'],
+                                      _stats['in_flight'])
+    try:
+        future = executor.submit(f, *args)
+    except BaseException:
+        _release(slots)
+        raise
+    future.add_done_callback(lambda future: _release(slots))
+    try:
+        return future.result(timeout=TIMEOUT)
+    except concurrent.futures.TimeoutError:
+        # 計算は続くが結果は使わない。枠は計算が終わった時に空く
+        future.cancel()
+        with _lock:
+            _stats['timeouts'] += 1
+        raise Saturated('password hashing timed out')
+
+def hash_password(password):
+    return _run(generate_password_hash, password)
+
+def check_password(digest, password):
+    return _run(check_password_hash, digest, password)
+
+# queuedは実行を待っている計算の数、workersはプールのプロセスの数
+def stats():
+    with _lock:
+        s = dict(_stats)
+        s['workers'] = _max_workers
+    s['queued'] = max(0, s['in_flight'] - s['workers'])
+    return s
+
+def init_app(app):
+    @app.errorhandler(Saturated)
+    def service_unavailable(e):
+        app.logger.warning(f'password hashing is saturated: {stats()}')
+        return 'Service Unavailable', 503, {'Retry-After': str(RETRY_AFTER)}
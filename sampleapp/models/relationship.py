@@ -1,8 +1,18 @@
+import collections
+import logging
 from .errors import Errors
-from google.cloud import datastore
+from . import database
+from . import identity_map
 from datetime import datetime, timezone
 import copy
 from . import user
+from . import timeline
+from .counter import Counter
+
+# idは"{follower_id}:{followed_id}"(Relationship.key)
+# フォローしているかどうかはクエリではなくキーで読んで確かめる
+# 同じrelationshipはtransactionの中でキーを確認してから作るので重複しない
+_logger = logging.getLogger(__name__)
 
 class Relationship:
     KIND_RELATIONSHIPS = 'relationships'
@@ -38,27 +48,24 @@ class Relationship:
         if not self.followed_id:
             v = False
             self.errors.add('followed_id', "followed_id can't be blank")
-        if Relationship.find_by(follower_id=self.follower_id,
-                                followed_id=self.followed_id):
-            # multi threadで同時に同じrelationshipを保存した場合、
-            # 同じrelationshipが複数存在してしまう問題がある。
-            # 万一そうなった場合はそれでも良いデータなので厳密にunique
-            # にすることはしない。destroy時に対策をする。
-            v = False
-            self.errors.add('', "same relationship can't exist")
+        # 同じrelationshipが無いことはsaveのtransactionの中で確認する
         if self.follower_id == self.followed_id:
             v = False
             self.errors.add('', "follower_id and followed_id can't be same")
         return v
 
+    @staticmethod
+    def key(follower_id, followed_id):
+        return f'{follower_id}:{followed_id}'
+
     def _insert_or_update(self):
-        client = datastore.Client()
+        backend = database.get_backend()
         if self.id:
-            key = client.key(Relationship.KIND_RELATIONSHIPS, self.id)
-            relationship = client.get(key)
+            relationship = backend.get(Relationship.KIND_RELATIONSHIPS, self.id)
         else:
-            key = client.key(Relationship.KIND_RELATIONSHIPS)
-            relationship = datastore.Entity(key)
+            relationship = database.Entity(
+                Relationship.KIND_RELATIONSHIPS,
+                Relationship.key(self.follower_id, self.followed_id))
 
         relationship['follower_id'] = self.follower_id
         relationship['followed_id'] = self.followed_id
@@ -67,8 +74,9 @@ class Relationship:
             relationship['created_at'] = t
         relationship['updated_at'] = t
 
-        client.put(relationship)
-        self.id = relationship.key.id
+        backend.put(relationship)
+        identity_map.invalidate(Relationship.KIND_RELATIONSHIPS, relationship.id)
+        self.id = relationship.id
         self.created_at = relationship['created_at']
         self.updated_at = relationship['updated_at']
         return True
@@ -76,7 +84,26 @@ class Relationship:
     def save(self):
         if not self.valid():
             return False
-        return self._insert_or_update()
+        backend = database.get_backend()
+        is_new = not self.id
+        try:
+            with backend.transaction():
+                if is_new:
+                    key = Relationship.key(self.follower_id, self.followed_id)
+                    if backend.get(Relationship.KIND_RELATIONSHIPS, key) is not None:
+                        self.errors.add('', "same relationship can't exist")
+                        return False
+                self._insert_or_update()
+                if is_new:
+                    self._increment_counters(1)
+        except database.Aborted:
+            # transaction競合のため失敗
+            if is_new:
+                self.id = None
+            return False
+        # フォローしたユーザーのmicropostをタイムラインに追加する
+        timeline.Timeline.backfill(self.follower_id, self.followed_id)
+        return True
 
     @classmethod
     def create(cls, **kwargs):
@@ -84,52 +111,141 @@ class Relationship:
         relationship.save()
         return relationship
 
+    def _increment_counters(self, delta):
+        kind = user.User.KIND_USERS
+        Counter.increment(Counter.name(kind, self.follower_id, 'following'), delta)
+        Counter.increment(Counter.name(kind, self.followed_id, 'followers'), delta)
+        Counter.increment(Counter.kind_name(Relationship.KIND_RELATIONSHIPS), delta)
+
     def destroy(self):
-        client = datastore.Client()
-        key = client.key(Relationship.KIND_RELATIONSHIPS, self.id)
-        client.delete(key)
+        backend = database.get_backend()
+        with backend.transaction():
+            # 既に削除されていたらカウンタを減らさない
+            if backend.get(Relationship.KIND_RELATIONSHIPS, self.id) is None:
+                return
+            backend.delete(Relationship.KIND_RELATIONSHIPS, self.id)
+            identity_map.invalidate(Relationship.KIND_RELATIONSHIPS, self.id)
+            self._increment_counters(-1)
+        timeline.Timeline.remove_author(self.follower_id, self.followed_id)
+
+    # relationshipをまとめて削除する(ユーザーの削除で使う)
+    # "{follower_id}:{followed_id}"のidからユーザーが分かるのでエンティティは読まない
+    # 移行前の整数のidのものだけはエンティティを読んでユーザーを調べる
+    # deleted_user_idのユーザーのカウンタは削除するので減らさない
+    # カウンタは名前ごとに合計してincrement_multiでまとめて減らす
+    @staticmethod
+    def delete_multi(ids, deleted_user_id=None):
+        if not ids:
+            return
+        backend = database.get_backend()
+        pairs = {}
+        legacy = []
+        for id in ids:
+            pair = Relationship._parse_key(id)
+            if pair is None:
+                legacy.append(id)
+            else:
+                pairs[id] = pair
+        if legacy:
+            _logger.warning('deleting %d relationships with legacy ids',
+                            len(legacy))
+            entities = backend.get_multi(Relationship.KIND_RELATIONSHIPS, legacy)
+            for id, e in zip(legacy, entities):
+                if e is not None:
+                    pairs[id] = (e['follower_id'], e['followed_id'])
+        if not pairs:
+            return
+        backend.delete_multi(Relationship.KIND_RELATIONSHIPS, list(pairs))
+        kind = user.User.KIND_USERS
+        deltas = collections.Counter()
+        for id, (follower_id, followed_id) in pairs.items():
+            identity_map.invalidate(Relationship.KIND_RELATIONSHIPS, id)
+            if follower_id != deleted_user_id:
+                deltas[Counter.name(kind, follower_id, 'following')] -= 1
+            if followed_id != deleted_user_id:
+                deltas[Counter.name(kind, followed_id, 'followers')] -= 1
+        deltas[Counter.kind_name(Relationship.KIND_RELATIONSHIPS)] -= len(pairs)
+        Counter.increment_multi(deltas)
 
     @staticmethod
     def find(id):
         if id is None:
             return None
-        client = datastore.Client()
-        key = client.key(Relationship.KIND_RELATIONSHIPS, id)
-        entity = client.get(key)
+        entity = identity_map.get(Relationship.KIND_RELATIONSHIPS, id)
         if entity is None:
             return None
-        relationship = Relationship(id=entity.key.id, **entity)
+        relationship = Relationship(id=entity.id, **entity)
         return relationship
 
+    # follower_idのユーザーがfollowed_idのユーザーをフォローしていればそのrelationship
+    @staticmethod
+    def find_by_users(follower_id, followed_id):
+        return Relationship.find(Relationship.key(follower_id, followed_id))
+
+    # "{follower_id}:{followed_id}"のidを(follower_id, followed_id)にする
+    # 移行前の整数のidなどはNone
+    @staticmethod
+    def _parse_key(id):
+        try:
+            follower_id, followed_id = (int(x) for x in id.split(':'))
+        except (AttributeError, ValueError):
+            return None
+        return follower_id, followed_id
+
+    # follower_idのユーザーがフォローしているユーザーのidのリスト
+    # followed_idはキーに含まれているのでエンティティは読まない(keys_only)
+    # 移行前の整数のidのものだけはエンティティを読む
+    @staticmethod
+    def followed_ids(follower_id, limit=None):
+        backend = database.get_backend()
+        entities = backend.query(Relationship.KIND_RELATIONSHIPS,
+                                 filters=[('follower_id', '=', follower_id)],
+                                 limit=limit, keys_only=True)
+        ids = []
+        legacy = []
+        for e in entities:
+            pair = Relationship._parse_key(e.id)
+            if pair is None:
+                legacy.append(e.id)
+            else:
+                ids.append(pair[1])
+        if legacy:
+            for e in backend.get_multi(Relationship.KIND_RELATIONSHIPS, legacy):
+                if e is not None:
+                    ids.append(e['followed_id'])
+        return ids
+
     @staticmethod
     def find_by(**kwargs):
         if not kwargs:
             return []
-        client = datastore.Client()
-        query = client.query(kind=Relationship.KIND_RELATIONSHIPS)
+        backend = database.get_backend()
+        filters = []
         for k,v in kwargs.items():
             if k=='id':
-                key = client.key(Relationship.KIND_RELATIONSHIPS, v)
-                query.key_filter(key, '=')
+                filters.append((database.KEY, '=', v))
             else:
-                query.add_filter(k, '=', v)
-        entities = list(query.fetch())
-        relationships = [Relationship(id=entity.key.id, **entity)
+                filters.append((k, '=', v))
+        entities = backend.query(Relationship.KIND_RELATIONSHIPS, filters=filters)
+        relationships = [Relationship(id=entity.id, **entity)
                          for entity in entities]
         return relationships
 
     @staticmethod
     def all():
-        client = datastore.Client()
-        query = client.query(kind=Relationship.KIND_RELATIONSHIPS)
-        entities = list(query.fetch())
-        relationships = [Relationship(id=entity.key.id, **entity)
+        backend = database.get_backend()
+        entities = backend.query(Relationship.KIND_RELATIONSHIPS)
+        relationships = [Relationship(id=entity.id, **entity)
                          for entity in entities]
         return relationships
 
+    # exact=Falseの時はプロセス内に一定時間キャッシュした値を返す
     @staticmethod
-    def count():
-        return len(Relationship.all())
+    def count(exact=True):
+        name = Counter.kind_name(Relationship.KIND_RELATIONSHIPS)
+        if exact:
+            return Counter.get(name)
+        return Counter.get_cached(name)
 
     def follower(self):
         return user.User.find(self.follower_id)
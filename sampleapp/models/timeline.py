@@ -0,0 +1,106 @@
+from . import database
+from . import micropost as mpost
+from . import relationship
+
+# ユーザーごとのホームタイムライン(feed)を実体化したもの
+# micropostの投稿時に投稿者とそのフォロワー全員のタイムラインにエントリを追加する
+# (fan-out on write)。feedの読み出しは1回のクエリとmicropostのget_multiで済む
+# エントリのidは"{タイムラインの持ち主のuser_id}:{micropost_id}"なので
+# 同じエントリを何度書き込んでも重複しない
+# feedの読み出し方がmerge(fan-in)の時はタイムラインを作成しない
+
+def _enabled():
+    from . import feed
+    return feed.get_strategy() == feed.TIMELINE
+
+class Timeline:
+    KIND_TIMELINES = 'timelines'
+    # フォローした時にタイムラインに追加する投稿の数(feedの数ページ分)
+    BACKFILL_LIMIT = 100
+
+    @staticmethod
+    def _entry_id(user_id, micropost_id):
+        return f'{user_id}:{micropost_id}'
+
+    @staticmethod
+    def _entry(user_id, micropost):
+        entry = database.Entity(Timeline.KIND_TIMELINES,
+                                Timeline._entry_id(user_id, micropost.id))
+        entry['user_id'] = user_id
+        entry['micropost_id'] = micropost.id
+        entry['author_id'] = micropost.user_id
+        entry['created_at'] = micropost.created_at
+        return entry
+
+    # micropostを投稿者とフォロワーのタイムラインに追加する
+    @staticmethod
+    def fan_out(micropost):
+        if not _enabled():
+            return
+        rs = relationship.Relationship.find_by(followed_id=micropost.user_id)
+        user_ids = [micropost.user_id] + [r.follower_id for r in rs]
+        entries = [Timeline._entry(user_id, micropost) for user_id in user_ids]
+        database.get_backend().put_multi(entries)
+
+    # micropostを全てのタイムラインから削除する
+    @staticmethod
+    def remove_micropost(micropost):
+        Timeline.remove_microposts([micropost.id])
+
+    # 複数のmicropostをまとめて削除する。IN filterで読むのでクエリはまとめた数で済む
+    @staticmethod
+    def remove_microposts(micropost_ids):
+        backend = database.get_backend()
+        ids = list(micropost_ids)
+        keys = []
+        for i in range(0, len(ids), database.MAX_IN_VALUES):
+            chunk = ids[i:i+database.MAX_IN_VALUES]
+            entries = backend.query(Timeline.KIND_TIMELINES,
+                                    filters=[('micropost_id', 'IN', chunk)],
+                                    keys_only=True)
+            keys += [e.id for e in entries]
+        backend.delete_multi(Timeline.KIND_TIMELINES, keys)
+
+    # フォローした時にフォローしたユーザーの新しい方からlimit件のmicropostを
+    # タイムラインに追加する。limitがNoneの時は全て追加する
+    @staticmethod
+    def backfill(user_id, author_id, limit=BACKFILL_LIMIT):
+        if not _enabled():
+            return
+        backend = database.get_backend()
+        entities = backend.query(mpost.Micropost.KIND_MICROPOSTS,
+                                 filters=[('user_id', '=', author_id)],
+                                 order=['-created_at', '-' + database.KEY],
+                                 limit=limit)
+        microposts = [mpost.Micropost(id=e.id, **e) for e in entities]
+        entries = [Timeline._entry(user_id, m) for m in microposts]
+        backend.put_multi(entries)
+
+    # フォローを解除した時にそのユーザーのmicropostをタイムラインから削除する
+    @staticmethod
+    def remove_author(user_id, author_id):
+        backend = database.get_backend()
+        entries = backend.query(Timeline.KIND_TIMELINES,
+                                filters=[('user_id', '=', user_id),
+                                         ('author_id', '=', author_id)],
+                                keys_only=True)
+        backend.delete_multi(Timeline.KIND_TIMELINES, [e.id for e in entries])
+
+    # ユーザーのタイムラインを全て削除する
+    # limitを指定した時はlimit件だけ削除する。削除した件数を返す
+    @staticmethod
+    def clear(user_id, limit=None):
+        backend = database.get_backend()
+        entries = backend.query(Timeline.KIND_TIMELINES,
+                                filters=[('user_id', '=', user_id)],
+                                limit=limit, keys_only=True)
+        backend.delete_multi(Timeline.KIND_TIMELINES, [e.id for e in entries])
+        return len(entries)
+
+    # タイムラインを作り直す。タイムライン導入前のデータの移行に使う
+    @staticmethod
+    def rebuild(user_id):
+        Timeline.clear(user_id)
+        Timeline.backfill(user_id, user_id, limit=None)
+        for r in relationship.Relationship.find_by(follower_id=user_id):
+            Timeline.backfill(user_id, r.followed_id, limit=None)
@@ -0,0 +1,93 @@
+import concurrent.futures
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from . import image_storage
+
+# アップロードされた画像をリクエストのthreadでストレージに送らず、
+# 一時ファイルに書き出してからバックグラウンドのthreadでアップロードする
+# リクエストの処理時間がストレージへの転送速度に左右されないようにする
+# 失敗した時は間隔を空けて再試行し、終わったらon_doneを呼ぶ
+# 画像の縮小版の作成など、リクエストの後で行う処理もこのthreadで行う
+
+MAX_WORKERS = 4
+MAX_RETRIES = 3
+RETRY_INTERVAL = 1.0
+
+_executor = None
+_pid = None
+_lock = threading.Lock()
+_pending = set()
+
+def _get_executor():
+    global _executor, _pid
+    # fork後の子プロセスには親のthreadが無いので作り直す
+    if _executor is None or _pid != os.getpid():
+        with _lock:
+            if _executor is None or _pid != os.getpid():
+                _executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=MAX_WORKERS, thread_name_prefix='upload')
+                _pid = os.getpid()
+                _pending.clear()
+    return _executor
+
+# fileを一時ファイルにコピーする。同時にサイズとSHA-256を求める
+# (一時ファイルのパス, サイズ, SHA-256)を返す
+def spool(file):
+    sha256 = hashlib.sha256()
+    size = 0
+    file.seek(0, os.SEEK_SET)
+    fd, path = tempfile.mkstemp(prefix='sampleapp-upload-')
+    with os.fdopen(fd, 'wb') as f:
+        while chunk := file.read(64*1024):
+            sha256.update(chunk)
+            f.write(chunk)
+            size += len(chunk)
+    file.seek(0, os.SEEK_SET)
+    return path, size, sha256.hexdigest()
+
+def _upload(blob_name, path, content_type, on_done):
+    storage = image_storage.get_storage()
+    ok = False
+    try:
+        for n in range(MAX_RETRIES):
+            try:
+                with open(path, 'rb') as f:
+                    storage.put(blob_name, f, content_type)
+                ok = True
+                break
+            except Exception:
+                if n + 1 == MAX_RETRIES:
+                    raise
+                time.sleep(RETRY_INTERVAL * 2**n)
+    finally:
+        try:
+            if on_done is not None:
+                on_done(ok, path)
+        finally:
+            os.remove(path)
+
+# 一時ファイルpathをblob_nameにアップロードする。アップロード後に一時ファイルは削除する
+# on_doneは成功したかどうかと一時ファイルのパスを引数に、一時ファイルを削除する前に呼ばれる
+def submit(blob_name, path, content_type, on_done=None):
+    return run(_upload, blob_name, path, content_type, on_done)
+
+# fをバックグラウンドのthreadで実行する
+def run(f, *args):
+    future = _get_executor().submit(f, *args)
+    with _lock:
+        _pending.add(future)
+    future.add_done_callback(_discard)
+    return future
+
+def _discard(future):
+    with _lock:
+        _pending.discard(future)
+
+# 実行中のアップロードが終わるまで待つ。テストやシャットダウン時に使う
+def wait(timeout=None):
+    with _lock:
+        futures = list(_pending)
+    concurrent.futures.wait(futures, timeout=timeout)
@@ -1,22 +1,38 @@
-from google.cloud import datastore
-from google.api_core.exceptions import Aborted
 from datetime import datetime, timedelta, timezone
 import copy
 import re
-from werkzeug.security import check_password_hash, generate_password_hash
 from .errors import Errors
 import secrets
 import functools
-from ..mailers import user_mailer
-from flask_mail import Mail
+import hashlib
+import hmac
+import os
+from flask import current_app, has_app_context
+from ..mailers import mail_queue
 from . import micropost as mpost
 from . import relationship
+from . import feed as fd
+from .counter import Counter
+from . import database
+from . import keyset
+from . import identity_map
+from . import password_hashing
+from . import user_deletion
+from .database import Aborted
 
 class User:
     KIND_EMAILS = 'emails'
     KIND_USERS = 'users'
+    # ユーザーごとに保存している件数
+    COUNTERS = ('following', 'followers', 'microposts')
     EMAIL_PATTERN = re.compile(r'\A[\w+\-.]+@[a-z\d\-]+(\.[a-z\d\-]+)*\.[a-z]+\Z',
                                flags=re.IGNORECASE)
+    # remember, activation, resetのtokenのdigestの形式
+    # hmac-sha256$selector$HMAC-SHA256(鍵, token)
+    # それ以外はgenerate_password_hashで作った以前の形式
+    TOKEN_DIGEST_METHOD = 'hmac-sha256'
+    # フォローしている人数がこれより多い時はidの集合を読まずにキーで確かめる
+    MAX_FOLLOWED_IDS = 5000
 
     def __init__(self, **kwargs):
         self.id = kwargs.get('id')
@@ -39,6 +55,8 @@ class User:
         self.reset_sent_at = kwargs.get('reset_sent_at')
         self.microposts = MyMicroposts(self)
         self.errors = Errors()
+        # フォローしているユーザーのidの集合(_followed_ids参照)
+        self._followed_id_set = None
 
     def __repr__(self):
         return f'User(id={self.id.__repr__()}, ' +\
@@ -103,11 +121,13 @@ class User:
         @functools.wraps(f)
         def wrapper(self, *args, **kwargs):
             self.activation_token = User.new_token()
-            self.activation_digest = User.digest(self.activation_token)
+            self.activation_digest = User.token_digest(self.activation_token)
             return f(self, *args, **kwargs)
         return wrapper
 
-    def valid(self):
+    # check_email=Falseの時はemailアドレスが使われているかを確認しない
+    # save, updateでは保存するtransactionの中でemailsのキーを読んで確認する
+    def valid(self, check_email=True):
         self.errors = Errors()
         v = True
         if (not self.name) or (not self.name.strip()):
@@ -125,9 +145,9 @@ class User:
         if self.email and (not User.EMAIL_PATTERN.match(self.email)):
             v = False
             self.errors.add('email', 'email is invalid')
-        if self._does_email_exist():
+        if check_email and self._does_email_exist():
             v = False
-            self.errors.add('email', 'email has already been taken')
+            self._add_email_taken_error()
 
         good_password = True
         if self.id:
@@ -167,24 +187,37 @@ class User:
         #     print(f'Invalid: {self}. {self.errors}')
         return v
 
-    def _check_email_unique_and_insert(self, client, key):
-        # print(f'{self.name}: {self.email}登録開始')
+    def _add_email_taken_error(self):
+        self.errors.add('email', 'email has already been taken')
+
+    # 他の項目が不正で保存しない時も、emailアドレスが使われていることを
+    # 他のエラーと一緒に表示できるようtransactionの外で確かめる
+    def _add_email_taken_error_if_exists(self):
+        if self.email and self._does_email_exist():
+            self._add_email_taken_error()
+
+    def _check_email_unique(self, backend, email):
         # emailアドレスが既に登録されているか確認
-        entity = client.get(key)
-        # print(f'{self.name}: メール登録済みかを確認')
+        entity = backend.get(User.KIND_EMAILS, email)
         if entity is not None:
-            # 既に登録済み
-            # print(f'{self.name}: {self.email}は既に使用されている')
+            self._add_email_taken_error()
             return False
+        return True
 
-        # emailアドレスを登録
-        entity = datastore.Entity(key=key)
+    # emailアドレスを登録する。ログインなどでemailアドレスからユーザーを
+    # キーで引けるようユーザーのidも保存する(find_by_email)
+    def _insert_email(self, backend, email, user_id):
+        entity = database.Entity(User.KIND_EMAILS, email)
+        entity['user_id'] = user_id
         entity['created_at'] = datetime.now(timezone.utc)
-        # print(f'{self.name}: メール登録開始')
-        client.put(entity)
-        return True
+        backend.put(entity)
+        identity_map.invalidate(User.KIND_EMAILS, email)
 
-    def _insert_or_update_user(self, client, user):
+    def _delete_email(self, backend, email):
+        backend.delete(User.KIND_EMAILS, email)
+        identity_map.invalidate(User.KIND_EMAILS, email)
+
+    def _insert_or_update_user(self, backend, user):
         t = datetime.now(timezone.utc)
         user['name'] =  self.name
         user['email'] = self.email
@@ -201,21 +234,23 @@ class User:
         user['reset_digest'] = self.reset_digest
         user['reset_sent_at'] = self.reset_sent_at
 
-        client.put(user)
+        backend.put(user)
+        identity_map.invalidate(User.KIND_USERS, user.id)
         self.created_at = user['created_at']
         self.updated_at = user['updated_at']
         return user
 
     @create_activation_digest
     def _insert(self):
-        client = datastore.Client()
+        backend = database.get_backend()
         try:
-            with client.transaction():
-                email_key = client.key(User.KIND_EMAILS, self.email)
-                user_key = client.key(User.KIND_USERS)
-                user = datastore.Entity(user_key)
-                if self._check_email_unique_and_insert(client, email_key):
-                    user = self._insert_or_update_user(client, user)
+            with backend.transaction():
+                user = database.Entity(User.KIND_USERS)
+                if self._check_email_unique(backend, self.email):
+                    # idはputした時に割り当てられるのでユーザーを先に保存する
+                    user = self._insert_or_update_user(backend, user)
+                    self._insert_email(backend, self.email, user.id)
+                    Counter.increment(Counter.kind_name(User.KIND_USERS))
                 else:
                     return False
         except Aborted as e:
@@ -225,28 +260,26 @@ class User:
             return False
 
         # transactionの外で行うこと
-        self.id = user.key.id
+        self.id = user.id
 
         # print(f'{self.name}: ユーザー登録終了')
         return True
 
     def _update(self):
-        client = datastore.Client()
-        user_key = client.key(User.KIND_USERS, self.id)
-        user = client.get(user_key)
+        backend = database.get_backend()
+        user = backend.get(User.KIND_USERS, self.id)
         if self.email != user['email']:
             # print('update: メールアドレスが違う')
-            email_key = client.key(User.KIND_EMAILS, user['email'])
             try:
-                with client.transaction():
-                    # メールアドレスを削除
-                    client.delete(email_key)
+                with backend.transaction():
                     # 新しいメールアドレスをチェックしてユーザー情報をアップデート
-                    email_key = client.key(User.KIND_EMAILS, self.email)
-                    if self._check_email_unique_and_insert(client, email_key):
-                        self._insert_or_update_user(client, user)
-                    else:
+                    # 使われていた時は何も書き込まずに終える
+                    if not self._check_email_unique(backend, self.email):
                         return False
+                    # メールアドレスを削除
+                    self._delete_email(backend, user['email'])
+                    self._insert_or_update_user(backend, user)
+                    self._insert_email(backend, self.email, self.id)
             except Aborted as e:
                 # transaction競合のため失敗
                 # print(f'{self.name}: 例外発生: {type(e)} {e}')
@@ -254,7 +287,7 @@ class User:
                 return False
         else:
             # print('update: メールアドレスが同じ')
-            self._insert_or_update_user(client, user)
+            self._insert_or_update_user(backend, user)
         return True
 
     def save(self):
@@ -263,7 +296,9 @@ class User:
             self.email = self.email.lower()
 
         # user属性の有効性をチェックする
-        if not self.valid():
+        # emailアドレスの重複は保存するtransactionの中で確認する
+        if not self.valid(check_email=False):
+            self._add_email_taken_error_if_exists()
             return False
 
         # password_digest を作成
@@ -312,7 +347,8 @@ class User:
                 raise AttributeError(f'{k} key is bad')
 
         # 変更する属性の有効性をチェックする
-        if not temp.valid():
+        if not temp.valid(check_email=False):
+            temp._add_email_taken_error_if_exists()
             self.errors = temp.errors
             return False
 
@@ -330,6 +366,8 @@ class User:
                 self.admin = temp.admin
                 return True
             else:
+                # emailアドレスが使われていた時のエラー
+                self.errors = temp.errors
                 return False
         return True
 
@@ -434,89 +472,109 @@ class User:
         self.reset_digest = user.reset_digest
         self.reset_sent_at = user.reset_sent_at
         self.errors = user.errors
+        self._followed_id_set = None
         return self
 
     def destroy(self):
-        client = datastore.Client()
-        email_key = client.key(User.KIND_EMAILS, self.email)
-        user_key = client.key(User.KIND_USERS, self.id)
-        with client.transaction():
-            client.delete(email_key)
-            client.delete(user_key)
-        # 1つのtransactionにたくさんの処理を入れられないようなので、transactionから外す
-        for m in self.microposts():
-            m.destroy()
-        for r in relationship.Relationship.find_by(follower_id=self.id):
-            r.destroy()
-        for r in relationship.Relationship.find_by(followed_id=self.id):
-            r.destroy()
+        backend = database.get_backend()
+        with backend.transaction():
+            # 既に削除されていたらカウンタを減らさない
+            if backend.get(User.KIND_USERS, self.id) is None:
+                return self
+            self._delete_email(backend, self.email)
+            backend.delete(User.KIND_USERS, self.id)
+            identity_map.invalidate(User.KIND_USERS, self.id)
+            Counter.increment(Counter.kind_name(User.KIND_USERS), -1)
+            # micropostやrelationshipの削除は件数に比例して時間がかかるので
+            # 同じtransactionでジョブを作り、バックグラウンドでまとめて削除する
+            user_deletion.schedule(self.id)
+        user_deletion.start(self.id)
         return self
 
+    # emailアドレスからユーザーを探す
+    # emailsのエンティティとユーザーをキーで読むので常に最新の状態が読める
+    # (usersへのクエリは登録直後のユーザーを返さないことがある)
+    @staticmethod
+    def find_by_email(email):
+        if not email:
+            return None
+        email = email.lower()
+        entity = identity_map.get(User.KIND_EMAILS, email)
+        if entity is None:
+            return None
+        user_id = entity.get('user_id')
+        if user_id is None:
+            # ユーザーのidを保存する前に登録されたemailアドレス
+            users = User.find_by(email=email)
+            return users[0] if users else None
+        user = User.find(user_id)
+        if user is None or user.email != email:
+            return None
+        return user
+
     @staticmethod
     def find(id):
         if id is None:
             return None
-        client = datastore.Client()
-        key = client.key(User.KIND_USERS, id)
-        entity = client.get(key)
+        # 同じリクエスト内で読み出し済みならデータストアを読まない
+        entity = identity_map.get(User.KIND_USERS, id)
         if entity is None:
             return None
-        user = User(id=entity.key.id, **entity)
+        user = User(id=entity.id, **entity)
         return user
 
+    # idsの順にユーザーを返す。存在しないidは飛ばす
+    @staticmethod
+    def find_multi(ids):
+        if not ids:
+            return []
+        entities = identity_map.get_multi(User.KIND_USERS, ids)
+        return [User(id=entity.id, **entity) for entity in entities
+                if entity is not None]
+
     @staticmethod
     def find_by(**kwargs):
         if not kwargs:
             return []
-        client = datastore.Client()
-        query = client.query(kind=User.KIND_USERS)
+        backend = database.get_backend()
+        filters = []
         for k,v in kwargs.items():
             if k == 'email':
                 v = v.lower()
-            query.add_filter(k, '=', v)
-        entities = list(query.fetch())
-        users = [User(id=entity.key.id, **entity) for entity in entities]
+            filters.append((k, '=', v))
+        entities = backend.query(User.KIND_USERS, filters=filters)
+        users = [User(id=entity.id, **entity) for entity in entities]
         return users
 
     @staticmethod
     def all():
-        client = datastore.Client()
-        query = client.query(kind=User.KIND_USERS)
-        query.order = ['created_at']
-        entities = list(query.fetch())
-        users = [User(id=entity.key.id, **entity) for entity in entities]
+        backend = database.get_backend()
+        entities = backend.query(User.KIND_USERS, order=['created_at'])
+        users = [User(id=entity.id, **entity) for entity in entities]
         return users
 
+    # 登録順にlimit人ずつ読み出す。offsetを使わずカーソルの位置から読むので
+    # ユーザー数に関係なく1ページ分の読み出しで済む
     @staticmethod
-    def paginate(page=None):
-        if page is None:
-            page = 1
-        elif page < 1:
-            raise IndexError('paginate: page must be greater than or equal to 1')
-        limit = 30
-        offset = (page-1)*limit
-        client = datastore.Client()
-        query = client.query(kind=User.KIND_USERS)
-        query.order = ['created_at']
-        entities = list(query.fetch(limit=limit, offset=offset))
-        users = [User(id=entity.key.id, **entity) for entity in entities]
-        return users
-
+    def paginate(cursor=None, limit=30):
+        entities = keyset.page(User.KIND_USERS, limit=limit, cursor=cursor)
+        return keyset.Page([User(id=entity.id, **entity) for entity in entities],
+                           next_cursor=entities.next_cursor,
+                           prev_cursor=entities.prev_cursor)
+
+    # 統計情報(__Stat_Kind__)はリアルタイムで反映されないので使用できない
+    # 登録・削除時にtransaction内で更新しているカウンタを読む
+    # exact=Falseの時はプロセス内に一定時間キャッシュした値を返す
     @staticmethod
-    def count():
-        # 統計情報はリアルタイムで反映されないので使用できない
-        # client = datastore.Client()
-        # key = client.key('__Stat_Kind__', 'emails')
-        # entity = client.get(key)
-        # if entity is not None:
-        #     count = entity.get('count')
-        #     if count is not None:
-        #         return count
-        users = User.all()
-        return len(users)
+    def count(exact=True):
+        name = Counter.kind_name(User.KIND_USERS)
+        if exact:
+            return Counter.get(name)
+        return Counter.get_cached(name)
 
+    # 照合はプロセスのプールで行う。混んでいる時はpassword_hashing.Saturated
     def authenticate(self, p):
-        if check_password_hash(self.password_digest, p):
+        if password_hashing.check_password(self.password_digest, p):
             return self
         return None
 
@@ -528,22 +586,99 @@ class User:
             digest = self.activation_digest
         elif attribute == 'reset':
             digest = self.reset_digest
-        if not digest:
+        if not digest or not token:
+            return False
+        if digest.startswith(User.TOKEN_DIGEST_METHOD + '$'):
+            return User._check_token_digest(digest, token)
+        # 以前の形式(PBKDF2)は遅いので、一致したら新しい形式に置き換える
+        if not password_hashing.check_password(digest, token):
             return False
-        return check_password_hash(digest, token)
+        self.update_attribute(f'{attribute}_digest', User.token_digest(token))
+        return True
 
+    # passwordのdigest。総当りに時間がかかるよう意図的に遅いのでプロセスのプールで計算する
     @staticmethod
     def digest(string):
-        return generate_password_hash(string)
+        return password_hashing.hash_password(string)
+
+    # tokenは十分な長さの乱数なので遅いhashは必要無い
+    # 鍵付きのSHA-256で作り、一致するかは一定時間で比べる
+    @staticmethod
+    def token_digest(token):
+        selector = User._token_selector(token)
+        mac = hmac.new(User._token_key(), token.encode('utf-8'),
+                       hashlib.sha256).hexdigest()
+        return f'{User.TOKEN_DIGEST_METHOD}${selector}${mac}'
+
+    @staticmethod
+    def _check_token_digest(digest, token):
+        parts = digest.split('$')
+        if len(parts) != 3:
+            return False
+        selector = parts[1]
+        # selectorが違うものは別のtokenなのでhashを計算せずに拒否する
+        if selector != User._token_selector(token):
+            return False
+        return hmac.compare_digest(digest, User.token_digest(token))
 
+    # tokenは selector.verifier の形式。以前のtokenにselectorは無い
     @staticmethod
-    def new_token():
-        token = secrets.token_urlsafe()
+    def _token_selector(token):
+        selector, sep, _ = token.partition('.')
+        return selector if sep else ''
+
+    @staticmethod
+    def _token_key():
+        # アプリのコンテキスト外(スクリプトなど)では環境変数から読む
+        if has_app_context():
+            key = current_app.secret_key
+        else:
+            key = os.environ.get('SAMPLEAPP_SECRET_KEY', 'dev')
+        if isinstance(key, str):
+            key = key.encode('utf-8')
+        return key
+
+    @staticmethod
+    def new_token(selector=None):
+        if selector is None:
+            selector = secrets.token_urlsafe(9)
+        verifier = secrets.token_urlsafe()
+        return f'{selector}.{verifier}'
+
+    # 発行したtokenのselector。メールのキューにはtokenの代わりにこれを入れる
+    def token_selector(self, attribute):
+        token = getattr(self, f'{attribute}_token')
+        return User._token_selector(token) if token else ''
+
+    # メールのキューから呼ぶ。selectorのtokenがまだ使えるなら同じselectorで
+    # tokenを発行し直して返す。使えない時はNoneを返す
+    # 他のメールのworkerと同時に書き込んでも消し合わないよう、読み直して
+    # digestだけを書き換える
+    def reissue_token(self, attribute, selector):
+        backend = database.get_backend()
+        field = f'{attribute}_digest'
+        token = User.new_token(selector)
+        # 競合した時のAbortedはそのまま送出し、メールは後で送り直す
+        with backend.transaction():
+            entity = backend.get(User.KIND_USERS, self.id)
+            if entity is None:
+                return None
+            digest = entity.get(field) or ''
+            if not selector or \
+               digest.split('$')[:2] != [User.TOKEN_DIGEST_METHOD, selector]:
+                return None
+            if attribute == 'activation' and entity.get('activated'):
+                return None
+            entity[field] = User.token_digest(token)
+            backend.put(entity)
+        identity_map.invalidate(User.KIND_USERS, self.id)
+        setattr(self, field, entity[field])
+        setattr(self, f'{attribute}_token', token)
         return token
 
     def remember(self):
         self.remember_token = User.new_token()
-        digest = User.digest(self.remember_token)
+        digest = User.token_digest(self.remember_token)
         self.update_attribute('remember_digest', digest)
 
     def forget(self):
@@ -555,41 +690,33 @@ class User:
         self.update_attribute('activated_at', datetime.now(timezone.utc))
 
     # 有効化用のメールを送信する
+    # メールはキューに入れてバックグラウンドで送る
     def send_activation_email(self, app):
-        msg = user_mailer.account_activation(self)
-        mail = Mail(app)
-        mail.send(msg)
+        mail_queue.deliver_later(app, 'account_activation', self)
 
     # パスワード再設定の属性を設定する
     def create_reset_digest(self):
         self.reset_token = User.new_token()
-        self.update_attribute('reset_digest',  User.digest(self.reset_token))
+        self.update_attribute('reset_digest',  User.token_digest(self.reset_token))
         self.update_attribute('reset_sent_at', datetime.now(timezone.utc))
 
     # パスワード再設定のメールを送信する
     def send_password_reset_email(self, app):
-        msg = user_mailer.password_reset(self)
-        mail = Mail(app)
-        mail.send(msg)
+        mail_queue.deliver_later(app, 'password_reset', self)
 
     def password_reset_expired(self):
         dt = datetime.now(timezone.utc) - self.reset_sent_at
         return 2*60*60 < dt.total_seconds()
 
-    def feed(self):
-        feed = []
-        # 自分のmicroposts
-        feed += self.microposts()
-        # フォローしている人のmicroposts
-        for u in self.following():
-            feed += u.microposts()
-        feed.sort(key=lambda x: x.created_at, reverse=True)
-        return feed
+    # 自分とフォローしている人のmicropostsを新しい順に返す
+    # limitを指定した時はcursorの位置から1ページ分だけ読み出す
+    # 戻り値のnext_cursor, prev_cursorで前後のページを読み出せる
+    def feed(self, limit=None, cursor=None):
+        return fd.page(self.id, limit=limit, cursor=cursor)
 
     def _does_email_exist(self):
-        client = datastore.Client()
-        users = self.find_by(email=self.email)
-        if len(users) == 0 or users[0].id == self.id:
+        user = User.find_by_email(self.email)
+        if user is None or user.id == self.id:
             return False
         return True
 
@@ -602,44 +729,62 @@ class User:
                                          followed_id=followed_id)
 
     def active_relationships_find_by(self, followed_id):
-        r = relationship.Relationship.find_by(follower_id=self.id,
-                                              followed_id=followed_id)
-        if r:
-            return r[0]
-        else:
-            return None
+        return relationship.Relationship.find_by_users(self.id, followed_id)
 
     def following(self):
         rs = relationship.Relationship.find_by(follower_id=self.id)
-        if rs:
-            return [User.find(r.followed_id) for r in rs]
-        else:
-            return []
+        return User.find_multi([r.followed_id for r in rs])
 
     def followers(self):
         rs = relationship.Relationship.find_by(followed_id=self.id)
-        if rs:
-            return [User.find(r.follower_id) for r in rs]
-        else:
-            return []
+        return User.find_multi([r.follower_id for r in rs])
+
+    # following, followers, micropostsの件数を1回のget_multiで読み出す
+    def counts(self):
+        names = {field: Counter.name(User.KIND_USERS, self.id, field)
+                 for field in User.COUNTERS}
+        counts = Counter.get_multi(list(names.values()))
+        return {field: counts[name] for field, name in names.items()}
+
+    def following_count(self):
+        return Counter.get(Counter.name(User.KIND_USERS, self.id, 'following'))
+
+    def followers_count(self):
+        return Counter.get(Counter.name(User.KIND_USERS, self.id, 'followers'))
 
     def follow(self, other_user):
         self.active_relationships_create(other_user.id)
+        self._followed_id_set = None
 
     def unfollow(self, other_user):
-        rs = relationship.Relationship.find_by(follower_id=self.id,
-                                              followed_id=other_user.id)
-        if rs:
-            for r in rs:
-                r.destroy()
+        r = relationship.Relationship.find_by_users(self.id, other_user.id)
+        if r:
+            r.destroy()
+        self._followed_id_set = None
+
+    # フォローしているユーザーのidの集合
+    # current_userはリクエストごとに1つなので、follow_formを何人分表示しても
+    # 読み出しは1回のkeys_onlyのクエリで済む
+    # 多くの人をフォローしている時はNoneを返す
+    def _followed_ids(self):
+        if self._followed_id_set is None:
+            ids = relationship.Relationship.followed_ids(
+                self.id, limit=User.MAX_FOLLOWED_IDS + 1)
+            if len(ids) <= User.MAX_FOLLOWED_IDS:
+                self._followed_id_set = frozenset(ids)
+            else:
+                # 多すぎるので読まなかったことを覚えておく
+                self._followed_id_set = False
+        if self._followed_id_set is False:
+            return None
+        return self._followed_id_set
 
     def is_following(self, other_user):
-        rs = relationship.Relationship.find_by(follower_id=self.id,
-                                              followed_id=other_user.id)
-        if rs:
-            return True
-        else:
-            return False
+        ids = self._followed_ids()
+        if ids is not None:
+            return other_user.id in ids
+        r = relationship.Relationship.find_by_users(self.id, other_user.id)
+        return r is not None
 # end of User class
 
 class MyMicroposts():
@@ -661,6 +806,7 @@ class MyMicroposts():
         if m and self._microposts:
             # キャッシュに追加
             self._microposts.insert(0, m)
+        if m and self._count is not None:
             self._count += 1
         return m
 
@@ -670,7 +816,10 @@ class MyMicroposts():
         return ms
 
     def count(self):
-        self._get_microposts()
+        if self._count is None:
+            # micropostsを読まずにカウンタから件数を得る
+            name = Counter.name(User.KIND_USERS, self._user.id, 'microposts')
+            self._count = Counter.get(name)
         return self._count
 
     def reset(self):
@@ -0,0 +1,205 @@
+import concurrent.futures
+import logging
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+from . import database
+from . import micropost as mpost
+from . import relationship
+from . import timeline
+from .counter import Counter
+
+# ユーザーを削除した後の関連するデータの削除(cascade)をバックグラウンドで行う
+# ユーザーの削除と同じtransactionでKIND_USER_DELETIONSにジョブを作り、
+# 以下の段階(STAGES)の順にBATCH件ずつまとめて削除する
+#   microposts: micropost(タイムラインのエントリと画像も)
+#   following:  ユーザーがフォローしているrelationship
+#   followers:  ユーザーをフォローしているrelationship
+#   timeline:   ユーザーのタイムライン
+#   counters:   ユーザーのカウンタ
+# 削除したものはクエリに現れないので、ジョブには今の段階だけを保存すれば
+# 途中でプロセスが落ちてもその段階の残りから再開できる
+# 実行中のジョブはLEASE秒ごとに延長し、期限の切れたジョブはresumeで再開する
+# (各workerでRESUME_INTERVAL秒ごとにresumeを実行する)
+# ジョブは専用のthread(MAX_WORKERS個)で順に実行し、画像のアップロードなどの
+# バックグラウンドの処理を待たせない
+
+KIND_USER_DELETIONS = 'user_deletions'
+
+STAGES = ('microposts', 'following', 'followers', 'timeline', 'counters')
+BATCH = 500
+LEASE = 5 * 60
+MAX_WORKERS = 1
+RESUME_INTERVAL = LEASE
+
+_logger = logging.getLogger(__name__)
+
+_executor = None
+_pid = None
+_resumer_pid = None
+_lock = threading.Lock()
+_pending = set()
+_wakeup = threading.Event()
+
+def _get_executor():
+    global _executor, _pid
+    # fork後の子プロセスには親のthreadが無いので作り直す
+    if _executor is None or _pid != os.getpid():
+        with _lock:
+            if _executor is None or _pid != os.getpid():
+                _executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=MAX_WORKERS, thread_name_prefix='user-deletion')
+                _pid = os.getpid()
+                _pending.clear()
+    return _executor
+
+def _submit(user_id, leased=False):
+    future = _get_executor().submit(run, user_id, leased)
+    with _lock:
+        _pending.add(future)
+    future.add_done_callback(_discard)
+    return future
+
+def _discard(future):
+    with _lock:
+        _pending.discard(future)
+
+# ユーザーを削除するtransactionの中で呼ぶ
+def schedule(user_id):
+    entity = database.Entity(KIND_USER_DELETIONS, user_id)
+    now = datetime.now(timezone.utc)
+    entity['stage'] = STAGES[0]
+    entity['deleted'] = 0
+    # 作成したプロセスがすぐに実行するので、その間は他から再開しない
+    entity['lease_until'] = now + timedelta(seconds=LEASE)
+    entity['created_at'] = now
+    entity['updated_at'] = now
+    database.get_backend().put(entity)
+
+# transactionの後でバックグラウンドのthreadで実行する
+def start(user_id):
+    return _submit(user_id, True)
+
+# ジョブを実行する。leasedは既に実行する権利を持っている時(schedule直後)
+def run(user_id, leased=False):
+    backend = database.get_backend()
+    job = _claim(user_id, leased)
+    if job is None:
+        return False
+    try:
+        for stage in STAGES[STAGES.index(job['stage']):]:
+            if job['stage'] != stage:
+                job['stage'] = stage
+                _save(job)
+            while True:
+                n = _STAGES[stage](user_id)
+                if n == 0:
+                    break
+                job['deleted'] += n
+                # 進み具合を保存して期限を延長する
+                _save(job)
+        backend.delete(KIND_USER_DELETIONS, user_id)
+        return True
+    except Exception:
+        _logger.exception('failed to delete data of user %s', user_id)
+        raise
+
+def _claim(user_id, leased):
+    backend = database.get_backend()
+    try:
+        with backend.transaction():
+            job = backend.get(KIND_USER_DELETIONS, user_id)
+            if job is None:
+                return None
+            now = datetime.now(timezone.utc)
+            if not leased and now < job['lease_until']:
+                # 他のthreadかプロセスが実行中
+                return None
+            job['lease_until'] = now + timedelta(seconds=LEASE)
+            backend.put(job)
+            return job
+    except database.Aborted:
+        return None
+
+def _save(job):
+    now = datetime.now(timezone.utc)
+    job['lease_until'] = now + timedelta(seconds=LEASE)
+    job['updated_at'] = now
+    database.get_backend().put(job)
+
+def _delete_microposts(user_id):
+    backend = database.get_backend()
+    # 画像の情報が必要なのでエンティティごと読む
+    entities = backend.query(mpost.Micropost.KIND_MICROPOSTS,
+                             filters=[('user_id', '=', user_id)], limit=BATCH)
+    microposts = [mpost.Micropost(id=e.id, **e) for e in entities]
+    mpost.Micropost.delete_all(microposts)
+    return len(microposts)
+
+def _delete_relationships(field, user_id):
+    backend = database.get_backend()
+    entities = backend.query(relationship.Relationship.KIND_RELATIONSHIPS,
+                             filters=[(field, '=', user_id)], limit=BATCH,
+                             keys_only=True)
+    ids = [e.id for e in entities]
+    relationship.Relationship.delete_multi(ids, deleted_user_id=user_id)
+    return len(ids)
+
+def _delete_counters(user_id):
+    from .user import User
+    Counter.delete([Counter.name(User.KIND_USERS, user_id, field)
+                    for field in User.COUNTERS])
+    return 0
+
+_STAGES = {
+    'microposts': _delete_microposts,
+    'following': lambda user_id: _delete_relationships('follower_id', user_id),
+    'followers': lambda user_id: _delete_relationships('followed_id', user_id),
+    'timeline': lambda user_id: timeline.Timeline.clear(user_id, limit=BATCH),
+    'counters': _delete_counters,
+}
+
+# 期限の切れたジョブ(実行中にプロセスが落ちたもの)を再開する
+def resume():
+    backend = database.get_backend()
+    now = datetime.now(timezone.utc)
+    jobs = backend.query(KIND_USER_DELETIONS,
+                         filters=[('lease_until', '<=', now)], keys_only=True)
+    return [_submit(job.id) for job in jobs]
+
+def _resume_periodically():
+    while True:
+        try:
+            resume()
+        except Exception:
+            _logger.exception('failed to resume user deletions')
+        _wakeup.wait(RESUME_INTERVAL)
+        _wakeup.clear()
+
+# 中断したジョブや失敗したジョブを定期的に再開するthreadを起動する
+# fork後の子プロセスには親のthreadが無いので起動し直す
+def start_resumer():
+    global _resumer_pid
+    with _lock:
+        if _resumer_pid == os.getpid():
+            return
+        _resumer_pid = os.getpid()
+    thread = threading.Thread(target=_resume_periodically,
+                              name='user-deletion-resumer', daemon=True)
+    thread.start()
+
+# アプリの作成時に起動する。preloadでmasterプロセスが起動した時は、
+# fork後のworkerの最初のリクエストで起動する
+def init_app(app):
+    start_resumer()
+
+    @app.before_request
+    def start_user_deletion_resumer():
+        if _resumer_pid != os.getpid():
+            start_resumer()
+
+# 実行中のジョブが終わるまで待つ。テストで使う
+def wait(timeout=None):
+    with _lock:
+        futures = list(_pending)
+    concurrent.futures.wait(futures, timeout=timeout)
@@ -75,6 +75,47 @@
         }
     }
 
+    // 画像をアプリを経由せずにストレージへ直接アップロードする
+    // 署名付きURLを受け取ってPUTで送り、フォームにはblob名だけを入れて投稿する
+    // 途中で失敗した時はこれまで通りフォームで画像を送る
+    let form = element && element.form;
+    if (form && form.getAttribute('data-direct-upload')) {
+        form.onsubmit = function(e) {
+            let file = element.files[0];
+            let blob_input = form.querySelector('input[name="image_blob"]');
+            if (!file || !blob_input || blob_input.value) {
+                return true;
+            }
+            let body = new FormData();
+            body.append('authenticity_token',
+                        form.querySelector('input[name="authenticity_token"]').value);
+            body.append('content_type', file.type);
+            body.append('size', file.size);
+            fetch(form.getAttribute('data-direct-upload'), {
+                method: 'POST', body: body, credentials: 'same-origin',
+                headers: {'Accept': 'application/json'}
+            }).then(function(res) {
+                if (!res.ok) throw new Error(res.status);
+                return res.json();
+            }).then(function(upload) {
+                return fetch(upload.url, {
+                    method: upload.method, headers: upload.headers, body: file
+                }).then(function(res) {
+                    if (!res.ok) throw new Error(res.status);
+                    return upload;
+                });
+            }).then(function(upload) {
+                blob_input.value = upload.blob_name;
+                // 画像の内容はフォームでは送らない
+                element.value = '';
+                form.submit();
+            }).catch(function() {
+                form.submit();
+            });
+            return false;
+        }
+    }
+
     // Ajaxで非同期通信でユーザーのフォロー・アンフォローを行う。
     // RailsではJavaScriptのコードを受取り動的に実行しているが、ここでは
     // 単にJSONデータを受取りそれに基づいてhtmlを書き換えることにする。
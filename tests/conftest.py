@@ -3,6 +3,7 @@ from sampleapp import create_app
 from sampleapp.models.user import User
 from sampleapp.models.micropost import Micropost
 from sampleapp.models.relationship import Relationship
+from sampleapp.models import user_deletion
 import yaml
 from datetime import datetime, timezone
 from faker import Faker
@@ -47,6 +48,8 @@ def test_users():
     finally:
         for user in test_users.values():
             user.destroy()
+        # 関連するデータの削除が終わるまで待つ
+        user_deletion.wait()
 
 @pytest.fixture
 def test_microposts(test_users):
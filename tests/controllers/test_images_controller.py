@@ -0,0 +1,128 @@
+import io
+import os
+import time
+import PIL.Image
+import pytest
+from urllib.parse import urlsplit
+from common import log_in_as
+from sampleapp.models import image_storage, uploads
+from sampleapp.models.micropost import Micropost
+
+@pytest.fixture
+def storage(tmp_path):
+    storage = image_storage.LocalStorage(tmp_path, secret_key='secret')
+    old = image_storage.get_storage()
+    image_storage.set_storage(storage)
+    yield storage
+    image_storage.set_storage(old)
+
+def test_show_serves_local_blob_with_cache_headers(client, storage):
+    storage.put('images/abc.png', io.BytesIO(b'0123456789'), 'image/png')
+    url = storage.url('images/abc.png')
+    assert url == '/images/images/abc.png'
+
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.data == b'0123456789'
+    assert response.mimetype == 'image/png'
+    assert 'immutable' in response.headers['Cache-Control']
+    assert 'max-age=31536000' in response.headers['Cache-Control']
+    etag = response.headers['ETag']
+    response.close()
+
+    response = client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 304
+
+    response = client.get(url, headers={'Range': 'bytes=2-4'})
+    assert response.status_code == 206
+    assert response.data == b'234'
+    response.close()
+
+def test_show_rejects_missing_and_outside_paths(client, storage):
+    assert client.get('/images/images/none.png').status_code == 404
+    assert client.get('/images/../../etc/passwd').status_code == 404
+    storage.delete('images/none.png')
+
+def png():
+    out = io.BytesIO()
+    PIL.Image.new('RGB', (10, 10), 'red').save(out, 'PNG')
+    return out.getvalue()
+
+def test_direct_upload(client, storage, test_users):
+    user = test_users['michael']
+    data = png()
+    with client:
+        log_in_as(client, user.email)
+        token = 'token'
+        with client.session_transaction() as sess:
+            sess['csrf_token'] = token
+        # 大きすぎるものには署名しない
+        response = client.post('/microposts/uploads',
+                               data={'authenticity_token': token,
+                                     'content_type': 'image/png',
+                                     'size': Micropost.MAX_IMAGE_SIZE + 1})
+        assert response.status_code == 422
+        response = client.post('/microposts/uploads',
+                               data={'authenticity_token': token,
+                                     'content_type': 'image/png',
+                                     'size': len(data)})
+        assert response.status_code == 200
+        upload = response.get_json()
+        blob_name = upload['blob_name']
+        assert blob_name.startswith(f'uploads/{user.id}/')
+        url = urlsplit(upload['url'])
+        path = f'{url.path}?{url.query}'
+
+        # 署名が正しくなければ受け付けない
+        response = client.put(path.replace('signature=', 'signature=0'),
+                              data=data, headers=upload['headers'])
+        assert response.status_code == 403
+        response = client.put(path, data=data,
+                              headers={'Content-Type': 'image/gif'})
+        assert response.status_code == 415
+        response = client.put(path, data=data, headers=upload['headers'])
+        assert response.status_code == 201
+        assert storage.stat(blob_name) == {'size': len(data),
+                                           'content_type': 'image/png'}
+
+        response = client.post('/microposts',
+                               data={'content': 'Lorem ipsum',
+                                     'image_blob': blob_name,
+                                     'authenticity_token': token})
+        assert response.status_code == 302
+    uploads.wait()
+    micropost = user.microposts()[0]
+    assert micropost.image_ready()
+    assert micropost.image['blob_name'] == \
+        f'images/{micropost.image["sha256"]}.png'
+    assert storage.get(micropost.image['blob_name']) == data
+    # 置き場所のblobは取り込んだ後に削除される
+    assert storage.stat(blob_name) is None
+    micropost.destroy()
+
+def test_direct_upload_of_other_user_is_rejected(storage, test_users):
+    michael = test_users['michael']
+    archer = test_users['archer']
+    upload = Micropost.signed_image_upload(archer.id, 'image/png', 10)
+    storage.put(upload['blob_name'], io.BytesIO(png()), 'image/png')
+    micropost = michael.microposts.build(content='Lorem ipsum')
+    micropost.image_attach_upload(upload['blob_name'])
+    assert not micropost.save()
+    assert 'image' in micropost.errors.messages
+    storage.delete(upload['blob_name'])
+
+def test_sweep_uploads_deletes_abandoned_uploads(storage, test_users):
+    archer = test_users['archer']
+    old = Micropost.signed_image_upload(archer.id, 'image/png', 10)['blob_name']
+    new = Micropost.signed_image_upload(archer.id, 'image/png', 10)['blob_name']
+    for blob_name in (old, new):
+        storage.put(blob_name, io.BytesIO(png()), 'image/png')
+    storage.put('images/abc.png', io.BytesIO(png()), 'image/png')
+    # フォームが送信されないまま1日以上経った
+    expired = time.time() - 2*24*60*60
+    os.utime(storage.path(old), (expired, expired))
+    os.utime(storage.path('images/abc.png'), (expired, expired))
+    assert Micropost.sweep_uploads() == 1
+    assert storage.stat(old) is None
+    assert storage.stat(new) is not None
+    assert storage.stat('images/abc.png') is not None
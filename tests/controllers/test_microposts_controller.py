@@ -1,7 +1,7 @@
 from flask import render_template, url_for
 from sampleapp.models.micropost import Micropost
 from common import are_same_templates, log_in_as
-from flask_paginate import Pagination
+from sampleapp.helpers.application_helper import CursorPagination
 
 def test_should_redirect_create_when_not_logged_in(client):
     with client:
@@ -57,16 +57,9 @@ def test_should_redirect_destroy_for_wrong_micropost(client,
         assert before_count == after_count
         # home画面にredirectされていることを確認
         micropost = user.microposts.build()
-        feed_items = user.feed()
-        page = 1
         per_page = 30
-        total = len(feed_items)
-        feed_items = feed_items[(page-1)*per_page:page*per_page]
-        pagination = Pagination(
-            page=page, total=total, per_page=per_page,
-            href=url_for('static_pages.home')+'?page={0}',
-            prev_label='&larr; Previous', next_label='Next &rarr;',
-            css_framework='bootstrap3')
+        feed_items = user.feed(limit=per_page)
+        pagination = CursorPagination(feed_items, url_for('static_pages.home'))
         ref = render_template('static_pages/home.html',
                               micropost=micropost, feed_items=feed_items,
                               pagination=pagination)
@@ -2,7 +2,7 @@ from common import log_in_as, are_same_templates
 import re
 from sampleapp.models.micropost import Micropost
 from flask import render_template, url_for
-from flask_paginate import Pagination
+from sampleapp.helpers.application_helper import CursorPagination
 
 def test_micropost_interface(client, test_users, test_microposts):
     user = test_users['michael']
@@ -28,7 +28,7 @@ def test_micropost_interface(client, test_users, test_microposts):
         assert before_count == after_count
         #print(f'\n{contents}\n')
         assert re.search('error_explanation', contents)
-        assert re.search(r'<a href="/\?page=2">', contents)
+        assert re.search(r'<a href="/\?cursor=[\w-]+">', contents)
         # 有効な送信
         before_count = Micropost.count()
         content = "This micropost really ties the room together"
@@ -43,16 +43,9 @@ def test_micropost_interface(client, test_users, test_microposts):
         assert before_count+1 == after_count
         # home画面にredirectされていることを確認
         micropost = user.microposts.build()
-        feed_items = user.feed()
-        page = 1
         per_page = 30
-        total = len(feed_items)
-        feed_items = feed_items[(page-1)*per_page:page*per_page]
-        pagination = Pagination(
-            page=page, total=total, per_page=per_page,
-            href=url_for('static_pages.home')+'?page={0}',
-            prev_label='&larr; Previous', next_label='Next &rarr;',
-            css_framework='bootstrap3')
+        feed_items = user.feed(limit=per_page)
+        pagination = CursorPagination(feed_items, url_for('static_pages.home'))
         ref = render_template('static_pages/home.html',
                               micropost=micropost, feed_items=feed_items,
                               pagination=pagination)
@@ -2,6 +2,7 @@ from flask import render_template, get_flashed_messages
 from common import AUTHENTICITY_TOKEN_PATTERN, are_same_templates, is_logged_in
 import re
 from flask_mail import Mail
+from sampleapp.mailers import mail_queue
 from sampleapp.models.user import User
 
 def test_password_resets(app, client, test_users):
@@ -42,6 +43,8 @@ def test_password_resets(app, client, test_users):
                 follow_redirects=True)
             contents = response.data.decode(encoding='utf-8')
             assert user.reset_digest != user.reload().reset_digest
+            # メールはバックグラウンドで送られる
+            assert mail_queue.wait(timeout=10)
             assert len(outbox) == 1
 
         flashed_message = get_flashed_messages()
@@ -1,6 +1,6 @@
-from flask import render_template, request
+from flask import render_template, url_for
 from common import are_same_templates, log_in_as
-from flask_paginate import Pagination
+from sampleapp.helpers.application_helper import CursorPagination
 from sampleapp.models.user import User
 import re
 
@@ -16,18 +16,8 @@ def test_index_as_admin_including_pagination_and_delete_links(client, test_users
         contents = response.data.decode(encoding='utf-8')
 
         # ユーザー一覧ページが表示されたことを確認
-        page = 1
-        per_page = 30
-        users = User.all()
-        total = len(users)
-        users = users[(page-1)*per_page:page*per_page]
-        # Pagination内でview_argsにアクセスしているがtest_clientコンテキストでは
-        # 存在しないのでエラーにならないようダミーを設定する
-        request.view_args = {}
-        pagination = Pagination(page=page, total=total, per_page=per_page,
-                                prev_label='&larr; Previous',
-                                next_label='Next &rarr;',
-                                css_framework='bootstrap3')
+        users = User.paginate()
+        pagination = CursorPagination(users, url_for('users.index'))
         ref = render_template('users/index.html', users=users, pagination=pagination)
         #print(f'\nref:\n{ref}\n\ncontents\n{contents}\n')
         assert are_same_templates(ref, contents)
@@ -36,7 +26,7 @@ def test_index_as_admin_including_pagination_and_delete_links(client, test_users
         assert re.search(r'class="pagination"', contents)
 
         # 最初のページに含まれるユーザーが表示されていることを確認
-        for user in User.paginate(page=page):
+        for user in User.paginate():
             assert re.search(f'<a href="/users/{user.id}">{user.name}', contents)
 
         # csrf tokenをsessionに設定する
@@ -4,6 +4,7 @@ from sampleapp.models.user import User
 from common import (is_logged_in, are_same_templates, AUTHENTICITY_TOKEN_PATTERN,
                     log_in_as)
 from flask_mail import Mail
+from sampleapp.mailers import mail_queue
 
 def test_invalid_signup_information(client):
     with client:
@@ -57,6 +58,8 @@ def test_valid_signup_information_with_account_activation(app, client):
                         'password_confirmation': user.password_confirmation,
                         'authenticity_token': token},
                     follow_redirects=True)
+                # メールはバックグラウンドで送られる
+                assert mail_queue.wait(timeout=10)
                 assert len(outbox) == 1
 
             # activation状態をデータベースから読み出す
@@ -0,0 +1,104 @@
+import re
+import pytest
+import flask_mail
+from flask_mail import Mail
+from sampleapp.mailers import mail_queue
+from sampleapp.models import database
+from sampleapp import create_app
+from sampleapp.models.user import User
+
+@pytest.fixture(autouse=True)
+def reset_connections():
+    # 前のテストでworkerが開いた接続を使わせない
+    mail_queue.reset()
+    yield
+    mail_queue.reset()
+
+def test_mails_are_sent_in_background(app, test_users, monkeypatch):
+    user = test_users['michael']
+    mail = Mail(app)
+    connections = []
+    enter = flask_mail.Connection.__enter__
+    def counting_enter(self):
+        connections.append(self)
+        return enter(self)
+    monkeypatch.setattr(flask_mail.Connection, '__enter__', counting_enter)
+    with mail.record_messages() as outbox:
+        with app.test_request_context('/'):
+            user.update_attribute('activated', False)
+            user.activation_token = User.new_token()
+            user.update_attribute('activation_digest',
+                                  User.token_digest(user.activation_token))
+            user.create_reset_digest()
+            mail_queue.deliver_later(app, 'account_activation', user)
+            mail_queue.deliver_later(app, 'password_reset', user)
+        assert mail_queue.wait(timeout=10)
+    assert sorted(m.subject for m in outbox) == \
+        ['Account activation', 'Password reset']
+    # tokenはキューに保存せず、workerが同じselectorで発行し直す
+    tokens = {'activation': user.activation_token, 'reset': user.reset_token}
+    entity = database.get_backend().get(User.KIND_USERS, user.id)
+    for attribute, token in tokens.items():
+        selector = token.split('.')[0]
+        assert not any(token in m.body for m in outbox)
+        m = re.search(rf'{re.escape(selector)}\.[\w-]+', ''.join(
+            m.body for m in outbox if selector in m.body))
+        assert entity[f'{attribute}_digest'] == User.token_digest(m.group(0))
+    # workerは接続を使い回す(前のテストで開いた接続が残っていればそれを使う)
+    assert len(connections) <= mail_queue.NUM_WORKERS
+    assert database.get_backend().query(mail_queue.KIND_MAIL_QUEUE) == []
+
+def test_superseded_mail_is_not_sent(app, test_users):
+    user = test_users['michael']
+    mail = Mail(app)
+    with mail.record_messages() as outbox:
+        with app.test_request_context('/'):
+            user.create_reset_digest()
+            old = user.reset_token.split('.')[0]
+            # 送る前にもう一度頼まれた時は新しい方だけを送る
+            user.create_reset_digest()
+            new = user.reset_token.split('.')[0]
+            mail_queue.deliver_later(app, 'password_reset', user)
+            user.reset_token = f'{old}.x'
+            mail_queue.deliver_later(app, 'password_reset', user)
+        assert mail_queue.wait(timeout=10)
+    assert len(outbox) == 1
+    assert new in outbox[0].body and old not in outbox[0].body
+
+def test_failed_mail_is_retried_later(app, test_users, monkeypatch):
+    user = test_users['michael']
+    def broken(user):
+        raise RuntimeError('template error')
+    monkeypatch.setitem(mail_queue.MAILERS, 'password_reset', broken)
+    with app.test_request_context('/'):
+        user.create_reset_digest()
+        id = mail_queue.deliver_later(app, 'password_reset', user)
+    assert mail_queue.wait(timeout=10)
+    backend = database.get_backend()
+    job = backend.get(mail_queue.KIND_MAIL_QUEUE, id)
+    assert job['attempts'] == 1
+    assert job['last_error'] == 'template error'
+    backend.delete(mail_queue.KIND_MAIL_QUEUE, id)
+
+def test_worker_survives_failed_mail_setup(app, test_users, monkeypatch):
+    user = test_users['michael']
+    def broken(app):
+        raise RuntimeError('mail is not configured')
+    monkeypatch.delitem(app.extensions, 'mail', raising=False)
+    monkeypatch.setattr(mail_queue, 'Mail', broken)
+    with app.test_request_context('/'):
+        user.create_reset_digest()
+        id = mail_queue.deliver_later(app, 'password_reset', user)
+    # 取り出したメールが数え終えられ、waitが返る
+    assert mail_queue.wait(timeout=10)
+    backend = database.get_backend()
+    job = backend.get(mail_queue.KIND_MAIL_QUEUE, id)
+    assert job['last_error'] == 'mail is not configured'
+    backend.delete(mail_queue.KIND_MAIL_QUEUE, id)
+
+def test_workers_start_with_the_app(monkeypatch):
+    # 再起動前にキューに入ったメールも新しいメールを待たずに送る
+    started = []
+    monkeypatch.setattr(mail_queue, 'start', started.append)
+    app = create_app({'TESTING': True})
+    assert started == [app]
@@ -0,0 +1,19 @@
+from sampleapp.models import clients
+
+def test_client_is_created_once_per_process():
+    clients.register('dummy', object)
+    before = clients.stats()['dummy']
+    c1 = clients.get('dummy')
+    c2 = clients.get('dummy')
+    assert c1 is c2
+    after = clients.stats()['dummy']
+    assert after['created'] - before['created'] <= 1
+    assert after['reused'] - before['reused'] >= 1
+
+def test_reset_recreates_client():
+    clients.register('dummy', object)
+    c1 = clients.get('dummy')
+    clients.reset()
+    c2 = clients.get('dummy')
+    assert c1 is not c2
+    assert 1 <= clients.stats()['dummy']['resets']
@@ -0,0 +1,59 @@
+from sampleapp.models.counter import Counter
+from sampleapp.models.user import User
+from sampleapp.models.micropost import Micropost
+
+def test_increment_and_get_multi():
+    names = ['test:1:a', 'test:1:b']
+    try:
+        for n in range(10):
+            Counter.increment(names[0])
+        Counter.increment(names[1], 3)
+        Counter.increment(names[1], -1)
+        assert Counter.get_multi(names) == {names[0]: 10, names[1]: 2}
+        Counter.reset(names[0], 5)
+        assert Counter.get(names[0]) == 5
+    finally:
+        Counter.delete(names)
+    assert Counter.get(names[0]) == 0
+
+def test_increment_multi(monkeypatch):
+    monkeypatch.setattr(Counter, 'MAX_BATCH', 2)
+    names = ['test:1:a', 'test:1:b', 'test:1:c']
+    try:
+        Counter.increment(names[0], 2)
+        Counter.increment_multi({names[0]: -1, names[1]: 3, names[2]: 0})
+        Counter.increment_multi({names[1]: 1, names[2]: -4})
+        assert Counter.get_multi(names) == \
+            {names[0]: 1, names[1]: 4, names[2]: -4}
+    finally:
+        Counter.delete(names)
+
+def test_user_counts(test_users, test_relationships):
+    michael = test_users['michael']
+    archer = test_users['archer']
+    counts = michael.counts()
+    assert counts['following'] == len(michael.following())
+    assert counts['followers'] == len(michael.followers())
+    before = archer.followers_count()
+    michael.follow(archer)
+    assert archer.followers_count() == before + 1
+    michael.unfollow(archer)
+    assert archer.followers_count() == before
+    m = michael.microposts.create(content='Lorem ipsum')
+    assert michael.counts()['microposts'] == 1
+    m.destroy()
+    m.destroy()
+    assert michael.counts()['microposts'] == 0
+
+def test_kind_counts(test_users):
+    michael = test_users['michael']
+    users = User.count()
+    microposts = Micropost.count()
+    assert users == len(User.all())
+    assert microposts == len(Micropost.all())
+    assert User.count(exact=False) == users
+    m = michael.microposts.create(content='Lorem ipsum')
+    assert Micropost.count() == microposts + 1
+    m.destroy()
+    m.destroy()
+    assert Micropost.count() == microposts
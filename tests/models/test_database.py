@@ -0,0 +1,79 @@
+import pytest
+from datetime import datetime, timedelta, timezone
+from sampleapp.models import database
+from sampleapp.models.database_memory import MemoryBackend
+from sampleapp.models.database_sqlite import SQLiteBackend
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def backend(request):
+    if request.param == 'memory':
+        backend = MemoryBackend()
+    else:
+        backend = SQLiteBackend(':memory:')
+    yield backend
+    backend.close()
+
+def test_put_and_get(backend):
+    t = datetime.now(timezone.utc)
+    entity = database.Entity('things', name='foo', created_at=t, flag=True)
+    backend.put(entity)
+    assert entity.id
+    got = backend.get('things', entity.id)
+    assert got.id == entity.id
+    assert got['name'] == 'foo'
+    assert got['created_at'] == t
+    assert got['flag'] is True
+    assert backend.get('things', entity.id + 1) is None
+
+def test_put_with_name_key(backend):
+    backend.put(database.Entity('emails', 'user@example.com', n=1))
+    assert backend.get('emails', 'user@example.com')['n'] == 1
+
+def test_delete(backend):
+    entity = backend.put(database.Entity('things', name='foo'))
+    backend.delete('things', entity.id)
+    assert backend.get('things', entity.id) is None
+    assert backend.query('things', filters=[('name', '=', 'foo')]) == []
+
+def test_query_filters_and_order(backend):
+    t = datetime.now(timezone.utc)
+    for n in range(5):
+        backend.put(database.Entity('things', owner=n % 2, n=n,
+                                    created_at=t + timedelta(minutes=n)))
+    things = backend.query('things', filters=[('owner', '=', 0)],
+                           order=['-created_at'])
+    assert [x['n'] for x in things] == [4, 2, 0]
+    things = backend.query('things', filters=[('n', '>=', 2)], order=['n'],
+                           limit=2, offset=1)
+    assert [x['n'] for x in things] == [3, 4]
+    first = backend.query('things', order=['n'])[0]
+    things = backend.query('things', filters=[(database.KEY, '=', first.id)])
+    assert [x['n'] for x in things] == [0]
+
+def test_count(backend):
+    for n in range(5):
+        backend.put(database.Entity('things', owner=n % 2, n=n))
+    assert backend.count('things') == 5
+    assert backend.count('things', filters=[('owner', '=', 1)]) == 2
+    assert backend.count('others') == 0
+
+def test_in_filter(backend):
+    for n in range(5):
+        backend.put(database.Entity('things', n=n))
+    things = backend.query('things', filters=[('n', 'IN', [1, 3, 7])],
+                           order=['n'])
+    assert [x['n'] for x in things] == [1, 3]
+    ids = [x.id for x in things]
+    things = backend.query('things', filters=[(database.KEY, 'IN', ids)])
+    assert sorted(x['n'] for x in things) == [1, 3]
+
+def test_transaction_rolls_back_on_error(backend):
+    entity = backend.put(database.Entity('things', name='foo'))
+    with pytest.raises(RuntimeError):
+        with backend.transaction():
+            entity['name'] = 'bar'
+            backend.put(entity)
+            backend.put(database.Entity('things', name='baz'))
+            raise RuntimeError()
+    assert backend.get('things', entity.id)['name'] == 'foo'
+    assert backend.query('things', filters=[('name', '=', 'baz')]) == []
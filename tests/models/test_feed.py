@@ -0,0 +1,33 @@
+import pytest
+from sampleapp.models import feed
+
+@pytest.fixture(params=[feed.TIMELINE, feed.MERGE])
+def strategy(request):
+    old = feed.get_strategy()
+    feed.set_strategy(request.param)
+    yield request.param
+    feed.set_strategy(old)
+
+def test_feed_is_paged_with_cursors(strategy, test_users, test_microposts,
+                                    test_relationships):
+    michael = test_users['michael']
+    everything = michael.feed()
+    assert everything[0] == test_microposts['most_recent']
+
+    pages = []
+    page = michael.feed(limit=7)
+    assert page.prev_cursor is None
+    while True:
+        pages.append(page)
+        if not page.next_cursor:
+            break
+        page = michael.feed(limit=7, cursor=page.next_cursor)
+    assert [m for p in pages for m in p] == everything
+
+    # 前のページに戻る
+    back = michael.feed(limit=7, cursor=pages[2].prev_cursor)
+    assert back == pages[1]
+
+def test_invalid_cursor_returns_first_page(test_users, test_microposts):
+    michael = test_users['michael']
+    assert michael.feed(limit=5, cursor='garbage') == michael.feed(limit=5)
@@ -0,0 +1,19 @@
+from sampleapp.models import identity_map
+from sampleapp.models.user import User
+
+def test_find_reads_once_per_request(app, test_users):
+    michael = test_users['michael']
+    with app.test_request_context():
+        assert User.find(michael.id) == michael
+        assert User.find(michael.id) == michael
+        assert User.find_multi([michael.id]) == [michael]
+        assert identity_map.stats() == {'reads': 1, 'hits': 2}
+
+        # モデルを通して書き込むと読み直す
+        user = User.find(michael.id)
+        user.update_attribute('name', 'Michael Example2')
+        assert User.find(michael.id).name == 'Michael Example2'
+        assert identity_map.stats()['reads'] == 2
+
+    # リクエストの外では保存しない
+    assert identity_map.stats() == {'reads': 0, 'hits': 0}
@@ -0,0 +1,80 @@
+import io
+from sampleapp.models import image_storage
+
+class FakeBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+
+    def upload_from_file(self, file, content_type=None):
+        self.bucket.blobs[self.name] = (file.read(), content_type)
+
+class FakeBucket:
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self.blobs = {}
+
+    def blob(self, name, chunk_size=None):
+        return FakeBlob(self, name)
+
+    def delete_blob(self, name):
+        self.blobs.pop(name, None)
+
+class FakeBatch:
+    def __init__(self, client):
+        self.client = client
+
+    def __enter__(self):
+        self.client.batches += 1
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+class FakeClient:
+    def __init__(self):
+        self.buckets = 0
+        self.batches = 0
+
+    def bucket(self, name):
+        self.buckets += 1
+        return FakeBucket(self, name)
+
+    def batch(self):
+        return FakeBatch(self)
+
+def test_cloud_storage_reuses_bucket_and_batches_deletes():
+    client = FakeClient()
+    storage = image_storage.CloudStorage('bucket', client=client)
+    for n in range(150):
+        storage.put(f'1/{n}.png', io.BytesIO(b'abc'), 'image/png')
+    assert client.buckets == 1
+    assert len(storage.bucket.blobs) == 150
+    storage.delete_multi([f'1/{n}.png' for n in range(150)])
+    assert storage.bucket.blobs == {}
+    assert client.batches == 2
+    stats = storage.stats()
+    assert stats['put']['count'] == 150
+    assert stats['delete']['count'] == 1
+    assert storage.url('1/a.png') == 'https://storage.googleapis.com/bucket/1/a.png'
+
+def test_local_storage_signed_upload(tmp_path):
+    storage = image_storage.LocalStorage(tmp_path, secret_key='secret')
+    upload = storage.signed_upload('uploads/1/a.png', 'image/png', 100)
+    assert upload['method'] == 'PUT'
+    assert upload['headers'] == {'Content-Type': 'image/png'}
+    path, query = upload['url'].split('?')
+    assert path == '/images/uploads/1/a.png'
+    args = dict(arg.split('=') for arg in query.split('&'))
+    assert storage.verify_upload('uploads/1/a.png', 'image/png', 100,
+                                 args['expires'], args['signature'])
+    # blob名、Content-Type、サイズの上限、期限のどれかが違えば無効
+    assert not storage.verify_upload('uploads/2/a.png', 'image/png', 100,
+                                     args['expires'], args['signature'])
+    assert not storage.verify_upload('uploads/1/a.png', 'image/gif', 100,
+                                     args['expires'], args['signature'])
+    assert not storage.verify_upload('uploads/1/a.png', 'image/png', 1000,
+                                     args['expires'], args['signature'])
+    assert not storage.verify_upload('uploads/1/a.png', 'image/png', 100,
+                                     '0', args['signature'])
@@ -1,5 +1,10 @@
+import io
+import PIL.Image
 import pytest
+from werkzeug.datastructures import FileStorage
 from sampleapp.models.micropost import Micropost
+from sampleapp.models.image import Image
+from sampleapp.models import image_storage, uploads
 
 @pytest.fixture
 def micropost(test_users):
@@ -26,3 +31,162 @@ def test_order_should_be_most_recent_first(test_microposts):
     micropost = test_microposts['most_recent']
     first_micropost = Micropost.all()[0]
     assert micropost == first_micropost
+
+def test_preload_attaches_users(test_users, test_microposts):
+    microposts = Micropost.all()[:10]
+    Micropost.preload(microposts, 'user')
+    for m in microposts:
+        assert m._user is not None
+        assert m.user().id == m.user_id
+    with pytest.raises(ValueError):
+        Micropost.preload(microposts, 'comments')
+
+def test_image_url_is_computed_from_metadata(micropost):
+    assert not micropost.image_attached()
+    assert micropost.image_url() is None
+    micropost.image = {'file_name': 'a b.png', 'blob_name': '1/a b.png',
+                       'content_type': 'image/png', 'size': 3,
+                       'sha256': 'x', 'variants': {}}
+    assert micropost.save()
+    micropost = Micropost.find(micropost.id)
+    assert micropost.image_attached()
+    old = image_storage.get_storage()
+    image_storage.set_storage(image_storage.CloudStorage('bucket'))
+    try:
+        assert micropost.image_url() == \
+            'https://storage.googleapis.com/bucket/1/a%20b.png'
+    finally:
+        image_storage.set_storage(old)
+
+class MemoryStorage(image_storage.ImageStorage):
+    def __init__(self):
+        super().__init__()
+        self.blobs = {}
+
+    def _put(self, blob_name, file, content_type):
+        self.blobs[blob_name] = file.read()
+
+    def _get(self, blob_name):
+        return self.blobs[blob_name]
+
+    def _delete_multi(self, blob_names):
+        for blob_name in blob_names:
+            self.blobs.pop(blob_name, None)
+
+    def url(self, blob_name):
+        return f'/images/{blob_name}'
+
+@pytest.fixture
+def storage():
+    storage = MemoryStorage()
+    old = image_storage.get_storage()
+    image_storage.set_storage(storage)
+    yield storage
+    image_storage.set_storage(old)
+
+def png(width, height):
+    out = io.BytesIO()
+    PIL.Image.new('RGB', (width, height), 'red').save(out, 'PNG')
+    out.seek(0)
+    return out
+
+def test_image_is_uploaded_in_background(micropost, storage):
+    image_file = FileStorage(png(1000, 800), filename='a.png',
+                             content_type='image/png')
+    micropost.image_attach(image_file)
+    assert micropost.save()
+    assert micropost.image_attached()
+    uploads.wait()
+    micropost = Micropost.find(micropost.id)
+    assert micropost.image_ready()
+    blob_name = micropost.image['blob_name']
+    assert micropost.image['size'] == len(storage.blobs[blob_name])
+    # 縮小版はアップロード時に作成される(eager)
+    display = micropost.image['variants']['display']
+    assert micropost.image_url('display') == f'/images/{display}'
+    assert PIL.Image.open(io.BytesIO(storage.blobs[display])).size == (500, 400)
+    micropost.destroy()
+    assert storage.blobs == {}
+
+def test_failed_upload_is_marked(micropost, storage, monkeypatch):
+    def broken(blob_name, file, content_type):
+        raise OSError('storage is down')
+    monkeypatch.setattr(storage, '_put', broken)
+    monkeypatch.setattr(uploads, 'RETRY_INTERVAL', 0)
+    image_file = FileStorage(png(10, 10), filename='a.png',
+                             content_type='image/png')
+    micropost.image_attach(image_file)
+    assert micropost.save()
+    assert not micropost.image_failed()
+    uploads.wait()
+    micropost = Micropost.find(micropost.id)
+    assert not micropost.image_ready()
+    assert micropost.image_failed()
+    micropost.destroy()
+
+def test_variants_are_generated_on_first_view(app, micropost, storage):
+    app.config['IMAGE_VARIANTS'] = 'lazy'
+    image_file = FileStorage(png(600, 600), filename='a.png',
+                             content_type='image/png')
+    micropost.image_attach(image_file)
+    with app.app_context():
+        assert micropost.save()
+    uploads.wait()
+    micropost = Micropost.find(micropost.id)
+    assert micropost.image['variants'] == {}
+    # 縮小版が無い間は元の画像を表示する
+    with app.app_context():
+        url = micropost.image_url('display')
+    assert url == f'/images/{micropost.image["blob_name"]}'
+    uploads.wait()
+    micropost = Micropost.find(micropost.id)
+    assert 'display' in micropost.image['variants']
+    micropost.destroy()
+    assert storage.blobs == {}
+
+def test_failed_variants_are_not_retried(app, micropost, storage, monkeypatch):
+    app.config['IMAGE_VARIANTS'] = 'lazy'
+    # 画像として読めないもの
+    image_file = FileStorage(io.BytesIO(b'not an image'), filename='a.png',
+                             content_type='image/png')
+    micropost.image_attach(image_file)
+    with app.app_context():
+        assert micropost.save()
+    uploads.wait()
+    micropost = Micropost.find(micropost.id)
+    with app.app_context():
+        micropost.image_url('display')
+    uploads.wait()
+    micropost = Micropost.find(micropost.id)
+    assert micropost.image['variants_failed']
+    gets = storage.stats()['get']['count']
+    with app.app_context():
+        url = micropost.image_url('display')
+    uploads.wait()
+    assert url == f'/images/{micropost.image["blob_name"]}'
+    assert storage.stats()['get']['count'] == gets
+    micropost.destroy()
+
+def test_same_image_is_stored_once(test_users, storage):
+    michael = test_users['michael']
+    archer = test_users['archer']
+    microposts = []
+    for user in (michael, archer):
+        m = user.microposts.build(content='Lorem ipsum')
+        m.image_attach(FileStorage(png(10, 10), filename='a.png',
+                                   content_type='image/png'))
+        assert m.save()
+        uploads.wait()
+        microposts.append(Micropost.find(m.id))
+    first, second = microposts
+    assert first.image['blob_name'] == second.image['blob_name']
+    assert first.image_url() == second.image_url()
+    assert second.image_ready()
+    assert storage.stats()['put']['count'] == 2  # 元の画像と縮小版
+    assert Image.find(first.image['sha256']).ref_count == 2
+
+    first.destroy()
+    assert first.image['blob_name'] in storage.blobs
+    second.destroy()
+    assert storage.blobs == {}
+    assert Image.find(first.image['sha256']) is None
@@ -0,0 +1,43 @@
+import threading
+from werkzeug.security import check_password_hash
+from sampleapp.models import password_hashing
+
+def test_hash_and_check_in_pool():
+    digest = password_hashing.hash_password('foobar')
+    assert check_password_hash(digest, 'foobar')
+    assert password_hashing.check_password(digest, 'foobar')
+    assert not password_hashing.check_password(digest, 'foobaz')
+    stats = password_hashing.stats()
+    assert stats['submitted'] >= 3
+    assert stats['in_flight'] == 0
+
+def test_login_returns_503_when_saturated(client, test_users, monkeypatch):
+    password_hashing.hash_password('foobar')
+    # 待たせておける枠が無い状態にする
+    monkeypatch.setattr(password_hashing, '_slots', threading.BoundedSemaphore(1))
+    password_hashing._slots.acquire()
+    rejected = password_hashing.stats()['rejected']
+    with client:
+        client.get('/login')
+        with client.session_transaction() as sess:
+            sess['csrf_token'] = 'token'
+        response = client.post('/login',
+                               data={'email': test_users['michael'].email,
+                                     'password': 'password',
+                                     'authenticity_token': 'token'})
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+    assert password_hashing.stats()['rejected'] == rejected + 1
+
+def test_max_workers_split_between_gunicorn_workers(app, monkeypatch):
+    monkeypatch.delenv('SAMPLEAPP_PASSWORD_HASHING_WORKERS', raising=False)
+    monkeypatch.setattr(password_hashing.os, 'cpu_count', lambda: 8)
+    monkeypatch.setenv('WEB_CONCURRENCY', '4')
+    assert password_hashing.get_max_workers() == 2
+    monkeypatch.setenv('WEB_CONCURRENCY', '16')
+    assert password_hashing.get_max_workers() == 1
+    monkeypatch.setenv('SAMPLEAPP_PASSWORD_HASHING_WORKERS', '3')
+    assert password_hashing.get_max_workers() == 3
+    monkeypatch.setitem(app.config, 'PASSWORD_HASHING_WORKERS', 5)
+    with app.app_context():
+        assert password_hashing.get_max_workers() == 5
@@ -1,4 +1,7 @@
 import pytest
+from datetime import datetime, timezone
+from sampleapp.models import database
+from sampleapp.models.counter import Counter
 from sampleapp.models.relationship import Relationship
 
 @pytest.fixture
@@ -17,3 +20,75 @@ def test_should_require_a_follower_id(relationship):
 def test_should_require_a_followed_id(relationship):
     relationship.followed_id = None
     assert not relationship.valid()
+
+def test_relationship_is_keyed_by_users(relationship):
+    assert relationship.save()
+    assert relationship.id == \
+        f'{relationship.follower_id}:{relationship.followed_id}'
+    assert Relationship.find_by_users(relationship.follower_id,
+                                      relationship.followed_id).id == \
+        relationship.id
+    # 同じrelationshipは作成できない
+    before_count = Relationship.count()
+    duplicate = Relationship(follower_id=relationship.follower_id,
+                             followed_id=relationship.followed_id)
+    assert not duplicate.save()
+    assert duplicate.errors.count == 1
+    assert Relationship.count() == before_count
+    relationship.destroy()
+    assert Relationship.find_by_users(relationship.follower_id,
+                                      relationship.followed_id) is None
+
+@pytest.fixture
+def legacy_relationship(test_users):
+    # 移行前の整数のidのrelationship(michaelがlanaをフォロー)
+    legacy = database.Entity(Relationship.KIND_RELATIONSHIPS)
+    legacy['follower_id'] = test_users['michael'].id
+    legacy['followed_id'] = test_users['lana'].id
+    legacy['created_at'] = datetime.now(timezone.utc)
+    backend = database.get_backend()
+    backend.put(legacy)
+    yield legacy
+    backend.delete(Relationship.KIND_RELATIONSHIPS, legacy.id)
+
+def test_followed_ids_reads_legacy_relationships(test_users,
+                                                 legacy_relationship):
+    michael = test_users['michael']
+    archer = test_users['archer']
+    lana = test_users['lana']
+    michael.follow(archer)
+    assert sorted(Relationship.followed_ids(michael.id)) == \
+        sorted([archer.id, lana.id])
+    assert michael.is_following(lana)
+    michael.unfollow(archer)
+
+def test_delete_multi_updates_counters_in_one_batch(test_users,
+                                                    legacy_relationship,
+                                                    monkeypatch):
+    michael = test_users['michael']
+    archer = test_users['archer']
+    lana = test_users['lana']
+    legacy = legacy_relationship
+    michael.follow(archer)
+    lana.follow(archer)
+    Counter.increment_multi({
+        Counter.name('users', michael.id, 'following'): 1,
+        Counter.name('users', lana.id, 'followers'): 1,
+        Counter.kind_name(Relationship.KIND_RELATIONSHIPS): 1})
+    before = Relationship.count()
+    followers = archer.followers_count()
+    following = michael.following_count()
+    lana_followers = lana.followers_count()
+    def increment(name, delta=1):
+        raise AssertionError('counters should be updated in one batch')
+    monkeypatch.setattr(Counter, 'increment', increment)
+    Relationship.delete_multi([Relationship.key(michael.id, archer.id),
+                               Relationship.key(lana.id, archer.id),
+                               legacy.id])
+    assert database.get_backend().get(Relationship.KIND_RELATIONSHIPS,
+                                      legacy.id) is None
+    assert not michael.is_following(archer)
+    assert archer.followers_count() == followers - 2
+    assert michael.following_count() == following - 2
+    assert lana.followers_count() == lana_followers - 1
+    assert Relationship.count() == before - 3
@@ -0,0 +1,41 @@
+from sampleapp.models.timeline import Timeline
+
+def test_micropost_is_added_to_followers_timeline(test_users):
+    michael = test_users['michael']
+    archer = test_users['archer']
+    michael.follow(archer)
+    m = archer.microposts.create(content='Lorem ipsum')
+    assert m in michael.feed()
+    assert m in archer.feed()
+    m.destroy()
+    assert m not in michael.feed()
+    assert m not in archer.feed()
+
+def test_follow_backfills_and_unfollow_removes(test_users):
+    michael = test_users['michael']
+    archer = test_users['archer']
+    m = archer.microposts.create(content='Lorem ipsum')
+    assert m not in michael.feed()
+    michael.follow(archer)
+    assert m in michael.feed()
+    michael.unfollow(archer)
+    assert m not in michael.feed()
+
+def test_backfill_adds_only_recent_microposts(test_users):
+    michael = test_users['michael']
+    archer = test_users['archer']
+    ms = [archer.microposts.create(content=f'Lorem ipsum {n}') for n in range(3)]
+    Timeline.backfill(michael.id, archer.id, limit=2)
+    feed = michael.feed()
+    assert ms[2] in feed and ms[1] in feed
+    assert ms[0] not in feed
+    Timeline.remove_author(michael.id, archer.id)
+
+def test_rebuild(test_users, test_relationships):
+    michael = test_users['michael']
+    lana = test_users['lana']
+    m = lana.microposts.create(content='Lorem ipsum')
+    Timeline.clear(michael.id)
+    assert michael.feed() == []
+    Timeline.rebuild(michael.id)
+    assert m in michael.feed()
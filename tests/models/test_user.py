@@ -1,7 +1,13 @@
 import pytest
 import copy
+import threading
+from sampleapp.models import database
+from sampleapp.models import keyset
 from sampleapp.models.user import User
 from sampleapp.models.micropost import Micropost
+from sampleapp.models.relationship import Relationship
+from sampleapp.models.counter import Counter
+from sampleapp.models import uploads, user_deletion
 
 @pytest.fixture
 def user():
@@ -53,6 +59,54 @@ def test_email_addresses_should_be_unique(user):
     finally:
         user.destroy()
 
+def test_save_reports_taken_email(user, test_users):
+    # 重複の確認は保存するtransactionの中で行い、エラーは同じように報告する
+    user.email = test_users['michael'].email.upper()
+    assert not user.save()
+    assert user.errors.messages == {'email': ['email has already been taken']}
+    assert user.id is None
+
+    archer = test_users['archer']
+    assert not archer.update(email=test_users['michael'].email)
+    assert archer.errors.messages == {'email': ['email has already been taken']}
+    assert User.find(archer.id).email == archer.email
+    assert User.find_by_email(archer.email).id == archer.id
+
+    # 他の項目も不正な時は一緒に報告する
+    user.password = user.password_confirmation = 'foo'
+    assert not user.save()
+    assert user.errors.messages['email'] == ['email has already been taken']
+    assert 'password' in user.errors.messages
+    assert not archer.update(email=test_users['michael'].email, name='')
+    assert archer.errors.messages['email'] == ['email has already been taken']
+    assert 'name' in archer.errors.messages
+
+def test_find_by_email(user):
+    try:
+        user.email = 'User@Example.com'
+        assert user.save()
+        assert User.find_by_email('user@example.com').id == user.id
+        assert User.find_by_email('USER@example.com').id == user.id
+        assert User.find_by_email('other@example.com') is None
+        assert user.update_attribute('email', 'new@example.com')
+        assert User.find_by_email('user@example.com') is None
+        assert User.find_by_email('new@example.com').id == user.id
+    finally:
+        user.destroy()
+    assert User.find_by_email('new@example.com') is None
+
+def test_find_by_email_without_user_id(user):
+    try:
+        assert user.save()
+        # ユーザーのidを保存する前に登録されたemailアドレス
+        backend = database.get_backend()
+        entity = backend.get(User.KIND_EMAILS, user.email)
+        del entity['user_id']
+        backend.put(entity)
+        assert User.find_by_email(user.email).id == user.id
+    finally:
+        user.destroy()
+
 def test_password_should_be_present_nonblank(user):
     user.password = user.password_confirmation = " " * 6
     assert not user.valid()
@@ -64,6 +118,25 @@ def test_password_should_have_a_minimum_length(user):
 def test_authenticated_should_return_false_for_a_user_with_nil_digest(user):
     assert not user.authenticated('remember', '')
 
+def test_authenticated_with_token_digest(test_users):
+    user = test_users['michael']
+    user.remember()
+    assert user.remember_digest.startswith('hmac-sha256$')
+    assert user.authenticated('remember', user.remember_token)
+    assert not user.authenticated('remember', User.new_token())
+    selector, verifier = user.remember_token.split('.')
+    assert not user.authenticated('remember', f'{selector}.{verifier[::-1]}')
+
+def test_authenticated_migrates_old_digest(test_users):
+    user = test_users['michael']
+    token = User.new_token()
+    # 以前の形式(PBKDF2)のdigest
+    user.update_attribute('reset_digest', User.digest(token))
+    assert user.authenticated('reset', token)
+    user.reload()
+    assert user.reset_digest == User.token_digest(token)
+    assert user.authenticated('reset', token)
+
 def test_associated_microposts_should_be_destroyed(user):
     try:
         user.save()
@@ -71,12 +144,97 @@ def test_associated_microposts_should_be_destroyed(user):
         before_count = Micropost.count()
     finally:
         user.destroy()
+        user_deletion.wait()
         after_count = Micropost.count()
         m = Micropost.find(m.id)
         if m:
             m.destroy()
         assert before_count - 1 == after_count
 
+def test_destroy_deletes_associated_data_in_batches(test_users, monkeypatch):
+    monkeypatch.setattr(user_deletion, 'BATCH', 2)
+    michael = test_users['michael']
+    archer = test_users['archer']
+    lana = test_users['lana']
+    user = User(name='Example User', email='user@example.com',
+                password='foobar', password_confirmation='foobar')
+    try:
+        user.save()
+        for n in range(5):
+            user.microposts.create(content=f'Lorem ipsum {n}')
+        user.follow(michael)
+        user.follow(archer)
+        lana.follow(user)
+        archer.follow(user)
+        michael_followers = michael.followers_count()
+        archer_following = archer.following_count()
+    finally:
+        user.destroy()
+    assert User.find(user.id) is None
+    user_deletion.wait()
+    backend = database.get_backend()
+    assert backend.get(user_deletion.KIND_USER_DELETIONS, user.id) is None
+    assert not Micropost.find_by(user_id=user.id)
+    assert not Relationship.find_by(follower_id=user.id)
+    assert not Relationship.find_by(followed_id=user.id)
+    assert michael.followers_count() == michael_followers - 1
+    assert archer.following_count() == archer_following - 1
+    assert Counter.get(Counter.name(User.KIND_USERS, user.id, 'microposts')) == 0
+
+def test_destroy_does_not_wait_for_uploads(user):
+    # アップロードのthreadが全て塞がっていても関連するデータは削除される
+    release = threading.Event()
+    for n in range(uploads.MAX_WORKERS):
+        uploads.run(release.wait, 10)
+    try:
+        user.save()
+        m = user.microposts.create(content='Lorem ipsum')
+        user.destroy()
+        user_deletion.wait(timeout=5)
+        assert Micropost.find(m.id) is None
+    finally:
+        release.set()
+        uploads.wait()
+
+def test_interrupted_destroy_is_resumed(user, monkeypatch):
+    # ジョブを実行せずにプロセスが落ちた状態を作る
+    monkeypatch.setattr(user_deletion, 'start', lambda user_id: None)
+    user.save()
+    m = user.microposts.create(content='Lorem ipsum')
+    user.destroy()
+    assert Micropost.find(m.id) is not None
+    backend = database.get_backend()
+    job = backend.get(user_deletion.KIND_USER_DELETIONS, user.id)
+    # 期限が切れるまでは他から再開しない
+    assert not user_deletion.run(user.id)
+    job['lease_until'] = job['created_at']
+    backend.put(job)
+    user_deletion.resume()
+    user_deletion.wait()
+    assert Micropost.find(m.id) is None
+    assert backend.get(user_deletion.KIND_USER_DELETIONS, user.id) is None
+
+def test_resume_runs_periodically_after_failures(monkeypatch):
+    calls = []
+    def resume():
+        calls.append(1)
+        if len(calls) == 1:
+            raise RuntimeError('datastore is unavailable')
+    class Stop(Exception):
+        pass
+    class Wakeup:
+        def wait(self, timeout):
+            assert timeout == user_deletion.RESUME_INTERVAL
+            if len(calls) == 3:
+                raise Stop()
+        def clear(self):
+            pass
+    monkeypatch.setattr(user_deletion, 'resume', resume)
+    monkeypatch.setattr(user_deletion, '_wakeup', Wakeup())
+    with pytest.raises(Stop):
+        user_deletion._resume_periodically()
+    assert len(calls) == 3
+
 def test_should_follow_and_unfollow_a_user(test_users):
     michael = test_users['michael']
     archer = test_users['archer']
@@ -87,6 +245,26 @@ def test_should_follow_and_unfollow_a_user(test_users):
     michael.unfollow(archer)
     assert not michael.is_following(archer)
 
+def test_is_following_reads_followed_ids_once(test_users, test_relationships,
+                                              monkeypatch):
+    michael = test_users['michael']
+    others = [u for u in test_users.values() if u.id != michael.id]
+    expected = {u.id for u in others
+                if Relationship.find_by_users(michael.id, u.id)}
+    assert expected
+    michael = User.find(michael.id)
+    # 何人分確かめてもクエリは1回
+    assert {u.id for u in others if michael.is_following(u)} == expected
+    monkeypatch.setattr(Relationship, 'followed_ids', None)
+    assert {u.id for u in others if michael.is_following(u)} == expected
+
+    # 多くの人をフォローしている時はキーで確かめる
+    monkeypatch.undo()
+    monkeypatch.setattr(User, 'MAX_FOLLOWED_IDS', 0)
+    michael = User.find(michael.id)
+    assert {u.id for u in others if michael.is_following(u)} == expected
+    assert michael._followed_ids() is None
+
 def test_feed_should_have_the_right_posts(test_users, test_microposts,
                                           test_relationships):
     michael = test_users['michael']
@@ -101,3 +279,35 @@ def test_feed_should_have_the_right_posts(test_users, test_microposts,
     # フォローしていないユーザーの投稿を確認
     for post_unfollowed in archer.microposts():
         assert not post_unfollowed in michael.feed()
+
+def test_find_multi_keeps_order_and_skips_missing(test_users):
+    michael = test_users['michael']
+    archer = test_users['archer']
+    lana = test_users['lana']
+    ids = [lana.id, michael.id, 999999999, archer.id]
+    assert User.find_multi(ids) == [lana, michael, archer]
+    assert User.find_multi([]) == []
+
+def test_paginate_with_cursors(test_users):
+    everything = User.all()
+    pages = []
+    page = User.paginate(limit=2)
+    assert page.prev_cursor is None
+    while True:
+        pages.append(page)
+        if not page.next_cursor:
+            break
+        page = User.paginate(cursor=page.next_cursor, limit=2)
+    assert [u for p in pages for u in p] == everything
+
+    # 前のページに戻る
+    back = User.paginate(cursor=pages[1].prev_cursor, limit=2)
+    assert back == pages[0]
+
+def test_paginate_ignores_tampered_cursor(test_users):
+    first = User.paginate(limit=2)
+    cursor = keyset.Cursor.decode(first.next_cursor)
+    for id in ([1], {'a': 1}, None, True, 1.5):
+        cursor.id = id
+        assert keyset.Cursor.decode(cursor.encode()) is None
+        assert User.paginate(cursor=cursor.encode(), limit=2) == first